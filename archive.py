@@ -0,0 +1,447 @@
+"""
+Columnar archive of device telemetry in Parquet.
+
+The archive job moves aged readings out of the operational database:
+
+    python archive.py archive --source mongo --older-than-days 30
+    python archive.py archive --source kafka        # straight from the topic
+    python archive.py compact --date 2026-01-31     # merge small files
+
+Files are hive-partitioned by day and device:
+
+    <root>/date=2026-01-31/Device_ID=1150/part-<first id>-0.parquet
+
+Route strings are dictionary-encoded (a handful of distinct values per
+file), and every file is sorted by event_time with statistics, so
+ArchiveReader prunes whole directories by date and Device_ID and skips row
+groups by time range before reading anything. Files are read through
+memory-mapped I/O.
+
+From Mongo, each batch is written first and only then deleted from the
+collection, so a crash in between leaves the batch in both places. The
+re-run then overwrites the same file, because a batch's file name comes
+from its first _id. Only the readings that were written are deleted:
+those without a usable Device_ID or with values that do not fit the file
+schema are logged and left in the collection. From Kafka, offsets are
+committed after the write.
+
+pyarrow is optional for the rest of the app: without it, the archive
+endpoints answer 503 and this job refuses to run.
+"""
+import argparse
+import logging
+import os
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+import telemetry_fields
+import wire_format
+from logging_setup import configure_logging
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "telemetry_archive")
+MONGODB_URI = os.environ.get("MONGODB_URI", "mongodb://localhost:27017")
+DATABASE_NAME = os.environ.get("DATABASE_NAME", "scmlitedb")
+COLLECTION_NAME = os.environ.get("ARCHIVE_COLLECTION", "device_stream_data")
+KAFKA_BOOTSTRAP_SERVERS = os.environ.get("KAFKA_BOOTSTRAP_SERVERS", "localhost:9092").split(",")
+KAFKA_TOPIC = os.environ.get("KAFKA_TOPIC", "device_stream_data")
+BATCH_RECORDS = int(os.environ.get("ARCHIVE_BATCH_RECORDS", 50000))
+# Rows per Parquet row group; the unit of time-range skipping
+ROW_GROUP_RECORDS = 64 * 1024
+# Upper bound on rows returned by a range query
+MAX_RANGE_ROWS = 10000
+
+ROUTE_COLUMNS = ["Route_From", "Route_To"]
+NUMERIC_COLUMNS = ["Battery_Level", "First_Sensor_temperature", "Seq"]
+GROUP_BY_COLUMNS = {"device": ["Device_ID"], "date": ["date"], "route": ROUTE_COLUMNS}
+
+
+def require_pyarrow():
+    if pa is None:
+        raise RuntimeError("The telemetry archive needs pyarrow (pip install pyarrow)")
+
+
+def file_schema():
+    """Columns stored in each file; date and Device_ID live in the directory names."""
+    return pa.schema([
+        ("event_time", pa.timestamp("ms", tz="UTC")),
+        ("Battery_Level", pa.float64()),
+        ("First_Sensor_temperature", pa.float64()),
+        ("Route_From", pa.dictionary(pa.int32(), pa.string())),
+        ("Route_To", pa.dictionary(pa.int32(), pa.string())),
+        ("Seq", pa.int64()),
+        ("source_id", pa.string()),
+    ])
+
+
+def dataset_schema():
+    return file_schema().append(pa.field("date", pa.string())).append(pa.field("Device_ID", pa.int64()))
+
+
+def partitioning():
+    return ds.partitioning(pa.schema([("date", pa.string()), ("Device_ID", pa.int64())]), flavor="hive")
+
+
+def _event_time(reading: Dict[str, Any], fallback: datetime) -> datetime:
+    sent_at = reading.get("Sent_At")
+    if isinstance(sent_at, (int, float)):
+        return datetime.fromtimestamp(sent_at, tz=timezone.utc)
+    return fallback
+
+
+def _fits(value: Any, types) -> bool:
+    return value is None or (isinstance(value, types) and not isinstance(value, bool))
+
+
+def archivable(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    The rows that fit file_schema(), with Device_ID as an int. The others
+    (no Device_ID, or a value of the wrong type) are counted in the log.
+    """
+    kept = []
+    for row in rows:
+        try:
+            device_id = int(row["Device_ID"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if not all(_fits(row.get(field), (int, float)) for field in NUMERIC_COLUMNS):
+            continue
+        if not all(_fits(row.get(field), str) for field in ROUTE_COLUMNS):
+            continue
+        row["Device_ID"] = device_id
+        kept.append(row)
+    if len(kept) < len(rows):
+        logger.warning(f"Skipped {len(rows) - len(kept)} readings that do not fit the archive schema")
+    return kept
+
+
+def readings_to_table(rows: List[Dict[str, Any]]):
+    """
+    rows: archivable() readings with an 'event_time' (aware datetime) and a
+    'source_id' (Mongo _id or Kafka partition/offset).
+    """
+    columns = {
+        "event_time": [row["event_time"] for row in rows],
+        "Battery_Level": [row.get("Battery_Level") for row in rows],
+        "First_Sensor_temperature": [row.get("First_Sensor_temperature") for row in rows],
+        "Route_From": [row.get("Route_From") for row in rows],
+        "Route_To": [row.get("Route_To") for row in rows],
+        "Seq": [row.get("Seq") for row in rows],
+        "source_id": [row["source_id"] for row in rows],
+    }
+    table = pa.Table.from_pydict(columns, schema=file_schema())
+    return table.append_column("date", pa.array([row["event_time"].strftime("%Y-%m-%d") for row in rows])) \
+        .append_column("Device_ID", pa.array([row["Device_ID"] for row in rows], pa.int64()))
+
+
+class ArchiveWriter:
+    def __init__(self, root: str = ARCHIVE_DIR):
+        require_pyarrow()
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def write(self, table, batch_name: str) -> int:
+        """Write one batch; re-writing a batch with the same name replaces its files."""
+        if not table.num_rows:
+            return 0
+        table = table.sort_by([("Device_ID", "ascending"), ("event_time", "ascending")])
+        ds.write_dataset(
+            table,
+            self.root,
+            format="parquet",
+            partitioning=partitioning(),
+            basename_template=f"part-{batch_name}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+            file_options=ds.ParquetFileFormat().make_write_options(
+                compression="zstd", use_dictionary=ROUTE_COLUMNS, write_statistics=True
+            ),
+            max_rows_per_group=ROW_GROUP_RECORDS,
+            min_rows_per_group=min(ROW_GROUP_RECORDS, table.num_rows),
+        )
+        return table.num_rows
+
+    def compact(self, day: str) -> int:
+        """Merge each device's files for `day` into one sorted file; returns files removed."""
+        removed = 0
+        day_dir = os.path.join(self.root, f"date={day}")
+        if not os.path.isdir(day_dir):
+            return 0
+        for device_dir in sorted(os.listdir(day_dir)):
+            path = os.path.join(day_dir, device_dir)
+            files = sorted(name for name in os.listdir(path) if name.endswith(".parquet"))
+            if len(files) < 2:
+                continue
+            table = pa.concat_tables([pq.read_table(os.path.join(path, name), schema=file_schema()) for name in files])
+            table = table.sort_by("event_time")
+            name = f"compacted-{int(time.time())}.parquet"
+            # Dataset discovery skips files starting with "_" until the rename
+            staging = os.path.join(path, f"_{name}")
+            pq.write_table(
+                table, staging, compression="zstd", use_dictionary=ROUTE_COLUMNS,
+                row_group_size=ROW_GROUP_RECORDS, write_statistics=True
+            )
+            # The new file is in place before the old ones go; a reader may
+            # briefly see both, never neither
+            os.replace(staging, os.path.join(path, name))
+            for old in files:
+                os.remove(os.path.join(path, old))
+            removed += len(files)
+        return removed
+
+
+# ------------------ ARCHIVE JOBS ------------------
+
+def archive_from_mongo(collection, writer: ArchiveWriter, older_than: timedelta, delete: bool = True,
+                       batch_records: int = BATCH_RECORDS) -> int:
+    """Move readings older than `older_than` from `collection` into the archive."""
+    from bson import ObjectId
+
+    cutoff = ObjectId.from_datetime(datetime.now(timezone.utc) - older_than)
+    total = 0
+    last_id = None
+    while True:
+        query = {"_id": {"$lt": cutoff}}
+        if last_id is not None:
+            query["_id"]["$gt"] = last_id
+        documents = list(collection.find(query).sort("_id", 1).limit(batch_records))
+        if not documents:
+            break
+        rows = []
+        for document in documents:
+            # Readings may be stored under short field names
+            document = telemetry_fields.from_stored(document)
+            document["event_time"] = _event_time(document, document["_id"].generation_time)
+            document["source_id"] = str(document["_id"])
+            rows.append(document)
+        rows = archivable(rows)
+        written = writer.write(readings_to_table(rows), str(documents[0]["_id"]))
+        if delete and rows:
+            collection.delete_many({"_id": {"$in": [row["_id"] for row in rows]}})
+        last_id = documents[-1]["_id"]
+        total += written
+        logger.info(f"Archived {written} readings up to {last_id}")
+    return total
+
+
+def archive_from_kafka(consumer, writer: ArchiveWriter, batch_records: int = BATCH_RECORDS,
+                       idle_timeout_ms: int = 5000) -> int:
+    """Archive the topic from the group's committed position until it is caught up."""
+    total = 0
+    while True:
+        rows, first = [], None
+        while len(rows) < batch_records:
+            batches = consumer.poll(timeout_ms=idle_timeout_ms, max_records=batch_records - len(rows))
+            if not batches:
+                break
+            for records in batches.values():
+                for record in records:
+                    try:
+                        reading = wire_format.decode_kafka_value(record.value, record.headers)
+                    except (ValueError, wire_format.WireFormatError):
+                        continue
+                    if not isinstance(reading, dict):
+                        continue
+                    source_id = f"{record.partition}-{record.offset}"
+                    first = first or source_id
+                    fallback = datetime.fromtimestamp(record.timestamp / 1000.0, tz=timezone.utc)
+                    reading["event_time"] = _event_time(reading, fallback)
+                    reading["source_id"] = source_id
+                    rows.append(reading)
+        if not rows:
+            return total
+        total += writer.write(readings_to_table(archivable(rows)), first)
+        consumer.commit()
+        logger.info(f"Archived {total} readings from Kafka")
+
+
+# ------------------ QUERIES ------------------
+
+def _day(value: datetime) -> str:
+    return value.astimezone(timezone.utc).strftime("%Y-%m-%d")
+
+
+class ArchiveReader:
+    """Range and aggregate queries over the archive with partition and row-group pruning."""
+
+    def __init__(self, root: str = ARCHIVE_DIR):
+        require_pyarrow()
+        self.root = root
+        self.filesystem = pafs.LocalFileSystem(use_mmap=True)
+
+    def _dataset(self):
+        # Re-listed per query so files written by the job since are visible
+        return ds.dataset(
+            self.root, format="parquet", partitioning=partitioning(),
+            filesystem=self.filesystem, schema=dataset_schema(),
+        )
+
+    def _filter(self, start: datetime, end: datetime, device_ids: Optional[Iterable[int]]):
+        # date is compared as text: ISO days sort correctly
+        expression = (
+            (ds.field("date") >= _day(start)) & (ds.field("date") <= _day(end))
+            & (ds.field("event_time") >= pa.scalar(start, pa.timestamp("ms", tz="UTC")))
+            & (ds.field("event_time") < pa.scalar(end, pa.timestamp("ms", tz="UTC")))
+        )
+        if device_ids:
+            expression &= ds.field("Device_ID").isin([int(d) for d in device_ids])
+        return expression
+
+    def _table(self, start, end, device_ids, columns=None):
+        if not os.path.isdir(self.root):
+            return pa.table({name: [] for name in (columns or [])})
+        return self._dataset().to_table(columns=columns, filter=self._filter(start, end, device_ids))
+
+    def range(self, start: datetime, end: datetime, device_ids: Optional[Iterable[int]] = None,
+              limit: int = 1000) -> List[Dict[str, Any]]:
+        """
+        Readings in [start, end), oldest first. Days are scanned in order
+        and the scan stops once `limit` rows are found, so a long range
+        only reads the days it returns.
+        """
+        columns = ["event_time", "Device_ID", "Battery_Level", "First_Sensor_temperature",
+                   "Route_From", "Route_To", "Seq"]
+        limit = min(limit, MAX_RANGE_ROWS)
+        days = [day for day in self.partitions() if _day(start) <= day <= _day(end)]
+        if not days:
+            return []
+        dataset = self._dataset()
+        tables, found = [], 0
+        for day in days:
+            table = dataset.to_table(
+                columns=columns, filter=self._filter(start, end, device_ids) & (ds.field("date") == day)
+            )
+            if table.num_rows:
+                table = table.sort_by("event_time").slice(0, limit - found)
+                tables.append(table)
+                found += table.num_rows
+                if found >= limit:
+                    break
+        if not tables:
+            return []
+        rows = pa.concat_tables(tables).to_pylist()
+        for row in rows:
+            row["event_time"] = row["event_time"].timestamp()
+        return rows
+
+    def aggregate(self, start: datetime, end: datetime, device_ids: Optional[Iterable[int]] = None,
+                  group_by: str = "device") -> List[Dict[str, Any]]:
+        """Count and battery/temperature statistics per device, day or route."""
+        keys = GROUP_BY_COLUMNS[group_by]
+        table = self._table(start, end, device_ids, keys + ["Battery_Level", "First_Sensor_temperature"])
+        if not table.num_rows:
+            return []
+        for key in keys:
+            column = table[key]
+            if pa.types.is_dictionary(column.type):
+                table = table.set_column(table.schema.get_field_index(key), key, pc.cast(column, pa.string()))
+        result = table.group_by(keys).aggregate([
+            ("Battery_Level", "count"),
+            ("Battery_Level", "mean"),
+            ("Battery_Level", "min"),
+            ("First_Sensor_temperature", "mean"),
+            ("First_Sensor_temperature", "min"),
+            ("First_Sensor_temperature", "max"),
+        ])
+        result = result.rename_columns([
+            "readings" if name == "Battery_Level_count" else name for name in result.column_names
+        ])
+        return result.sort_by([(key, "ascending") for key in keys]).to_pylist()
+
+    def partitions(self) -> List[str]:
+        """Archived days, oldest first."""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name[len("date="):] for name in os.listdir(self.root) if name.startswith("date="))
+
+
+# ------------------ CLI ------------------
+
+def _mongo_collection():
+    import mongo_clients
+
+    client = mongo_clients.create_client(MONGODB_URI, "archiver")
+    # Exports read aged readings, which a lagging secondary holds too;
+    # the deletes still go to the primary
+    return client, mongo_clients.analytics(client[DATABASE_NAME][COLLECTION_NAME])
+
+
+def _kafka_consumer():
+    from kafka import KafkaConsumer
+
+    consumer = KafkaConsumer(
+        bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
+        auto_offset_reset="earliest",
+        enable_auto_commit=False,
+        # Separate group: archiving never moves the live consumer's offsets
+        group_id="telemetry_archiver",
+    )
+    consumer.subscribe([KAFKA_TOPIC])
+    return consumer
+
+
+def run_archive(options) -> int:
+    writer = ArchiveWriter(options.root)
+    if options.source == "kafka":
+        consumer = _kafka_consumer()
+        try:
+            return archive_from_kafka(consumer, writer, options.batch)
+        finally:
+            consumer.close()
+    client, collection = _mongo_collection()
+    try:
+        return archive_from_mongo(
+            collection, writer, timedelta(days=options.older_than_days), delete=not options.keep,
+            batch_records=options.batch
+        )
+    finally:
+        client.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parquet archive of device telemetry")
+    parser.add_argument("--root", default=ARCHIVE_DIR, help="Archive directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    archive = commands.add_parser("archive", help="Move aged readings into the archive")
+    archive.add_argument("--source", choices=["mongo", "kafka"], default="mongo")
+    archive.add_argument("--older-than-days", type=float, default=30,
+                         help="Mongo source: archive readings older than this")
+    archive.add_argument("--keep", action="store_true", help="Mongo source: copy without deleting")
+    archive.add_argument("--batch", type=int, default=BATCH_RECORDS, help="Readings per written batch")
+    archive.add_argument("--every", type=float, default=0,
+                         help="Repeat every N seconds instead of running once")
+
+    compact = commands.add_parser("compact", help="Merge each device's files for a day into one")
+    compact.add_argument("--date", help="YYYY-MM-DD (default: yesterday, UTC)")
+
+    options = parser.parse_args(argv)
+    configure_logging("archive")
+    require_pyarrow()
+
+    if options.command == "compact":
+        day = options.date or (date.today() - timedelta(days=1)).isoformat()
+        removed = ArchiveWriter(options.root).compact(day)
+        logger.info(f"Compacted {day}: merged {removed} files")
+        return
+
+    while True:
+        total = run_archive(options)
+        logger.info(f"Archive run finished: {total} readings archived")
+        if not options.every:
+            break
+        time.sleep(options.every)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Static asset pipeline and pre-rendered pages for the web app.
+
+AssetPipeline reads static/ once at startup, fingerprints every file with a
+content hash (dashboard.css -> dashboard.3f2a1b9c0d12.css) and keeps gzip and,
+when the brotli package is installed, brotli variants next to the original.
+AssetFiles serves them under /assets with immutable cache headers: a changed
+file gets a new URL, so browsers never need to revalidate. Templates link to
+assets through the asset_url() Jinja global.
+
+None of the pages vary per user (account data is fetched by the page's
+JavaScript), so PageCache renders each template once, compresses it and
+answers repeat loads with 304 Not Modified when the ETag still matches.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, Optional
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Immutable: the URL changes whenever the content does
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Pages may change on deploy; browsers revalidate with If-None-Match
+PAGE_CACHE_CONTROL = "no-cache"
+# Compressing tiny files costs more than it saves
+MIN_COMPRESS_SIZE = 256
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+# Preferred first
+ENCODINGS = ("br", "gzip")
+
+
+def _compress(body: bytes) -> Dict[str, bytes]:
+    """Pre-compressed variants that are actually smaller than the original."""
+    variants = {}
+    if len(body) < MIN_COMPRESS_SIZE:
+        return variants
+    # mtime=0 keeps the output identical between builds
+    gzipped = gzip.compress(body, compresslevel=9, mtime=0)
+    if len(gzipped) < len(body):
+        variants["gzip"] = gzipped
+    if brotli is not None:
+        compressed = brotli.compress(body, quality=11)
+        if len(compressed) < len(body):
+            variants["br"] = compressed
+    return variants
+
+
+def choose_encoding(accept_encoding: str, available) -> Optional[str]:
+    """Best encoding from `available` that the client accepts, or None for identity."""
+    accepted = set()
+    for token in accept_encoding.split(","):
+        name, _, params = token.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(name.strip().lower())
+    for encoding in ENCODINGS:
+        if encoding in available and (encoding in accepted or "*" in accepted):
+            return encoding
+    return None
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison, as required for If-None-Match."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    wanted = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == wanted:
+            return True
+    return False
+
+
+def not_modified(request: Request, etag: str, last_modified: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+class CachedBody:
+    """A response body with its validators and pre-compressed variants."""
+
+    def __init__(self, body: bytes, media_type: str, last_modified: float, compress: bool = True):
+        self.body = body
+        self.media_type = media_type
+        self.digest = hashlib.sha256(body).hexdigest()
+        self.etag = f'W/"{self.digest[:16]}"'
+        self.last_modified = last_modified
+        self.variants = _compress(body) if compress else {}
+
+    def response(self, request: Request, cache_control: str) -> Response:
+        headers = {
+            "ETag": self.etag,
+            "Last-Modified": formatdate(self.last_modified, usegmt=True),
+            "Cache-Control": cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if not_modified(request, self.etag, self.last_modified):
+            return Response(status_code=304, headers=headers)
+        encoding = choose_encoding(request.headers.get("accept-encoding", ""), self.variants)
+        body = self.body
+        if encoding:
+            body = self.variants[encoding]
+            # GZipMiddleware leaves responses that already have an encoding alone
+            headers["Content-Encoding"] = encoding
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(body))
+            return Response(status_code=200, headers=headers, media_type=self.media_type)
+        return Response(body, headers=headers, media_type=self.media_type)
+
+
+# ------------------ STATIC ASSETS ------------------
+
+class AssetPipeline:
+    """Fingerprinted, pre-compressed copies of the files under `directory`."""
+
+    def __init__(self, directory: str, url_prefix: str = "/assets", fallback_prefix: str = "/static"):
+        self.directory = directory
+        self.url_prefix = url_prefix
+        self.fallback_prefix = fallback_prefix
+        # logical path ("dashboard.css") -> fingerprinted path ("dashboard.<hash>.css")
+        self.manifest: Dict[str, str] = {}
+        self.files: Dict[str, CachedBody] = {}
+        self.build()
+
+    def build(self):
+        manifest, files = {}, {}
+        for root, _, names in os.walk(self.directory):
+            for name in sorted(names):
+                full_path = os.path.join(root, name)
+                logical = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+                with open(full_path, "rb") as f:
+                    body = f.read()
+                media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                asset = CachedBody(
+                    body, media_type, os.path.getmtime(full_path),
+                    compress=media_type.startswith(COMPRESSIBLE_TYPES)
+                )
+                stem, ext = os.path.splitext(logical)
+                fingerprinted = f"{stem}.{asset.digest[:12]}{ext}"
+                manifest[logical] = fingerprinted
+                files[fingerprinted] = asset
+        self.manifest, self.files = manifest, files
+
+    def url(self, path: str) -> str:
+        """URL for a static file; unknown files fall back to the plain /static mount."""
+        path = path.lstrip("/")
+        fingerprinted = self.manifest.get(path)
+        if fingerprinted is None:
+            return f"{self.fallback_prefix}/{path}"
+        return f"{self.url_prefix}/{fingerprinted}"
+
+
+class AssetFiles:
+    """ASGI app serving an AssetPipeline; mount it at pipeline.url_prefix."""
+
+    def __init__(self, pipeline: AssetPipeline):
+        self.pipeline = pipeline
+
+    async def __call__(self, scope, receive, send):
+        request = Request(scope, receive)
+        if request.method not in ("GET", "HEAD"):
+            response = Response(status_code=405, headers={"Allow": "GET, HEAD"})
+        else:
+            asset = self.pipeline.files.get(scope["path"][len(scope.get("root_path", "")):].lstrip("/"))
+            if asset is None:
+                response = Response("Not Found", status_code=404, media_type="text/plain")
+            else:
+                response = asset.response(request, IMMUTABLE_CACHE_CONTROL)
+        await response(scope, receive, send)
+
+
+# ------------------ PRE-RENDERED PAGES ------------------
+
+class PageCache:
+    """Renders each template once per process and serves it with ETag/304 support."""
+
+    def __init__(self, templates):
+        self.templates = templates
+        self._pages: Dict[str, CachedBody] = {}
+        self._lock = threading.Lock()
+
+    def _render(self, request: Request, name: str) -> CachedBody:
+        with self._lock:
+            page = self._pages.get(name)
+            if page is None:
+                rendered = self.templates.TemplateResponse(request, name)
+                page = self._pages[name] = CachedBody(rendered.body, "text/html", time.time())
+            return page
+
+    def response(self, request: Request, name: str) -> Response:
+        page = self._pages.get(name) or self._render(request, name)
+        return page.response(request, PAGE_CACHE_CONTROL)
+
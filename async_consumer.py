@@ -0,0 +1,430 @@
+"""
+Asyncio ingest consumer: aiokafka + Motor (CONSUMER_MODE=async).
+
+The synchronous pipeline in consumer.py inserts one record at a time, so its
+throughput is one Mongo round trip per record; against a remote cluster the
+round trip dominates. Here the work is split into stages connected by
+bounded queues:
+
+    fetch    getmany() from Kafka, per partition       -> decode queue
+    decode   dedup, decode, validate; fold readings     -> write queue
+             into device state and route matrices
+    write    ASYNC_WRITERS tasks, each running one unordered insert_many
+
+so several bulk writes are in flight while the next records are fetched and
+decoded. A full queue blocks the stage in front of it, which bounds memory
+to roughly (queue sizes x ASYNC_WRITE_BATCH) records.
+
+Batches finish out of order. OffsetTracker only moves a partition's commit
+position past a batch once it and every batch fetched before it on that
+partition were written, so commits stay ordered and a crash re-delivers
+(rather than loses) whatever was in flight. Before partitions are revoked
+the pipeline drains: queued batches are written and committed, then device
+state is handed off as in the synchronous consumer.
+
+State is folded in the decode stage, in offset order, so a reading whose
+insert fails is still counted in device state (the synchronous consumer
+skips it). Failed inserts are counted and logged, not retried, as before.
+
+aiokafka and motor are optional; without them only the synchronous
+consumer is available.
+"""
+import asyncio
+import logging
+import os
+import signal
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from pymongo.errors import BulkWriteError, PyMongoError
+
+import consumer
+import metrics
+import mongo_clients
+import telemetry_fields
+from dedup import DedupIndex
+from device_state import MongoStateStore, PartitionedDeviceState
+from route_analytics import PartitionedRouteMatrix
+
+try:
+    from aiokafka import AIOKafkaConsumer
+    from aiokafka.abc import ConsumerRebalanceListener
+    from aiokafka.errors import KafkaError
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AIOKafkaConsumer = AsyncIOMotorClient = None
+    ConsumerRebalanceListener = object
+
+    class KafkaError(Exception):
+        pass
+
+logger = logging.getLogger(__name__)
+
+# Bulk writes in flight at once
+ASYNC_WRITERS = int(os.environ.get('ASYNC_WRITERS', 4))
+# Documents per insert_many
+ASYNC_WRITE_BATCH = int(os.environ.get('ASYNC_WRITE_BATCH', 500))
+# Batches waiting between stages
+ASYNC_QUEUE_BATCHES = int(os.environ.get('ASYNC_QUEUE_BATCHES', 8))
+
+WRITES_IN_FLIGHT = metrics.gauge(
+    "consumer_writes_in_flight", "Bulk inserts currently awaiting Mongo"
+)
+WRITE_SECONDS = metrics.histogram(
+    "consumer_write_batch_duration_seconds", "Time of one insert_many", ["outcome"]
+)
+QUEUE_BATCHES = metrics.gauge(
+    "consumer_stage_queue_batches", "Batches waiting in front of a pipeline stage", ["stage"]
+)
+
+
+def require_async_dependencies():
+    if AIOKafkaConsumer is None:
+        raise RuntimeError("CONSUMER_MODE=async needs aiokafka and motor (pip install aiokafka motor)")
+
+
+class WriteBatch:
+    """Consecutive records of one partition, written with one insert_many."""
+
+    def __init__(self, tp, records: list):
+        self.tp = tp
+        self.records = records
+        # Commit position once this batch is written
+        self.next_offset = records[-1].offset + 1
+        self.documents: List[dict] = []
+        # The record of each document, to forget() in the dedup index if its insert fails
+        self.sources: list = []
+        self.done = False
+
+
+class OffsetTracker:
+    """Per-partition FIFO of batches; the commit position only passes finished prefixes."""
+
+    def __init__(self):
+        self._pending: Dict[object, Deque[WriteBatch]] = {}
+        self._committable: Dict[object, int] = {}
+
+    def add(self, batch: WriteBatch):
+        self._pending.setdefault(batch.tp, deque()).append(batch)
+
+    def finish(self, batch: WriteBatch):
+        batch.done = True
+        pending = self._pending.get(batch.tp)
+        while pending and pending[0].done:
+            self._committable[batch.tp] = pending.popleft().next_offset
+
+    def take_committable(self) -> Dict[object, int]:
+        committable, self._committable = self._committable, {}
+        return committable
+
+    def in_flight(self) -> int:
+        return sum(len(pending) for pending in self._pending.values())
+
+    def forget(self, tps):
+        for tp in tps:
+            self._pending.pop(tp, None)
+            self._committable.pop(tp, None)
+
+
+class _RebalanceListener(ConsumerRebalanceListener):
+    def __init__(self, pipeline: "AsyncKafkaMongoPipeline"):
+        self.pipeline = pipeline
+
+    async def on_partitions_revoked(self, revoked):
+        await self.pipeline.hand_off_partitions(revoked)
+
+    async def on_partitions_assigned(self, assigned):
+        await self.pipeline.take_over_partitions(assigned)
+
+
+class AsyncKafkaMongoPipeline:
+    def __init__(self, kafka_message_consumer=None, target_collection=None, state_database=None,
+                 writers: int = ASYNC_WRITERS, write_batch: int = ASYNC_WRITE_BATCH,
+                 queue_batches: int = ASYNC_QUEUE_BATCHES):
+        """
+        Clients are created in start() unless given: an AIOKafkaConsumer-like
+        object, an async collection with insert_many, and a synchronous
+        pymongo database for state snapshots (saved in a worker thread).
+        """
+        self.kafka_message_consumer = kafka_message_consumer
+        self.target_collection = target_collection
+        self.state_database = state_database
+        self.writers = writers
+        self.write_batch = write_batch
+        self.decode_queue: asyncio.Queue = asyncio.Queue(queue_batches)
+        self.write_queue: asyncio.Queue = asyncio.Queue(queue_batches)
+        self.offsets = OffsetTracker()
+        self.dedup = DedupIndex()
+        self.device_state: Optional[PartitionedDeviceState] = None
+        self.route_matrix: Optional[PartitionedRouteMatrix] = None
+        self.stopping = asyncio.Event()
+        self._clients = []
+        self._tasks: List[asyncio.Task] = []
+
+    # ------------------ LIFECYCLE ------------------
+
+    async def start(self):
+        if self.target_collection is None or self.state_database is None:
+            require_async_dependencies()
+            # One connection per writer plus headroom for the lag/commit path
+            motor_client = mongo_clients.create_motor_client(
+                consumer.MONGO_CONNECTION_URI, "async_consumer", max_pool_size=self.writers + 2
+            )
+            # Checkpoints run in worker threads on a small synchronous pool
+            state_client = mongo_clients.create_client(consumer.MONGO_CONNECTION_URI, "consumer", max_pool_size=2)
+            self._clients += [motor_client, state_client]
+            self.target_collection = motor_client[consumer.MONGODB_DATABASE_NAME][consumer.MONGODB_COLLECTION_NAME]
+            self.state_database = state_client[consumer.MONGODB_DATABASE_NAME]
+        self.device_state = PartitionedDeviceState(
+            consumer.KAFKA_INPUT_TOPIC, MongoStateStore(self.state_database[consumer.MONGODB_STATE_COLLECTION_NAME], item_field="devices")
+        )
+        self.route_matrix = PartitionedRouteMatrix(
+            consumer.KAFKA_INPUT_TOPIC,
+            MongoStateStore(self.state_database[consumer.MONGODB_ROUTE_MATRIX_COLLECTION_NAME])
+        )
+        if self.kafka_message_consumer is None:
+            require_async_dependencies()
+            self.kafka_message_consumer = AIOKafkaConsumer(
+                bootstrap_servers=consumer.KAFKA_SERVER_ADDRESSES,
+                group_id='shipment_consumer_group',
+                auto_offset_reset='earliest',
+                enable_auto_commit=False,
+            )
+        self.kafka_message_consumer.subscribe([consumer.KAFKA_INPUT_TOPIC], listener=_RebalanceListener(self))
+        await self.kafka_message_consumer.start()
+        logger.info(f"Async consumer started: {self.writers} writers, batches of {self.write_batch}")
+
+    async def run(self):
+        """Run until stop() is called or a stage fails."""
+        await self.start()
+        self._tasks = [asyncio.create_task(self._fetch(), name="fetch"),
+                       asyncio.create_task(self._decode(), name="decode"),
+                       asyncio.create_task(self._housekeeping(), name="housekeeping")]
+        self._tasks += [asyncio.create_task(self._write(), name=f"write-{i}") for i in range(self.writers)]
+        stop_waiter = asyncio.create_task(self.stopping.wait())
+        try:
+            done, _ = await asyncio.wait([stop_waiter, *self._tasks], return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is not stop_waiter and task.exception() is not None:
+                    raise task.exception()
+        finally:
+            stop_waiter.cancel()
+            await self.close()
+
+    def stop(self):
+        self.stopping.set()
+
+    async def close(self):
+        # Stop fetching, finish what was fetched, then commit and snapshot
+        for task in self._tasks:
+            if task.get_name() == "fetch":
+                task.cancel()
+        try:
+            await asyncio.wait_for(self.drain(), timeout=30)
+        except asyncio.TimeoutError:
+            logger.error("Timed out draining the pipeline; uncommitted records will be re-delivered")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self._checkpoint()
+        try:
+            await self.kafka_message_consumer.stop()
+        except Exception as kafka_close_error:
+            logger.error(f"Error closing Kafka consumer: {kafka_close_error}")
+        for client in self._clients:
+            client.close()
+        logger.info("Async consumer stopped")
+
+    async def drain(self):
+        """Wait until every fetched batch is written, then commit."""
+        await self.decode_queue.join()
+        await self.write_queue.join()
+        await self._commit()
+
+    # ------------------ STAGES ------------------
+
+    async def _fetch(self):
+        while True:
+            batches = await self.kafka_message_consumer.getmany(
+                timeout_ms=consumer.POLL_TIMEOUT_MS, max_records=consumer.POLL_MAX_RECORDS
+            )
+            record_count = sum(len(records) for records in batches.values())
+            if record_count:
+                consumer.BATCH_SIZE.observe(record_count)
+            for tp, records in batches.items():
+                for start in range(0, len(records), self.write_batch):
+                    batch = WriteBatch(tp, records[start:start + self.write_batch])
+                    self.offsets.add(batch)
+                    await self.decode_queue.put(batch)
+                    QUEUE_BATCHES.set(self.decode_queue.qsize(), stage="decode")
+
+    async def _decode(self):
+        while True:
+            batch = await self.decode_queue.get()
+            try:
+                for record in batch.records:
+                    reading = self._accept(record)
+                    if reading is not None:
+                        batch.documents.append(telemetry_fields.to_stored(reading))
+                        batch.sources.append(record)
+                batch.records = None
+                if batch.documents:
+                    await self.write_queue.put(batch)
+                    QUEUE_BATCHES.set(self.write_queue.qsize(), stage="write")
+                else:
+                    self.offsets.finish(batch)
+            finally:
+                self.decode_queue.task_done()
+
+    def _accept(self, record) -> Optional[dict]:
+        """The reading to store, with state updated; None if the record is skipped."""
+        if not record.value:
+            consumer.MESSAGES_TOTAL.inc(outcome="invalid")
+            return None
+        if self.dedup.seen(record.key, record.timestamp, record.value):
+            consumer.MESSAGES_TOTAL.inc(outcome="duplicate")
+            return None
+        reading = consumer.KafkaMongoDataPipeline._safely_decode_message(record)
+        if not isinstance(reading, dict):
+            consumer.MESSAGES_TOTAL.inc(outcome="invalid")
+            self.dedup.forget(record.key, record.timestamp, record.value)
+            return None
+        event_time = record.timestamp / 1000.0
+        self.device_state.apply(record.partition, record.offset, reading, event_time)
+        self.route_matrix.apply(record.partition, record.offset, reading, event_time)
+        return reading
+
+    async def _write(self):
+        while True:
+            batch = await self.write_queue.get()
+            WRITES_IN_FLIGHT.inc()
+            started = time.perf_counter()
+            try:
+                failed = await self._insert(batch)
+                consumer.MESSAGES_TOTAL.inc(len(batch.documents) - len(failed), outcome="stored")
+                if failed:
+                    consumer.MESSAGES_TOTAL.inc(len(failed), outcome="failed")
+                for index in failed:
+                    # Not written, so a redelivery must not be dropped as a duplicate
+                    record = batch.sources[index]
+                    self.dedup.forget(record.key, record.timestamp, record.value)
+                WRITE_SECONDS.observe(time.perf_counter() - started, outcome="error" if failed else "ok")
+                batch.documents = batch.sources = None
+                self.offsets.finish(batch)
+            finally:
+                WRITES_IN_FLIGHT.dec()
+                self.write_queue.task_done()
+
+    async def _insert(self, batch: WriteBatch) -> List[int]:
+        """Indexes of the documents that were not written."""
+        try:
+            await self.target_collection.insert_many(batch.documents, ordered=False)
+            return []
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            logger.error(f"Partition {batch.tp.partition}: {len(errors)} inserts failed: {errors[:1]}")
+            return [error["index"] for error in errors]
+        except PyMongoError as mongo_operation_error:
+            logger.error(f"MongoDB error during insertion: {mongo_operation_error}")
+            return list(range(len(batch.documents)))
+
+    async def _housekeeping(self):
+        last_checkpoint = last_lag_refresh = time.monotonic()
+        while True:
+            await asyncio.sleep(consumer.COMMIT_INTERVAL_SECONDS)
+            await self._commit()
+            now = time.monotonic()
+            if now - last_checkpoint >= consumer.STATE_CHECKPOINT_SECONDS:
+                await self._checkpoint()
+                last_checkpoint = now
+            if now - last_lag_refresh >= consumer.LAG_REFRESH_SECONDS:
+                await self._refresh_lag_metrics()
+                last_lag_refresh = now
+
+    # ------------------ OFFSETS, STATE, REBALANCES ------------------
+
+    async def _commit(self):
+        offsets = self.offsets.take_committable()
+        if not offsets:
+            return
+        started = time.perf_counter()
+        try:
+            await self.kafka_message_consumer.commit(offsets)
+            consumer.KAFKA_COMMIT_SECONDS.observe(time.perf_counter() - started, outcome="ok")
+        except KafkaError as commit_error:
+            consumer.KAFKA_COMMIT_SECONDS.observe(time.perf_counter() - started, outcome="error")
+            logger.warning(f"Offset commit failed: {commit_error}")
+
+    async def _checkpoint(self):
+        # Serialized here, between decode steps; only the writes go to a thread
+        snapshots = [(self.device_state.store, self.device_state.snapshots()),
+                     (self.route_matrix.store, self.route_matrix.snapshots())]
+        try:
+            await asyncio.to_thread(_save_snapshots, consumer.KAFKA_INPUT_TOPIC, snapshots)
+        except PyMongoError as mongo_operation_error:
+            logger.error(f"Device state checkpoint failed: {mongo_operation_error}")
+
+    async def _refresh_lag_metrics(self):
+        try:
+            assigned = list(self.kafka_message_consumer.assignment())
+            if not assigned:
+                return
+            end_offsets = await self.kafka_message_consumer.end_offsets(assigned)
+            for tp in assigned:
+                lag = end_offsets[tp] - await self.kafka_message_consumer.position(tp)
+                consumer.CONSUMER_LAG.set(max(lag, 0), partition=tp.partition)
+        except KafkaError as lag_error:
+            logger.debug(f"Could not refresh consumer lag: {lag_error}")
+
+    async def hand_off_partitions(self, revoked):
+        """Write and commit everything fetched, then snapshot the revoked partitions."""
+        tps = [tp for tp in revoked if tp.topic == consumer.KAFKA_INPUT_TOPIC]
+        await self.drain()
+        self.offsets.forget(tps)
+        partitions = [tp.partition for tp in tps]
+        try:
+            await asyncio.to_thread(self.device_state.revoke, partitions)
+            await asyncio.to_thread(self.route_matrix.revoke, partitions)
+            logger.info(f"Handed off device state for partitions {partitions}")
+        except PyMongoError as mongo_operation_error:
+            logger.error(f"Failed to snapshot device state for partitions {partitions}: {mongo_operation_error}")
+
+    async def take_over_partitions(self, assigned):
+        partitions = [tp.partition for tp in assigned if tp.topic == consumer.KAFKA_INPUT_TOPIC]
+        try:
+            await asyncio.to_thread(self.device_state.assign, partitions)
+            await asyncio.to_thread(self.route_matrix.assign, partitions)
+            logger.info(f"Restored device state for partitions {partitions}")
+        except PyMongoError as mongo_operation_error:
+            logger.error(f"Failed to restore device state for partitions {partitions}: {mongo_operation_error}")
+
+
+def _save_snapshots(topic: str, snapshots):
+    for store, partition_snapshots in snapshots:
+        for snapshot in partition_snapshots:
+            store.save(topic, snapshot)
+
+
+async def _run_until_signalled():
+    pipeline = AsyncKafkaMongoPipeline()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, pipeline.stop)
+    await pipeline.run()
+    return pipeline.stopping.is_set()
+
+
+def run():
+    """Entry point used by consumer.py when CONSUMER_MODE=async; restarts after failures."""
+    require_async_dependencies()
+    while True:
+        try:
+            if asyncio.run(_run_until_signalled()):
+                logger.info("Shutdown requested. Exiting...")
+                return
+        except Exception as pipeline_failure_error:
+            logger.error(f"Async consumer pipeline failed: {pipeline_failure_error}")
+        logger.info("Restarting consumer in 10 seconds...")
+        time.sleep(10)
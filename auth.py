@@ -3,16 +3,19 @@ from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from fastapi import Depends, HTTPException, status, WebSocket
 from fastapi.security import OAuth2PasswordBearer
-from pymongo import MongoClient
 from typing import Optional
 from config import settings
 from database import db
+from profiling import phase
 from passlib.context import CryptContext
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# What route handlers get as the current user; never the password hash
+CURRENT_USER_PROJECTION = {"name": 1, "email": 1}
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -29,20 +32,27 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
+    with phase("auth"):
+        try:
+            payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
+            email: str = payload.get("sub")
+            if email is None:
+                raise credentials_exception
+        except JWTError:
             raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    
-    users_collection = db.get_collection("users")
-    user = users_collection.find_one({"email": email})
+
+        users_collection = db.get_collection("users")
+        user = users_collection.find_one({"email": email}, CURRENT_USER_PROJECTION)
     if user is None:
         raise credentials_exception
     return user
 
+async def get_admin_user(user: dict = Depends(get_current_user)):
+    """Allows only the accounts listed in ADMIN_EMAILS."""
+    if user["email"] not in settings.admin_emails:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return user
+
 async def get_websocket_user(websocket: WebSocket, token: str) -> Optional[dict]:
     try:
         payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
@@ -52,7 +62,7 @@ async def get_websocket_user(websocket: WebSocket, token: str) -> Optional[dict]
             return None
             
         users_collection = db.get_collection("users")
-        user = users_collection.find_one({"email": email})
+        user = users_collection.find_one({"email": email}, CURRENT_USER_PROJECTION)
         if user is None:
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
             return None
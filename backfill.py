@@ -0,0 +1,307 @@
+"""
+Replay device readings from Kafka into Mongo, e.g. after a consumer bug.
+
+    python backfill.py --from-time 2026-10-01T00:00 --to-time 2026-10-02T00:00
+    python backfill.py --partitions 0 2 --from-offset 1200 --to-offset 5000
+    python backfill.py --from-time 2026-10-01 --target-collection device_stream_data_rebuild --rate 20000
+
+Each partition is replayed by its own thread with its own consumer, which
+is assigned the partition directly (no group), so the live consumer's
+committed offsets and assignments are never touched. Records are decoded
+exactly as the live pipeline does, redelivered copies are dropped as in the
+consumer (see dedup.py), and the rest are written with unordered insert_many
+batches. A token bucket shared by all threads caps the total write rate,
+so a backfill can run next to live ingest without starving it.
+
+Replayed documents get a deterministic _id (replay_id()): the Kafka record
+timestamp in the ObjectId's time bytes, then partition and offset. They
+therefore sort by event time wherever readings are ordered by _id (latest
+first, since-cursors, the live feed, archiving), rather than as the newest
+data, and replaying a record twice collides on _id and is skipped. Re-running
+a backfill over the same window is idempotent.
+
+Documents the live consumer inserted carry an ordinary ObjectId, stamped
+when they were inserted, and are not matched by a replay. Either replay into
+an empty collection (--target-collection) and swap it in, or pass
+--clear-range to delete the target's documents in the time window first.
+The window is matched on _id time: event time for replayed documents,
+insert time (event time plus consumer lag) for live ones.
+
+Only the readings are replayed. The consumer's rollups, device_state and
+route_matrix, are not rebuilt from them.
+"""
+import argparse
+import logging
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from bson import ObjectId
+from kafka import KafkaConsumer, TopicPartition
+from pymongo.errors import BulkWriteError
+
+import consumer
+import metrics
+import mongo_clients
+import telemetry_fields
+from logging_setup import configure_logging
+from dedup import DedupIndex
+from rate_limit import MemoryBucketStore, RateLimiter
+
+logger = logging.getLogger(__name__)
+
+POLL_TIMEOUT_MS = 1000
+# Polls in a row without records before a partition is given up on
+MAX_EMPTY_POLLS = 10
+
+# Mongo's duplicate key error code
+DUPLICATE_KEY = 11000
+# ObjectId layout of replay_id(): seconds, partition, then the 6-byte offset
+_REPLAY_ID = struct.Struct(">IH")
+
+BACKFILL_RECORDS_TOTAL = metrics.counter(
+    "backfill_records_total", "Records handled by the backfill tool", ["partition", "outcome"]
+)
+BACKFILL_WRITE_SECONDS = metrics.histogram(
+    "backfill_insert_duration_seconds", "Time to insert one batch"
+)
+
+
+class ReplayRange(NamedTuple):
+    partition: int
+    start: int  # first offset replayed
+    end: int  # first offset not replayed
+
+
+def _millis(value: datetime) -> int:
+    return int(value.timestamp() * 1000)
+
+
+def parse_time(value: str) -> datetime:
+    """ISO date or datetime; naive values are UTC."""
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def resolve_ranges(kafka, topic: str, partitions: Optional[List[int]] = None,
+                   from_time: Optional[datetime] = None, to_time: Optional[datetime] = None,
+                   from_offset: Optional[int] = None, to_offset: Optional[int] = None) -> List[ReplayRange]:
+    """Offset range to replay per partition, clamped to what the log still holds."""
+    available = sorted(kafka.partitions_for_topic(topic) or ())
+    if not available:
+        raise RuntimeError(f"Topic '{topic}' not found")
+    tps = [TopicPartition(topic, p) for p in (partitions if partitions is not None else available)]
+    beginning = kafka.beginning_offsets(tps)
+    end = kafka.end_offsets(tps)
+
+    def by_time(when: datetime, default: Dict[TopicPartition, int]) -> Dict[TopicPartition, int]:
+        found = kafka.offsets_for_times({tp: _millis(when) for tp in tps})
+        # None: no record at or after that time in the partition
+        return {tp: found[tp].offset if found.get(tp) else default[tp] for tp in tps}
+
+    starts = by_time(from_time, beginning) if from_time else {tp: from_offset or 0 for tp in tps}
+    ends = by_time(to_time, end) if to_time else {tp: end[tp] if to_offset is None else to_offset for tp in tps}
+
+    ranges = []
+    for tp in tps:
+        start = max(starts[tp], beginning[tp])
+        stop = min(ends[tp], end[tp])
+        if start < stop:
+            ranges.append(ReplayRange(tp.partition, start, stop))
+    return ranges
+
+
+class WriteThrottle:
+    """Caps inserts per second across every replay thread."""
+
+    def __init__(self, rate: float):
+        self.limiter = RateLimiter(MemoryBucketStore(), f"{rate}/second") if rate else None
+
+    def acquire(self, count: int):
+        if self.limiter is None:
+            return
+        while True:
+            wait = self.limiter.hit("backfill", cost=count)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+def replay_id(record) -> ObjectId:
+    """_id of a replayed record: its Kafka timestamp (seconds), partition and offset."""
+    return ObjectId(_REPLAY_ID.pack(record.timestamp // 1000, record.partition) + record.offset.to_bytes(6, "big"))
+
+
+def insert_batch(collection, documents: List[dict], partition: int) -> int:
+    """Unordered bulk insert; returns documents written. Documents already there are skipped."""
+    try:
+        with BACKFILL_WRITE_SECONDS.time():
+            inserted = len(collection.insert_many(documents, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        inserted = e.details.get("nInserted", 0)
+        errors = e.details.get("writeErrors", [])
+        failed = [error for error in errors if error.get("code") != DUPLICATE_KEY]
+        BACKFILL_RECORDS_TOTAL.inc(len(errors) - len(failed), partition=partition, outcome="existing")
+        if failed:
+            BACKFILL_RECORDS_TOTAL.inc(len(failed), partition=partition, outcome="failed")
+            logger.error(f"Partition {partition}: {len(failed)} inserts failed: {failed[:1]}")
+    BACKFILL_RECORDS_TOTAL.inc(inserted, partition=partition, outcome="inserted")
+    return inserted
+
+
+def replay_partition(replay: ReplayRange, topic: str, make_consumer: Callable[[], object], collection,
+                     throttle: WriteThrottle, batch_size: int, dry_run: bool = False) -> int:
+    """Replay one partition's range; returns the number of documents written."""
+    kafka = make_consumer()
+    tp = TopicPartition(topic, replay.partition)
+    kafka.assign([tp])
+    kafka.seek(tp, replay.start)
+    written, empty_polls, position = 0, 0, replay.start
+    documents: List[dict] = []
+    dedup = DedupIndex()
+    try:
+        while position < replay.end:
+            batches = kafka.poll(timeout_ms=POLL_TIMEOUT_MS, max_records=batch_size)
+            records = batches.get(tp, [])
+            if not records:
+                empty_polls += 1
+                if empty_polls >= MAX_EMPTY_POLLS:
+                    logger.warning(f"Partition {replay.partition}: no records at offset {position}; stopping early")
+                    break
+                continue
+            empty_polls = 0
+            for record in records:
+                if record.offset >= replay.end:
+                    break
+                position = record.offset + 1
+                if not record.value or dedup.seen(record.key, record.timestamp, record.value):
+                    BACKFILL_RECORDS_TOTAL.inc(partition=replay.partition,
+                                               outcome="duplicate" if record.value else "invalid")
+                    continue
+                reading = consumer.KafkaMongoDataPipeline._safely_decode_message(record)
+                if not isinstance(reading, dict):
+                    BACKFILL_RECORDS_TOTAL.inc(partition=replay.partition, outcome="invalid")
+                    continue
+                documents.append({"_id": replay_id(record), **telemetry_fields.to_stored(reading)})
+                if len(documents) >= batch_size:
+                    written += _flush(collection, documents, replay.partition, throttle, dry_run)
+                    documents = []
+            if records[-1].offset >= replay.end - 1:
+                position = replay.end
+        if documents:
+            written += _flush(collection, documents, replay.partition, throttle, dry_run)
+    finally:
+        kafka.close()
+    logger.info(f"Partition {replay.partition}: replayed offsets {replay.start}-{position - 1}, wrote {written}")
+    return written
+
+
+def _flush(collection, documents: List[dict], partition: int, throttle: WriteThrottle, dry_run: bool) -> int:
+    throttle.acquire(len(documents))
+    if dry_run:
+        BACKFILL_RECORDS_TOTAL.inc(len(documents), partition=partition, outcome="dry_run")
+        return len(documents)
+    return insert_batch(collection, documents, partition)
+
+
+def clear_range(collection, from_time: datetime, to_time: Optional[datetime]) -> int:
+    """Delete documents whose _id time is in [from_time, to_time) before replaying that window."""
+    query = {"$gte": ObjectId.from_datetime(from_time)}
+    if to_time is not None:
+        query["$lt"] = ObjectId.from_datetime(to_time)
+    return collection.delete_many({"_id": query}).deleted_count
+
+
+def run_backfill(ranges: List[ReplayRange], topic: str, make_consumer, collection, rate: float,
+                 batch_size: int, workers: int, dry_run: bool = False) -> int:
+    throttle = WriteThrottle(rate)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backfill") as pool:
+        futures = [
+            pool.submit(replay_partition, replay, topic, make_consumer, collection, throttle, batch_size, dry_run)
+            for replay in ranges
+        ]
+        return sum(future.result() for future in futures)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay device readings from Kafka into Mongo",
+        epilog="Only readings are written: the device_state and route_matrix rollups are not rebuilt.",
+    )
+    parser.add_argument("--topic", default=consumer.KAFKA_INPUT_TOPIC)
+    parser.add_argument("--partitions", type=int, nargs="+", help="Partitions to replay (default: all)")
+    window = parser.add_argument_group("replay window (time or offsets)")
+    window.add_argument("--from-time", type=parse_time, help="ISO time, inclusive")
+    window.add_argument("--to-time", type=parse_time, help="ISO time, exclusive (default: log end at start)")
+    window.add_argument("--from-offset", type=int, help="Same start offset on every partition")
+    window.add_argument("--to-offset", type=int, help="Same end offset (exclusive) on every partition")
+    parser.add_argument("--target-collection", default=consumer.MONGODB_COLLECTION_NAME)
+    parser.add_argument("--rate", type=float, default=float(os.environ.get("BACKFILL_RATE", 5000)),
+                        help="Maximum inserts per second across all partitions (0: unlimited)")
+    parser.add_argument("--batch", type=int, default=1000, help="Documents per insert_many")
+    parser.add_argument("--workers", type=int, default=0, help="Parallel partitions (default: one per partition)")
+    parser.add_argument("--clear-range", action="store_true",
+                        help="Delete target documents whose _id time is in the window first (needs --from-time); "
+                             "replayed documents are matched by event time, live ones by insert time")
+    parser.add_argument("--dry-run", action="store_true", help="Read and decode, but do not write")
+    parser.add_argument("--metrics-port", type=int, default=int(os.environ.get("METRICS_PORT", 0)))
+    options = parser.parse_args(argv)
+
+    if options.from_time and options.from_offset is not None:
+        parser.error("use either --from-time or --from-offset")
+    if options.to_time and options.to_offset is not None:
+        parser.error("use either --to-time or --to-offset")
+    if options.clear_range and not options.from_time:
+        parser.error("--clear-range needs --from-time")
+    if options.rate:
+        # A batch can never cost more tokens than the bucket holds
+        options.batch = max(1, min(options.batch, int(options.rate)))
+
+    configure_logging("backfill")
+    metrics.start_http_server(options.metrics_port)
+
+    def make_consumer():
+        return KafkaConsumer(
+            bootstrap_servers=consumer.KAFKA_SERVER_ADDRESSES,
+            group_id=None,
+            enable_auto_commit=False,
+            max_poll_records=options.batch,
+        )
+
+    metadata = make_consumer()
+    try:
+        ranges = resolve_ranges(
+            metadata, options.topic, options.partitions,
+            options.from_time, options.to_time, options.from_offset, options.to_offset
+        )
+    finally:
+        metadata.close()
+    if not ranges:
+        logger.info("Nothing to replay in that window")
+        return
+    total_records = sum(r.end - r.start for r in ranges)
+    logger.info(f"Replaying {total_records} records from {len(ranges)} partitions: {ranges}")
+
+    workers = options.workers or len(ranges)
+    # One connection per replay thread, plus one for --clear-range
+    client = mongo_clients.create_client(consumer.MONGO_CONNECTION_URI, "backfill", max_pool_size=workers + 2)
+    collection = client[consumer.MONGODB_DATABASE_NAME][options.target_collection]
+    try:
+        if options.clear_range and not options.dry_run:
+            deleted = clear_range(collection, options.from_time, options.to_time)
+            logger.info(f"Cleared {deleted} documents from {options.target_collection}")
+        started = time.monotonic()
+        written = run_backfill(
+            ranges, options.topic, make_consumer, collection, options.rate, options.batch, workers, options.dry_run
+        )
+        elapsed = time.monotonic() - started
+        logger.info(f"Backfill done: {written} documents in {elapsed:.1f}s ({written / max(elapsed, 1e-9):.0f}/s)")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""
+Pub/sub backplane for WebSocket fan-out across web workers.
+
+Every uvicorn worker (and every replica) holds only its own WebSocket
+connections. Broadcasts and per-user messages are published to a channel on
+the backplane, and each worker delivers them to the sockets it holds.
+
+    InProcessBackplane  single worker; publish() calls the local handlers.
+    BrokerBackplane     any number of workers and nodes; talks to the small
+                        TCP broker in this module (python backplane.py).
+
+The broker protocol is newline-delimited JSON:
+
+    {"op": "sub",   "channel": "ws:broadcast"}
+    {"op": "unsub", "channel": "ws:broadcast"}
+    {"op": "pub",   "channel": "ws:broadcast", "data": "<text>"}
+    {"op": "msg",   "channel": "ws:broadcast", "data": "<text>"}   broker -> subscriber
+
+Delivery is at-most-once: messages published while a worker is disconnected
+from the broker are dropped and counted, as are messages to subscribers that
+fall too far behind.
+"""
+import argparse
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+import codec
+import metrics
+from logging_setup import configure_logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS = "localhost:7070"
+RECONNECT_MIN_SECONDS = 0.5
+RECONNECT_MAX_SECONDS = 5.0
+# A subscriber with more than this many unsent bytes is disconnected
+MAX_SUBSCRIBER_BUFFER_BYTES = 4 * 1024 * 1024
+# Longest frame the broker or a client will read
+MAX_FRAME_BYTES = 1024 * 1024
+
+BACKPLANE_MESSAGES_TOTAL = metrics.counter(
+    "backplane_messages_total", "Backplane messages by outcome", ["outcome"]
+)
+
+# Called with (channel, data)
+Handler = Callable[[str, str], Awaitable[None]]
+
+
+class Backplane:
+    """Channel subscriptions shared by every backplane implementation."""
+
+    def __init__(self):
+        self._handlers: Dict[str, List[Handler]] = {}
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, channel: str, data: str):
+        raise NotImplementedError
+
+    async def subscribe(self, channel: str, handler: Handler):
+        handlers = self._handlers.setdefault(channel, [])
+        handlers.append(handler)
+        if len(handlers) == 1:
+            await self._channel_added(channel)
+
+    async def unsubscribe(self, channel: str, handler: Handler):
+        handlers = self._handlers.get(channel)
+        if not handlers or handler not in handlers:
+            return
+        handlers.remove(handler)
+        if not handlers:
+            del self._handlers[channel]
+            await self._channel_removed(channel)
+
+    async def _channel_added(self, channel: str):
+        pass
+
+    async def _channel_removed(self, channel: str):
+        pass
+
+    async def _dispatch(self, channel: str, data: str):
+        for handler in list(self._handlers.get(channel, ())):
+            try:
+                await handler(channel, data)
+                BACKPLANE_MESSAGES_TOTAL.inc(outcome="delivered")
+            except Exception:
+                logger.exception(f"Backplane handler failed for channel {channel}")
+
+
+class InProcessBackplane(Backplane):
+    """Single-process backplane: publishing delivers straight to local handlers."""
+
+    async def publish(self, channel: str, data: str):
+        BACKPLANE_MESSAGES_TOTAL.inc(outcome="published")
+        await self._dispatch(channel, data)
+
+
+# ------------------ BROKER CLIENT ------------------
+
+class BrokerBackplane(Backplane):
+    """
+    Backplane client for the TCP broker. Reconnects with backoff and
+    re-subscribes every channel after a reconnect. A worker's own
+    publications come back to it through its subscriptions.
+    """
+
+    def __init__(self, address: str = DEFAULT_ADDRESS):
+        super().__init__()
+        self.host, self.port = parse_address(address)
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+        self._connected = asyncio.Event()
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._close_writer()
+
+    async def wait_connected(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def publish(self, channel: str, data: str):
+        if self._send({"op": "pub", "channel": channel, "data": data}):
+            BACKPLANE_MESSAGES_TOTAL.inc(outcome="published")
+        else:
+            BACKPLANE_MESSAGES_TOTAL.inc(outcome="dropped")
+
+    async def _channel_added(self, channel: str):
+        self._send({"op": "sub", "channel": channel})
+
+    async def _channel_removed(self, channel: str):
+        self._send({"op": "unsub", "channel": channel})
+
+    def _send(self, frame: dict) -> bool:
+        writer = self._writer
+        if writer is None or writer.is_closing():
+            return False
+        writer.write(codec.dumps(frame) + b"\n")
+        return True
+
+    def _close_writer(self):
+        self._connected.clear()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def _run(self):
+        delay = RECONNECT_MIN_SECONDS
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port, limit=MAX_FRAME_BYTES)
+            except OSError as e:
+                logger.warning(f"Backplane broker {self.host}:{self.port} unavailable ({e}); retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_SECONDS)
+                continue
+
+            self._writer = writer
+            for channel in self._handlers:
+                self._send({"op": "sub", "channel": channel})
+            self._connected.set()
+            delay = RECONNECT_MIN_SECONDS
+            logger.info(f"Connected to backplane broker {self.host}:{self.port}")
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    frame = codec.loads(line)
+                    if frame.get("op") == "msg":
+                        await self._dispatch(frame["channel"], frame["data"])
+            except (OSError, ValueError) as e:
+                logger.warning(f"Backplane connection lost: {e}")
+            finally:
+                self._close_writer()
+
+
+# ------------------ BROKER SERVER ------------------
+
+class Broker:
+    """Minimal fan-out broker: forwards each publication to the channel's subscribers."""
+
+    def __init__(self):
+        self.subscribers: Dict[str, Set[asyncio.StreamWriter]] = {}
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info("peername")
+        channels: Set[str] = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                frame = codec.loads(line)
+                op, channel = frame.get("op"), frame.get("channel")
+                if op == "sub":
+                    self.subscribers.setdefault(channel, set()).add(writer)
+                    channels.add(channel)
+                elif op == "unsub":
+                    self._remove(channel, writer)
+                    channels.discard(channel)
+                elif op == "pub":
+                    self.publish(channel, frame.get("data"))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Backplane client {peer} failed: {e}")
+        finally:
+            for channel in channels:
+                self._remove(channel, writer)
+            writer.close()
+
+    def publish(self, channel: str, data: str):
+        frame = codec.dumps({"op": "msg", "channel": channel, "data": data}) + b"\n"
+        for subscriber in list(self.subscribers.get(channel, ())):
+            if subscriber.transport.get_write_buffer_size() > MAX_SUBSCRIBER_BUFFER_BYTES:
+                # Never let one slow worker grow the broker's memory without bound
+                logger.warning("Disconnecting slow backplane subscriber")
+                BACKPLANE_MESSAGES_TOTAL.inc(outcome="dropped")
+                subscriber.close()
+                continue
+            subscriber.write(frame)
+
+    def _remove(self, channel: str, writer: asyncio.StreamWriter):
+        subscribers = self.subscribers.get(channel)
+        if subscribers is not None:
+            subscribers.discard(writer)
+            if not subscribers:
+                del self.subscribers[channel]
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle_client, host, port, limit=MAX_FRAME_BYTES)
+        logger.info(f"Backplane broker listening on {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+
+def parse_address(address: str):
+    host, _, port = address.rpartition(":")
+    return host or "localhost", int(port)
+
+
+def create_backplane(kind: str, address: str = DEFAULT_ADDRESS) -> Backplane:
+    """'memory' for a single worker, 'broker' to share fan-out across workers and nodes."""
+    if kind == "memory":
+        return InProcessBackplane()
+    if kind == "broker":
+        return BrokerBackplane(address)
+    raise ValueError(f"Unknown backplane '{kind}' (expected 'memory' or 'broker')")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="WebSocket fan-out backplane broker")
+    parser.add_argument("--host", default=os.environ.get("BACKPLANE_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("BACKPLANE_PORT", 7070)))
+    parser.add_argument("--metrics-port", type=int, default=int(os.environ.get("METRICS_PORT", 9103)))
+    options = parser.parse_args(argv)
+    configure_logging("backplane")
+    metrics.start_http_server(options.metrics_port)
+    try:
+        asyncio.run(Broker().serve(options.host, options.port))
+    except KeyboardInterrupt:
+        print("\nBackplane broker shutting down...")
+
+
+if __name__ == "__main__":
+    main()
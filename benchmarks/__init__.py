@@ -0,0 +1 @@
+"""Benchmarks for scm-lite. Run modules from the repo root, e.g. `python -m benchmarks.codec_bench`."""
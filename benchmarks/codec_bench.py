@@ -0,0 +1,133 @@
+"""
+Serialization cost per Kafka message and per API response, before and after
+the codec change.
+
+"before" is what the services did previously: stdlib json for messages, and
+for responses a Python loop stringifying `_id` followed by FastAPI's
+jsonable_encoder and JSONResponse. "after" is codec.dumps/loads and
+FastJSONResponse returned directly from the handler.
+
+Usage:
+    python -m benchmarks.codec_bench [--number 20000] [--output results.json]
+"""
+import argparse
+import json
+import random
+import time
+import timeit
+from datetime import datetime
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+
+import codec
+
+ROUTES = ['Newyork,USA', 'Chennai, India', 'Bengaluru, India', 'London,UK']
+
+
+def make_reading(rng):
+    """A device reading shaped like the ones server.py emits."""
+    route_from, route_to = rng.sample(ROUTES, 2)
+    return {
+        "Battery_Level": round(rng.uniform(2.00, 5.00), 2),
+        "Device_ID": rng.randint(1150, 1158),
+        "First_Sensor_temperature": round(rng.uniform(10, 40.0), 1),
+        "Route_From": route_from,
+        "Route_To": route_to,
+    }
+
+
+def make_shipment(rng, index):
+    """A shipment document shaped like the ones /shipment/new stores."""
+    return {
+        "_id": ObjectId(),
+        "shipmentNumber": f"SHP-{index:06d}",
+        "route": rng.choice(ROUTES),
+        "device": str(rng.randint(1150, 1158)),
+        "poNumber": f"PO-{rng.randint(1000, 9999)}",
+        "containerNumber": f"CN-{rng.randint(1000, 9999)}",
+        "goodsType": rng.choice(["Pharma", "Food", "Electronics"]),
+        "deliveryDate": "2025-12-01",
+        "description": "Temperature controlled consignment",
+        "status": "In Transit",
+        "created": "2025-11-20",
+        "ndcNumber": f"NDC-{rng.randint(1000, 9999)}",
+        "serialNumber": f"SN-{rng.randint(1000, 9999)}",
+        "deliveryNumber": f"DN-{rng.randint(1000, 9999)}",
+        "batchId": f"B-{rng.randint(100, 999)}",
+        "timestamp": int(time.time()),
+        "creator_email": "user@example.com",
+        "createdOnDisplay": datetime.now().strftime('%Y-%m-%d %H:%M'),
+    }
+
+
+def respond_before(docs):
+    for doc in docs:
+        doc["_id"] = str(doc["_id"])
+    return JSONResponse(jsonable_encoder(docs)).body
+
+
+def respond_after(docs):
+    return codec.FastJSONResponse(docs).body
+
+
+def per_call_us(func, number):
+    """Best-of-3 cost of one call in microseconds."""
+    best = min(timeit.repeat(func, number=number, repeat=3))
+    return best / number * 1e6
+
+
+def run(number):
+    rng = random.Random(42)
+    reading = make_reading(rng)
+    reading_bytes = json.dumps(reading).encode("utf-8")
+    device_docs = [dict(make_reading(rng), _id=ObjectId()) for _ in range(15)]
+    shipment_docs = [make_shipment(rng, i) for i in range(50)]
+
+    # Fresh copies for every call so the "before" loop does its full work
+    results = {
+        "backend": codec.BACKEND,
+        "message_serialize_us": {
+            "before": per_call_us(lambda: json.dumps(reading).encode("utf-8"), number),
+            "after": per_call_us(lambda: codec.dumps(reading), number),
+        },
+        "message_parse_us": {
+            "before": per_call_us(lambda: json.loads(reading_bytes), number),
+            "after": per_call_us(lambda: codec.loads(reading_bytes), number),
+        },
+        "device_data_response_us": {
+            "before": per_call_us(lambda: respond_before([dict(d) for d in device_docs]), number // 10),
+            "after": per_call_us(lambda: respond_after([dict(d) for d in device_docs]), number // 10),
+        },
+        "shipment_my_response_us": {
+            "before": per_call_us(lambda: respond_before([dict(d) for d in shipment_docs]), number // 100),
+            "after": per_call_us(lambda: respond_after([dict(d) for d in shipment_docs]), number // 100),
+        },
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=20000, help="Calls per message measurement")
+    parser.add_argument("--output", help="Optional path to write the results as JSON")
+    args = parser.parse_args()
+
+    results = run(args.number)
+
+    print(f"codec backend: {results['backend']}")
+    print(f"{'measurement':<28}{'before (us)':>14}{'after (us)':>14}{'speedup':>10}")
+    for name, value in results.items():
+        if name == "backend":
+            continue
+        speedup = value["before"] / value["after"] if value["after"] else float("inf")
+        print(f"{name:<28}{value['before']:>14.2f}{value['after']:>14.2f}{speedup:>9.1f}x")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+In-memory stand-in for a Kafka broker, with producer and consumer objects
+exposing the subset of the kafka-python API that producer.py and consumer.py
+use. Good enough to drive the real pipeline code in a single process.
+"""
+import threading
+import time
+from collections import namedtuple
+
+from kafka import TopicPartition
+from kafka.partitioner import DefaultPartitioner
+
+ConsumerRecord = namedtuple(
+    "ConsumerRecord", ["topic", "partition", "offset", "timestamp", "key", "value", "headers"]
+)
+
+
+class InMemoryBroker:
+    """Append-only partition logs guarded by one condition variable."""
+
+    def __init__(self, partitions=3):
+        self.partition_count = partitions
+        self.logs = {}
+        self.condition = threading.Condition()
+
+    def _log(self, topic, partition):
+        return self.logs.setdefault((topic, partition), [])
+
+    def append(self, topic, partition, key, value, headers, timestamp_ms=None):
+        with self.condition:
+            log = self._log(topic, partition)
+            if timestamp_ms is None:
+                timestamp_ms = int(time.time() * 1000)
+            record = ConsumerRecord(topic, partition, len(log), timestamp_ms, key, value, headers)
+            log.append(record)
+            self.condition.notify_all()
+            return record
+
+    def total_records(self, topic):
+        with self.condition:
+            return sum(len(log) for (t, _), log in self.logs.items() if t == topic)
+
+
+class SentRecord:
+    """Already-resolved stand-in for the future returned by KafkaProducer.send()."""
+
+    def __init__(self, record):
+        self.record = record
+
+    def get(self, timeout=None):
+        return self.record
+
+
+class InMemoryProducer:
+    """KafkaProducer look-alike: serializes, partitions and appends synchronously."""
+
+    def __init__(self, broker, key_serializer=None, value_serializer=None, partitioner=None, on_send=None):
+        self.broker = broker
+        self.key_serializer = key_serializer
+        self.value_serializer = value_serializer
+        self.partitioner = partitioner or DefaultPartitioner()
+        self.on_send = on_send
+
+    def send(self, topic, value=None, key=None, headers=None, timestamp_ms=None):
+        key_bytes = self.key_serializer(key) if self.key_serializer else key
+        value_bytes = self.value_serializer(value) if self.value_serializer else value
+        partitions = list(range(self.broker.partition_count))
+        partition = self.partitioner(key_bytes, partitions, partitions)
+        record = self.broker.append(topic, partition, key_bytes, value_bytes, headers or [], timestamp_ms)
+        if self.on_send:
+            self.on_send(value_bytes, record)
+        return SentRecord(record)
+
+    def flush(self, timeout=None):
+        pass
+
+    def close(self, timeout=None):
+        pass
+
+
+class InMemoryConsumer:
+    """
+    KafkaConsumer look-alike for a single group member that owns every
+    partition. poll() blocks for new records until its timeout or close().
+    """
+
+    def __init__(self, broker, poll_timeout=0.05):
+        self.broker = broker
+        self.poll_timeout = poll_timeout
+        self.topics = []
+        self.listener = None
+        self.positions = {}
+        self.committed = {}
+        self.closed = False
+        self.assigned = False
+        self.on_receive = None
+
+    def subscribe(self, topics, listener=None):
+        self.topics = list(topics)
+        self.listener = listener
+
+    def assignment(self):
+        return {TopicPartition(t, p) for t in self.topics for p in range(self.broker.partition_count)}
+
+    def commit(self, offsets=None):
+        self.committed.update(self.positions)
+
+    def close(self, autocommit=True):
+        if autocommit:
+            self.commit()
+        with self.broker.condition:
+            self.closed = True
+            self.broker.condition.notify_all()
+
+    def position(self, tp):
+        return self.positions.get(tp, 0)
+
+    def end_offsets(self, partitions):
+        with self.broker.condition:
+            return {tp: len(self.broker._log(tp.topic, tp.partition)) for tp in partitions}
+
+    def poll(self, timeout_ms=0, max_records=None):
+        """Return {TopicPartition: [records]}, waiting up to timeout_ms for data."""
+        if self.listener and not self.assigned:
+            self.assigned = True
+            self.listener.on_partitions_assigned(sorted(self.assignment()))
+        deadline = time.monotonic() + timeout_ms / 1000.0
+        batches = {}
+        with self.broker.condition:
+            while not self.closed:
+                remaining = max_records or float("inf")
+                for tp in sorted(self.assignment()):
+                    log = self.broker._log(tp.topic, tp.partition)
+                    position = self.positions.get(tp, 0)
+                    if position < len(log) and remaining > 0:
+                        end = int(min(len(log), position + remaining))
+                        batches[tp] = log[position:end]
+                        self.positions[tp] = end
+                        remaining -= end - position
+                wait = deadline - time.monotonic()
+                if batches or wait <= 0:
+                    break
+                self.broker.condition.wait(min(wait, self.poll_timeout))
+        if self.on_receive:
+            for records in batches.values():
+                for record in records:
+                    self.on_receive(record)
+        return batches
@@ -0,0 +1,381 @@
+"""
+End-to-end latency and throughput of the ingest pipeline.
+
+Drives the real code paths in one process:
+
+    server.py (load mode) -> socket -> producer.process_messages
+        -> in-memory Kafka -> consumer.KafkaMongoDataPipeline
+        -> Mongo (mongomock, or a local mongod via --mongo-uri)
+        -> the /device-data query (latest 15 by _id)
+        -> the /ws/device-data live feed (live_feed.LiveFeed, one client)
+
+Each reading carries Sent_At/Seq from the load generator, and every stage
+boundary is timestamped:
+
+    socket     Sent_At              -> producer hands the record to Kafka
+    kafka      producer send        -> consumer receives the record
+    mongo      consumer receives    -> insert returns
+    visible    insert returns       -> record shows up in the /device-data query
+    websocket  insert returns       -> a live feed frame carrying it is sent
+    stored     Sent_At              -> insert returns
+    total      Sent_At              -> visible (ingest-to-visible)
+    pushed     Sent_At              -> live feed frame sent (ingest-to-push)
+
+/device-data only returns the 15 newest readings, so "visible" and "total"
+are measured over the readings the poller actually saw. Likewise the live
+feed sends only the newest reading of each device per batch interval
+(--ws-interval), so "websocket" and "pushed" cover the readings that made
+it into a frame. Route throughput is measured by benchmarks/route_load.py.
+
+Usage:
+    python -m benchmarks.pipeline_bench --rate 2000 --duration 10 --output run.json
+    python -m benchmarks.pipeline_bench --compare run.json   # diff against a previous run
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+import codec
+import consumer
+import producer
+import server
+import telemetry_fields
+import wire_format
+from live_feed import LiveFeed
+
+from benchmarks.inmemory_kafka import InMemoryBroker, InMemoryConsumer, InMemoryProducer
+
+STAGES = ["socket", "kafka", "mongo", "visible", "websocket", "stored", "total", "pushed"]
+# Seq as stored by the consumer (STORED_FIELD_NAMES, see telemetry_fields.py)
+SEQ_FIELD = telemetry_fields.stored_name("Seq")
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0, "mean_ms": None, "p50_ms": None, "p95_ms": None, "p99_ms": None}
+    return {
+        "count": len(values),
+        "mean_ms": sum(values) / len(values) * 1000,
+        "p50_ms": percentile(values, 0.50) * 1000,
+        "p95_ms": percentile(values, 0.95) * 1000,
+        "p99_ms": percentile(values, 0.99) * 1000,
+    }
+
+
+class StageClock:
+    """Collects the time each reading (by Seq) crossed each stage boundary."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent_at = {}
+        self.produced = {}
+        self.received = {}
+        self.stored = {}
+        self.visible = {}
+        self.pushed = {}
+        self.seq_by_record = {}
+
+    def on_send(self, value, record):
+        now = time.time()
+        reading = wire_format.decode_kafka_value(value, record.headers)
+        seq = reading.get("Seq")
+        with self.lock:
+            self.sent_at[seq] = reading.get("Sent_At")
+            self.produced[seq] = now
+            self.seq_by_record[(record.partition, record.offset)] = seq
+
+    def on_receive(self, record):
+        now = time.time()
+        with self.lock:
+            seq = self.seq_by_record.get((record.partition, record.offset))
+            self.received[seq] = now
+
+    def on_stored(self, document):
+        now = time.time()
+        with self.lock:
+            self.stored[document.get(SEQ_FIELD)] = now
+
+    def on_visible(self, seq, now):
+        with self.lock:
+            self.visible.setdefault(seq, now)
+
+    def on_pushed(self, seq, now):
+        with self.lock:
+            self.pushed.setdefault(seq, now)
+
+    def stage_latencies(self):
+        def diffs(end, start):
+            return [end[s] - start[s] for s in end if s in start and start[s] is not None]
+
+        return {
+            "socket": diffs(self.produced, self.sent_at),
+            "kafka": diffs(self.received, self.produced),
+            "mongo": diffs(self.stored, self.received),
+            "visible": diffs(self.visible, self.stored),
+            "websocket": diffs(self.pushed, self.stored),
+            "stored": diffs(self.stored, self.sent_at),
+            "total": diffs(self.visible, self.sent_at),
+            "pushed": diffs(self.pushed, self.sent_at),
+        }
+
+
+class TimedCollection:
+    """Collection proxy that reports when each inserted document is durable."""
+
+    def __init__(self, collection, clock):
+        self._collection = collection
+        self._clock = clock
+
+    def insert_one(self, document, *args, **kwargs):
+        result = self._collection.insert_one(document, *args, **kwargs)
+        self._clock.on_stored(document)
+        return result
+
+    def insert_many(self, documents, *args, **kwargs):
+        documents = list(documents)
+        result = self._collection.insert_many(documents, *args, **kwargs)
+        for document in documents:
+            self._clock.on_stored(document)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+
+def poll_device_data(collection, clock, stop_event, interval):
+    """Run the /device-data query in a loop and note when readings first appear."""
+    while not stop_event.is_set():
+        docs = list(collection.find({}, {SEQ_FIELD: 1}).sort('_id', -1).limit(15))
+        now = time.time()
+        for doc in docs:
+            clock.on_visible(doc.get(SEQ_FIELD), now)
+        stop_event.wait(interval)
+
+
+def follow_live_feed(collection, clock, stop_event, interval):
+    """Subscribe one client to the live feed and note when each reading is first sent in a frame."""
+
+    async def record(client_ids, frame, started):
+        now = time.time()
+        for state in codec.loads(frame)["devices"].values():
+            if "Seq" in state:
+                clock.on_pushed(state["Seq"], now)
+
+    async def follow():
+        # subscribe() sends the snapshot and starts the feed's tick() loop
+        feed = LiveFeed(collection, record, interval)
+        await feed.subscribe("bench")
+        while not stop_event.is_set():
+            await asyncio.sleep(interval)
+        await feed.stop()
+
+    asyncio.run(follow())
+
+
+def make_mongo_client(uri):
+    if uri:
+        from pymongo import MongoClient
+        return MongoClient(uri)
+    try:
+        import mongomock
+    except ImportError:
+        raise SystemExit("mongomock is not installed; pip install mongomock or pass --mongo-uri")
+    return mongomock.MongoClient()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    # Per-message INFO logs would dominate the measurement
+    logging.disable(logging.INFO)
+    server.WIRE_FORMAT = args.wire_format
+    producer.WIRE_FORMAT = args.wire_format
+    # Never write benchmark data into the application database
+    consumer.MONGODB_DATABASE_NAME = args.database
+
+    clock = StageClock()
+    broker = InMemoryBroker(partitions=args.partitions)
+
+    mongo_client = make_mongo_client(args.mongo_uri)
+    mongo_client.drop_database(args.database)
+
+    kafka_consumer = InMemoryConsumer(broker)
+    kafka_consumer.on_receive = clock.on_receive
+    pipeline = consumer.KafkaMongoDataPipeline(kafka_consumer, mongo_client)
+    raw_collection = pipeline.target_collection
+    pipeline.target_collection = TimedCollection(raw_collection, clock)
+    consumer_thread = threading.Thread(target=pipeline.start_pipeline, daemon=True)
+    consumer_thread.start()
+
+    stop_polling = threading.Event()
+    poller = threading.Thread(
+        target=poll_device_data, args=(raw_collection, clock, stop_polling, args.poll_interval), daemon=True
+    )
+    poller.start()
+    live_follower = threading.Thread(
+        target=follow_live_feed, args=(raw_collection, clock, stop_polling, args.ws_interval), daemon=True
+    )
+    live_follower.start()
+
+    # The real load generator, served on an ephemeral port
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    port = listener.getsockname()[1]
+    options = server.parse_args([
+        "--mode", "load", "--rate", str(args.rate), "--duration", str(args.duration),
+        "--devices", str(args.devices), "--routes", str(args.routes),
+        "--profile", args.profile, "--seed", str(args.seed),
+    ])
+
+    def serve():
+        conn, addr = listener.accept()
+        server.handle_client(conn, addr, options, 0)
+
+    threading.Thread(target=serve, daemon=True).start()
+
+    kafka_producer = InMemoryProducer(
+        broker,
+        key_serializer=producer._serialize_key,
+        value_serializer=producer._serialize_value,
+        partitioner=producer.PARTITIONERS[producer.PARTITIONER],
+        on_send=clock.on_send,
+    )
+    # The producer's outbox, with its spool in a throwaway directory
+    spool_dir = tempfile.mkdtemp(prefix="pipeline_bench_")
+    outbox = producer.Outbox(
+        producer.DiskSpool(os.path.join(spool_dir, "producer.spool"), producer.SPOOL_MAX_BYTES),
+        producer.MEMORY_QUEUE_RECORDS,
+    )
+    sender = producer.KafkaSender(outbox)
+    sender.producer = kafka_producer
+    sender.start()
+    started = time.time()
+    sock = socket.create_connection(("127.0.0.1", port))
+    try:
+        producer.process_messages(sock, outbox)
+    finally:
+        sock.close()
+        listener.close()
+    while outbox.pending() and time.time() < started + args.duration + args.drain_timeout:
+        time.sleep(0.05)
+    sender.stop(timeout=5)
+    outbox.close()
+    shutil.rmtree(spool_dir, ignore_errors=True)
+
+    # Let the consumer drain everything that reached the broker
+    produced = broker.total_records(consumer.KAFKA_INPUT_TOPIC)
+    deadline = time.time() + args.drain_timeout
+    while len(clock.stored) < produced and time.time() < deadline:
+        time.sleep(0.05)
+    time.sleep(max(args.poll_interval, args.ws_interval) * 3)
+    stop_polling.set()
+    poller.join()
+    live_follower.join()
+    stored_count = len(clock.stored)
+    # Measured from the first reading generated, so connection setup is not counted
+    first_sent = min((t for t in clock.sent_at.values() if t is not None), default=started)
+    last_stored = max(clock.stored.values()) if clock.stored else first_sent
+
+    pipeline.is_running = False
+    consumer_thread.join(timeout=5)
+
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "rate": args.rate, "duration": args.duration, "devices": args.devices, "routes": args.routes,
+            "profile": args.profile, "seed": args.seed, "partitions": args.partitions,
+            "wire_format": args.wire_format, "poll_interval": args.poll_interval,
+            "ws_interval": args.ws_interval,
+            "mongo": "mongod" if args.mongo_uri else "mongomock",
+        },
+        "events_produced": produced,
+        "events_stored": stored_count,
+        "events_per_sec": stored_count / (last_stored - first_sent) if last_stored > first_sent else 0.0,
+        "stages": {name: summarize(values) for name, values in clock.stage_latencies().items()},
+    }
+
+
+def print_results(results, baseline=None):
+    print(f"commit {results['commit']}  {results['config']}")
+    line = f"events/sec: {results['events_per_sec']:.0f}  ({results['events_stored']}/{results['events_produced']} stored)"
+    if baseline:
+        line += f"  baseline {baseline['events_per_sec']:.0f} ({_delta(results['events_per_sec'], baseline['events_per_sec'])})"
+    print(line)
+    print(f"{'stage':<10}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name in STAGES:
+        stage = results["stages"][name]
+        if not stage["count"]:
+            print(f"{name:<10}{0:>8}")
+            continue
+        print(f"{name:<10}{stage['count']:>8}{stage['p50_ms']:>10.2f}{stage['p95_ms']:>10.2f}{stage['p99_ms']:>10.2f}")
+        if baseline and baseline["stages"].get(name, {}).get("count"):
+            base = baseline["stages"][name]
+            print(f"{'  vs base':<18}"
+                  f"{_delta(stage['p50_ms'], base['p50_ms']):>10}"
+                  f"{_delta(stage['p95_ms'], base['p95_ms']):>10}"
+                  f"{_delta(stage['p99_ms'], base['p99_ms']):>10}")
+
+
+def _delta(current, previous):
+    if not previous:
+        return "n/a"
+    return f"{(current - previous) / previous * 100:+.1f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=1000, help="Events/sec from the load generator")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of load")
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--routes", type=int, default=20)
+    parser.add_argument("--profile", choices=["steady", "burst"], default="steady")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--partitions", type=int, default=3)
+    parser.add_argument("--wire-format", choices=list(wire_format.SUPPORTED_FORMATS), default=wire_format.FORMAT_JSON)
+    parser.add_argument("--poll-interval", type=float, default=0.05, help="Seconds between /device-data polls")
+    parser.add_argument("--ws-interval", type=float, default=0.25,
+                        help="Live feed batch interval in seconds (WS_BATCH_INTERVAL_MS / 1000)")
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    parser.add_argument("--mongo-uri", help="Use a local mongod instead of mongomock")
+    parser.add_argument("--database", default="scmlite_bench", help="Database the benchmark writes to (dropped first)")
+    parser.add_argument("--output", help="Write the results as JSON")
+    parser.add_argument("--compare", help="Previous results JSON to compare against")
+    args = parser.parse_args()
+
+    results = run(args)
+    baseline = None
+    if args.compare and os.path.exists(args.compare):
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
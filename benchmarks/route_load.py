@@ -0,0 +1,396 @@
+"""
+Requests per second and latency of the web app's routes under concurrent users.
+
+Runs main.app in-process behind httpx's ASGI transport, so a run measures
+one worker's routes, threadpool and Mongo calls without sockets or HTTP
+parsing. Mongo is mongomock, or a local mongod via --mongo-uri. mongomock
+is not thread-safe: concurrent queries occasionally fail with 500s that a
+real server would not give, so take error rates from --mongo-uri runs.
+Users, shipments and device readings are seeded first. Each virtual user then
+repeats weighted journeys until the level's duration is up:
+
+    login      POST /login, then POST /verify-2fa with the emailed code
+               (the email hook is replaced; nothing is sent)
+    browse     GET /shipment/my (with the ETag of its last answer, as the
+               dashboard sends it), GET /account/me/{email}
+    devices    POST /device-data/filter for 1-3 devices (IDs sent as strings,
+               as DeviceListModel takes them), GET /device-data
+    create     POST /shipment/new
+
+Every concurrency level runs with fresh counters after a warm-up. Each
+level reports, per route, throughput, error rate (any status other than
+2xx/304, or an exception) and latency percentiles. The auth rate limits
+are raised for the run unless --keep-rate-limits is given. Password-hash
+admission control (AUTH_MAX_CONCURRENT_HASHES) stays in force, and its
+503s count as errors.
+
+Usage:
+    python -m benchmarks.route_load --concurrency 1 8 32 --duration 10 --output load.json
+    python -m benchmarks.route_load --concurrency 1 8 32 --compare load.json   # diff against a previous run
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List, NamedTuple
+
+from benchmarks.pipeline_bench import _delta, git_commit, summarize
+
+PASSWORD = "load-test-password"
+DEVICE_IDS = list(range(1150, 1159))
+CITIES = ["Chennai, India", "Mumbai, India", "Delhi, India", "Dubai, UAE", "Singapore", "Rotterdam, Netherlands"]
+JOURNEYS = ["login", "browse", "devices", "create"]
+DEFAULT_MIX = "login=10,browse=50,devices=35,create=5"
+OK_STATUSES = {200, 201, 202, 304}
+
+
+class VirtualUser(NamedTuple):
+    email: str
+    token: str
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """'login=10,browse=50' -> journey weights."""
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in JOURNEYS:
+            raise ValueError(f"Unknown journey '{name}' (expected one of {JOURNEYS})")
+        mix[name] = float(weight)
+    return mix
+
+
+class RouteStats:
+    """Latency and status of every request, per route; only records after `measure_from`."""
+
+    def __init__(self, measure_from: float):
+        self.measure_from = measure_from
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    def record(self, route: str, outcome, started: float, finished: float):
+        if started < self.measure_from:
+            return
+        self.latencies[route].append(finished - started)
+        self.statuses[route][str(outcome)] += 1
+
+    def summary(self, elapsed: float) -> Dict[str, dict]:
+        routes = {}
+        for route in sorted(self.latencies):
+            statuses = dict(self.statuses[route])
+            requests = sum(statuses.values())
+            errors = sum(count for outcome, count in statuses.items() if not _is_ok(outcome))
+            routes[route] = {
+                "requests": requests,
+                "rps": requests / elapsed,
+                "errors": errors,
+                "error_rate": errors / requests,
+                "statuses": statuses,
+                **summarize(self.latencies[route]),
+            }
+        return routes
+
+
+def _is_ok(outcome: str) -> bool:
+    return outcome.isdigit() and int(outcome) in OK_STATUSES
+
+
+async def timed(client, stats: RouteStats, route: str, method: str, url: str, **kwargs):
+    started = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+    except Exception as e:
+        stats.record(route, type(e).__name__, started, time.perf_counter())
+        return None
+    stats.record(route, response.status_code, started, time.perf_counter())
+    return response
+
+
+# ------------------ JOURNEYS ------------------
+
+async def journey_login(client, user: VirtualUser, stats: RouteStats, state: dict, rng, codes: Dict[str, str]):
+    response = await timed(client, stats, "POST /login", "POST", "/login",
+                           json={"email": user.email, "password": PASSWORD})
+    if response is None or response.status_code != 202:
+        return
+    await timed(client, stats, "POST /verify-2fa", "POST", "/verify-2fa",
+                json={"email": user.email, "code": codes.pop(user.email, "000000")})
+
+
+async def journey_browse(client, user: VirtualUser, stats: RouteStats, state: dict, rng, codes):
+    headers = {"Authorization": f"Bearer {user.token}"}
+    if state.get("etag"):
+        headers["If-None-Match"] = state["etag"]
+    response = await timed(client, stats, "GET /shipment/my", "GET", "/shipment/my", headers=headers)
+    if response is not None and response.status_code == 200:
+        state["etag"] = response.headers.get("ETag")
+    await timed(client, stats, "GET /account/me/{email}", "GET", f"/account/me/{user.email}",
+                headers={"Authorization": f"Bearer {user.token}"})
+
+
+async def journey_devices(client, user: VirtualUser, stats: RouteStats, state: dict, rng, codes):
+    headers = {"Authorization": f"Bearer {user.token}"}
+    devices = [str(device) for device in rng.sample(DEVICE_IDS, rng.randint(1, 3))]
+    await timed(client, stats, "POST /device-data/filter", "POST", "/device-data/filter",
+                json={"devices": devices}, headers=headers)
+    await timed(client, stats, "GET /device-data", "GET", "/device-data", headers=headers)
+
+
+async def journey_create(client, user: VirtualUser, stats: RouteStats, state: dict, rng, codes):
+    await timed(client, stats, "POST /shipment/new", "POST", "/shipment/new",
+                json=shipment_document(rng), headers={"Authorization": f"Bearer {user.token}"})
+
+
+JOURNEY_FUNCTIONS = {
+    "login": journey_login,
+    "browse": journey_browse,
+    "devices": journey_devices,
+    "create": journey_create,
+}
+
+
+async def virtual_user(client, user: VirtualUser, stats: RouteStats, mix: Dict[str, float], deadline: float,
+                       rng: random.Random, codes: Dict[str, str], think_seconds: float):
+    names, weights = list(mix), list(mix.values())
+    state: dict = {}
+    while time.perf_counter() < deadline:
+        journey = JOURNEY_FUNCTIONS[rng.choices(names, weights)[0]]
+        await journey(client, user, stats, state, rng, codes)
+        if think_seconds:
+            await asyncio.sleep(think_seconds)
+
+
+# ------------------ SEEDING ------------------
+
+def shipment_document(rng: random.Random) -> dict:
+    number = rng.randint(100000, 999999)
+    return {
+        "shipmentNumber": f"SHP-{number}",
+        "route": " -> ".join(rng.sample(CITIES, 2)),
+        "device": str(rng.choice(DEVICE_IDS)),
+        "poNumber": f"PO-{number}",
+        "containerNumber": f"CONT-{rng.randint(1000, 9999)}",
+        "goodsType": rng.choice(["Pharma", "Electronics", "Food", "Chemicals"]),
+        "deliveryDate": "2026-12-01",
+        "description": "Load test shipment",
+        "status": rng.choice(["Created", "In Transit", "Delivered"]),
+        "created": "2026-10-01",
+        "ndcNumber": f"NDC-{number}",
+        "serialNumber": f"SN-{number}",
+        "deliveryNumber": f"DN-{number}",
+        "batchId": f"B-{rng.randint(1, 500)}",
+    }
+
+
+def seed(database, users: int, shipments_per_user: int, readings: int, seed_value: int) -> List[VirtualUser]:
+    import auth
+    import telemetry_fields
+    from database import DEVICE_STREAM_DATA_COLLECTION, SHIPMENT_DATA_COLLECTION, USERS_COLLECTION
+
+    rng = random.Random(seed_value)
+    # One bcrypt hash for everyone: seeding should not take minutes
+    hashed = auth.hash_password(PASSWORD)
+    emails = [f"load{i}@example.com" for i in range(users)]
+    database[USERS_COLLECTION].insert_many(
+        [{"name": f"Load User {i}", "email": email, "password": hashed} for i, email in enumerate(emails)]
+    )
+    now = int(time.time())
+    shipments = []
+    for email in emails:
+        for _ in range(shipments_per_user):
+            document = shipment_document(rng)
+            document["timestamp"] = now - rng.randint(0, 90 * 86400)
+            document["creator_email"] = email
+            shipments.append(document)
+    if shipments:
+        database[SHIPMENT_DATA_COLLECTION].insert_many(shipments)
+    if readings:
+        database[DEVICE_STREAM_DATA_COLLECTION].insert_many([telemetry_fields.to_stored({
+            "Device_ID": rng.choice(DEVICE_IDS),
+            "Battery_Level": round(rng.uniform(2.5, 4.2), 2),
+            "First_Sensor_temperature": round(rng.uniform(2, 40), 1),
+            "Route_From": rng.choice(CITIES),
+            "Route_To": rng.choice(CITIES),
+        }) for _ in range(readings)])
+    return [VirtualUser(email, auth.create_access_token({"sub": email})) for email in emails]
+
+
+async def check_seeded_routes(app, user: VirtualUser):
+    """Fail fast if a journey would only measure empty results."""
+    import httpx
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://route-load") as client:
+        response = await client.post("/device-data/filter", json={"devices": [str(device) for device in DEVICE_IDS]},
+                                     headers={"Authorization": f"Bearer {user.token}"})
+    if response.status_code != 200 or not response.json():
+        raise SystemExit(f"POST /device-data/filter returned no seeded readings ({response.status_code}: "
+                         f"{response.text[:200]}); the devices journey would only time empty results")
+
+
+# ------------------ RUN ------------------
+
+def configure_environment(args):
+    """Settings main.py reads at import time."""
+    os.environ["MONGODB_URI"] = args.mongo_uri or "mongodb://mongomock"
+    os.environ["DATABASE_NAME"] = args.database
+    os.environ.setdefault("JWT_SECRET_KEY", "route-load-secret")
+    # Per-worker stores: nothing to share with other processes
+    os.environ["RATE_LIMIT_BACKEND"] = "memory"
+    os.environ["SECRET_STORE_BACKEND"] = "mongo"
+    os.environ["PROFILING_ENABLED"] = "false"
+    if not args.keep_rate_limits:
+        os.environ["AUTH_RATE_LIMIT_PER_IP"] = "1000000/second"
+        os.environ["AUTH_RATE_LIMIT_PER_EMAIL"] = "1000000/second"
+
+
+def connect_database(args):
+    import mongo_clients
+
+    if not args.mongo_uri:
+        try:
+            import mongomock
+        except ImportError:
+            raise SystemExit("mongomock is not installed; pip install mongomock or pass --mongo-uri")
+        client = mongomock.MongoClient()
+        # Every client the app creates is this one
+        mongo_clients.MongoClient = lambda *args, **kwargs: client
+
+    from database import Database
+
+    Database.connect()
+    Database._client.drop_database(args.database)
+    return Database._db
+
+
+async def run_level(app, users: List[VirtualUser], mix, concurrency: int, args, codes) -> dict:
+    import httpx
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://route-load") as client:
+        started = time.perf_counter()
+        stats = RouteStats(measure_from=started + args.warmup)
+        deadline = started + args.warmup + args.duration
+        await asyncio.gather(*(
+            virtual_user(client, users[i], stats, mix, deadline, random.Random(args.seed + i), codes,
+                         args.think_ms / 1000)
+            for i in range(concurrency)
+        ))
+        elapsed = time.perf_counter() - stats.measure_from
+    routes = stats.summary(elapsed)
+    requests = sum(route["requests"] for route in routes.values())
+    errors = sum(route["errors"] for route in routes.values())
+    return {
+        "concurrency": concurrency,
+        "seconds": elapsed,
+        "requests": requests,
+        "rps": requests / elapsed,
+        "error_rate": errors / requests if requests else 0.0,
+        "routes": routes,
+    }
+
+
+def run(args):
+    try:
+        import httpx  # noqa: F401
+    except ImportError:
+        raise SystemExit("httpx is not installed; pip install httpx")
+    if max(args.concurrency) > args.users:
+        raise SystemExit("--users must be at least the highest --concurrency (one account per virtual user)")
+    mix = parse_mix(args.mix)
+
+    configure_environment(args)
+    # Route logs and per-request prints would dominate the measurement
+    logging.disable(logging.WARNING)
+    database = connect_database(args)
+    # Imported only now: config.py reads the environment set above
+    import main
+
+    codes: Dict[str, str] = {}
+
+    async def capture_code(recipient_email: str, code: str) -> bool:
+        codes[recipient_email] = code
+        return True
+
+    main.send_2fa_code_email = capture_code
+    users = seed(database, args.users, args.shipments_per_user, args.readings, args.seed)
+    if args.readings and mix.get("devices"):
+        asyncio.run(check_seeded_routes(main.app, users[0]))
+
+    levels = [asyncio.run(run_level(main.app, users, mix, concurrency, args, codes)) for concurrency in args.concurrency]
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "concurrency": args.concurrency, "duration": args.duration, "warmup": args.warmup,
+            "mix": mix, "think_ms": args.think_ms, "users": args.users,
+            "shipments_per_user": args.shipments_per_user, "readings": args.readings, "seed": args.seed,
+            "rate_limits": "kept" if args.keep_rate_limits else "raised",
+            "mongo": "mongod" if args.mongo_uri else "mongomock",
+        },
+        "levels": levels,
+    }
+
+
+def print_results(results, baseline=None):
+    print(f"commit {results['commit']}  {results['config']}")
+    base_levels = {level["concurrency"]: level for level in (baseline or {}).get("levels", [])}
+    for level in results["levels"]:
+        base = base_levels.get(level["concurrency"])
+        line = (f"\nconcurrency {level['concurrency']}: {level['rps']:.0f} req/s, "
+                f"errors {level['error_rate'] * 100:.2f}%")
+        if base:
+            line += f"  baseline {base['rps']:.0f} req/s ({_delta(level['rps'], base['rps'])})"
+        print(line)
+        print(f"{'route':<28}{'req/s':>9}{'err %':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for route, stats in level["routes"].items():
+            print(f"{route:<28}{stats['rps']:>9.1f}{stats['error_rate'] * 100:>8.2f}"
+                  f"{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+            previous = base["routes"].get(route) if base else None
+            if previous and previous["requests"]:
+                print(f"{'  vs base':<28}{_delta(stats['rps'], previous['rps']):>9}{'':>8}"
+                      f"{_delta(stats['p50_ms'], previous['p50_ms']):>10}"
+                      f"{_delta(stats['p95_ms'], previous['p95_ms']):>10}"
+                      f"{_delta(stats['p99_ms'], previous['p99_ms']):>10}")
+            errors = {outcome: count for outcome, count in stats["statuses"].items() if not _is_ok(outcome)}
+            if errors:
+                print(f"{'  errors':<28}{errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32], help="Virtual users per level")
+    parser.add_argument("--duration", type=float, default=10, help="Measured seconds per level")
+    parser.add_argument("--warmup", type=float, default=2, help="Unmeasured seconds before each level")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Journey weights, e.g. 'browse=80,devices=20'")
+    parser.add_argument("--think-ms", type=float, default=0, help="Pause between journeys (0: closed loop)")
+    parser.add_argument("--users", type=int, default=200, help="Seeded accounts")
+    parser.add_argument("--shipments-per-user", type=int, default=20)
+    parser.add_argument("--readings", type=int, default=20000, help="Seeded device readings")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--keep-rate-limits", action="store_true", help="Measure with the configured auth limits")
+    parser.add_argument("--mongo-uri", help="Use a local mongod instead of mongomock")
+    parser.add_argument("--database", default="scmlite_load", help="Database the run writes to (dropped first)")
+    parser.add_argument("--output", help="Write the results as JSON")
+    parser.add_argument("--compare", help="Previous results JSON to compare against")
+    args = parser.parse_args()
+
+    results = run(args)
+    baseline = None
+    if args.compare and os.path.exists(args.compare):
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+JSON codec shared by the producer, consumer and web app.
+
+orjson is used when it is installed; otherwise everything falls back to the
+standard library json module with the same output (compact, UTF-8 bytes).
+Mongo documents can be passed in as-is: ObjectId and datetime values are
+handled by the encoder, so handlers no longer need to stringify `_id`.
+"""
+import json
+from datetime import date, datetime
+from typing import Any
+
+from bson import ObjectId
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Name of the active backend, useful for logs and benchmarks
+BACKEND = "orjson" if orjson is not None else "json"
+
+# Both orjson.JSONDecodeError and json.JSONDecodeError derive from this
+JSONDecodeError = json.JSONDecodeError
+
+
+def _default(obj: Any) -> Any:
+    """Encode the types that come back from Mongo."""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(obj: Any) -> bytes:
+        """Serialize obj to compact JSON bytes."""
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+
+    def loads(data) -> Any:
+        """Parse JSON from bytes or str."""
+        return orjson.loads(data)
+else:
+    def dumps(obj: Any) -> bytes:
+        """Serialize obj to compact JSON bytes."""
+        return json.dumps(obj, default=_default, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+    def loads(data) -> Any:
+        """Parse JSON from bytes or str."""
+        return json.loads(data)
+
+
+def dumps_str(obj: Any) -> str:
+    """Serialize obj to a JSON string (for text frames and sockets)."""
+    return dumps(obj).decode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    ORJSONResponse-style response class backed by this codec.
+
+    Returning an instance directly from a handler also skips FastAPI's
+    jsonable_encoder pass, which is where most of the per-document cost
+    of the old responses went.
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
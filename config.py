@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import List
+from typing import List, Optional
 import os
 from dotenv import load_dotenv
 
@@ -7,24 +7,84 @@ from dotenv import load_dotenv
 load_dotenv()
 
 class Settings(BaseSettings):
-    MONGODB_URI: str = os.getenv("MONGODB_URI")
-    DATABASE_NAME: str = os.getenv("DATABASE_NAME")
-    KAFKA_BOOTSTRAP_SERVERS: str = os.getenv("KAFKA_BOOTSTRAP_SERVERS")
+    # Missing values must not break the import: the web app starts, and
+    # /readyz reports whatever it cannot reach
+    MONGODB_URI: Optional[str] = os.getenv("MONGODB_URI")
+    DATABASE_NAME: Optional[str] = os.getenv("DATABASE_NAME")
+    KAFKA_BOOTSTRAP_SERVERS: str = os.getenv("KAFKA_BOOTSTRAP_SERVERS", "")
     KAFKA_TOPIC: str = os.getenv("KAFKA_TOPIC", "device_stream_data")
-    JWT_SECRET_KEY: str = os.getenv("JWT_SECRET_KEY")
-    JWT_ALGORITHM: str = os.getenv("JWT_ALGORITHM")
-    ACCESS_TOKEN_EXPIRE_MINUTES: int = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
-    ZOOKEEPER_CLIENT_PORT: str = int(os.getenv("ZOOKEEPER_CLIENT_PORT"))
+    JWT_SECRET_KEY: Optional[str] = os.getenv("JWT_SECRET_KEY")
+    JWT_ALGORITHM: str = os.getenv("JWT_ALGORITHM", "HS256")
+    ACCESS_TOKEN_EXPIRE_MINUTES: int = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
+    ZOOKEEPER_CLIENT_PORT: str = os.getenv("ZOOKEEPER_CLIENT_PORT", "2181")
 
 
-    EMAIL_HOST = os.getenv("EMAIL_HOST")
-    EMAIL_PORT= int(os.getenv("EMAIL_PORT"))
-    EMAIL_USERNAME = os.getenv("EMAIL_USERNAME")
-    EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
+    EMAIL_HOST: Optional[str] = os.getenv("EMAIL_HOST")
+    EMAIL_PORT: int = int(os.getenv("EMAIL_PORT", 587))
+    EMAIL_USERNAME: Optional[str] = os.getenv("EMAIL_USERNAME")
+    EMAIL_PASSWORD: Optional[str] = os.getenv("EMAIL_PASSWORD")
+
+    # Request profiling (see profiling.py); off unless PROFILING_ENABLED=true
+    PROFILING_ENABLED: bool = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+    SLOW_QUERY_MS: float = float(os.getenv("SLOW_QUERY_MS", 100))
+    # Fraction of requests profiled without an X-Profile header
+    PROFILE_SAMPLE_RATE: float = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+    # Comma-separated emails allowed to use the /admin endpoints
+    ADMIN_EMAILS: str = os.getenv("ADMIN_EMAILS", "")
+
+    # Delta sync (`since` on the polling routes) and the live feed re-read
+    # this many seconds before their cursor, for documents committed out of
+    # `_id` order
+    SYNC_LOOKBACK_SECONDS: float = float(os.getenv("SYNC_LOOKBACK_SECONDS", 2))
+    # WebSocket fan-out across workers (see backplane.py): 'memory' for a
+    # single worker, 'broker' when running several workers or replicas
+    WS_BACKPLANE: str = os.getenv("WS_BACKPLANE", "memory")
+    BACKPLANE_ADDRESS: str = os.getenv("BACKPLANE_ADDRESS", "localhost:7070")
+    WS_SHARDS: int = int(os.getenv("WS_SHARDS", 64))
+    # Live feed frames on /ws/device-data (see live_feed.py) go out at most this
+    # often; with the broker backplane one worker reads the feed for all of them
+    WS_BATCH_INTERVAL_MS: int = int(os.getenv("WS_BATCH_INTERVAL_MS", 250))
+
+    # Auth endpoint throttling (see rate_limit.py): 'memory' per worker or
+    # 'mongo' shared across workers; limits are '<count>/<second|minute|hour|day>'
+    RATE_LIMIT_BACKEND: str = os.getenv("RATE_LIMIT_BACKEND", "memory")
+    AUTH_RATE_LIMIT_PER_IP: str = os.getenv("AUTH_RATE_LIMIT_PER_IP", "30/minute")
+    AUTH_RATE_LIMIT_PER_EMAIL: str = os.getenv("AUTH_RATE_LIMIT_PER_EMAIL", "5/minute")
+    AUTH_MAX_CONCURRENT_HASHES: int = int(os.getenv("AUTH_MAX_CONCURRENT_HASHES", 4))
+    AUTH_MAX_CONCURRENT_EMAILS: int = int(os.getenv("AUTH_MAX_CONCURRENT_EMAILS", 8))
+
+    # 2FA codes and reset tokens (see secret_store.py): 'mongo' is needed as
+    # soon as more than one worker serves /login and /verify-2fa
+    SECRET_STORE_BACKEND: str = os.getenv("SECRET_STORE_BACKEND", "mongo")
+
+    # Per-user results of /shipment/my and /account/me (see result_cache.py):
+    # 'memory' per worker, 'mongo' shared across workers, or 'off'
+    RESULT_CACHE_BACKEND: str = os.getenv("RESULT_CACHE_BACKEND", "memory")
+    RESULT_CACHE_MAX_ENTRIES: int = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 10000))
+    # Starting TTL of an entry; it doubles for keys that are only read and
+    # halves on every write, within the min and max
+    RESULT_CACHE_TTL_SECONDS: float = float(os.getenv("RESULT_CACHE_TTL_SECONDS", 60))
+    RESULT_CACHE_MIN_TTL_SECONDS: float = float(os.getenv("RESULT_CACHE_MIN_TTL_SECONDS", 5))
+    RESULT_CACHE_MAX_TTL_SECONDS: float = float(os.getenv("RESULT_CACHE_MAX_TTL_SECONDS", 600))
+
+    # Dependency checks behind /readyz (see health.py), run in the background
+    HEALTH_CHECK_INTERVAL_SECONDS: float = float(os.getenv("HEALTH_CHECK_INTERVAL_SECONDS", 5))
+    HEALTH_CHECK_TIMEOUT_SECONDS: float = float(os.getenv("HEALTH_CHECK_TIMEOUT_SECONDS", 2))
+
+    # Parquet archive of aged telemetry (see archive.py), read by /archive/*
+    ARCHIVE_DIR: str = os.getenv("ARCHIVE_DIR", "telemetry_archive")
+
+    # Lane summaries (see route_analytics.py) are rebuilt from the consumer's
+    # matrix snapshots at most this often
+    ROUTE_ANALYTICS_REFRESH_SECONDS: float = float(os.getenv("ROUTE_ANALYTICS_REFRESH_SECONDS", 30))
     
     @property
     def kafka_bootstrap_servers(self) -> List[str]:
-        return self.KAFKA_BOOTSTRAP_SERVERS.split(",")
+        return [server.strip() for server in self.KAFKA_BOOTSTRAP_SERVERS.split(",") if server.strip()]
+
+    @property
+    def admin_emails(self) -> List[str]:
+        return [email.strip() for email in self.ADMIN_EMAILS.split(",") if email.strip()]
 
     class Config:   
         env_file = ".env"
@@ -1,25 +1,24 @@
-import json
 import logging
 import signal
 import sys
-from kafka import KafkaConsumer
+from kafka import KafkaConsumer, ConsumerRebalanceListener
 from kafka.errors import KafkaError, NoBrokersAvailable
-from pymongo import MongoClient
 from pymongo.errors import ConnectionFailure, PyMongoError
-from time import sleep
+from time import sleep, monotonic
 import os
+import codec
+import wire_format
+from device_state import PartitionedDeviceState, MongoStateStore
+from route_analytics import PartitionedRouteMatrix
+from dedup import DedupIndex
+import telemetry_fields
+import metrics
+import mongo_clients
+from logging_setup import configure_logging
 
 
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('consumer.log')
-    ]
-)
+# Logging is configured in the entry point (see logging_setup.py)
 log_processor = logging.getLogger(__name__)
 
 # Configuration Constants
@@ -32,20 +31,77 @@ MONGO_CONNECTION_URI = os.environ.get('MONGODB_URI', 'mongodb+srv://jaisankarnb6
 
 MONGODB_DATABASE_NAME = 'scmlitedb'
 MONGODB_COLLECTION_NAME = 'device_stream_data'
+# Per-partition device state snapshots used for rebalance hand-off
+MONGODB_STATE_COLLECTION_NAME = 'device_state'
+# Per-partition origin-destination matrices (see route_analytics.py)
+MONGODB_ROUTE_MATRIX_COLLECTION_NAME = 'route_matrix'
+STATE_CHECKPOINT_SECONDS = int(os.environ.get('STATE_CHECKPOINT_SECONDS', 30))
+
+POLL_TIMEOUT_MS = 1000
+POLL_MAX_RECORDS = int(os.environ.get('POLL_MAX_RECORDS', 500))
+# Offsets are committed after processing, at most this often
+COMMIT_INTERVAL_SECONDS = float(os.environ.get('COMMIT_INTERVAL_SECONDS', 5))
+LAG_REFRESH_SECONDS = 15
+# Port of the /metrics listener (0 disables it)
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9102))
+# 'sync' (this module) or 'async' (aiokafka + Motor, see async_consumer.py)
+CONSUMER_MODE = os.environ.get('CONSUMER_MODE', 'sync')
+
+MESSAGES_TOTAL = metrics.counter(
+    "consumer_messages_total", "Records handled by the consumer", ["outcome"]
+)
+BATCH_SIZE = metrics.histogram(
+    "consumer_poll_batch_size", "Records returned per Kafka poll", buckets=metrics.SIZE_BUCKETS
+)
+KAFKA_COMMIT_SECONDS = metrics.histogram(
+    "consumer_kafka_commit_duration_seconds", "Offset commit latency", ["outcome"]
+)
+CONSUMER_LAG = metrics.gauge(
+    "consumer_lag_records", "Records between the consumer position and the log end", ["partition"]
+)
+
+class DeviceStateRebalanceListener(ConsumerRebalanceListener):
+    """Hands per-device state off between consumers when partitions move."""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def on_partitions_revoked(self, revoked):
+        self.pipeline._hand_off_partitions(revoked)
+
+    def on_partitions_assigned(self, assigned):
+        self.pipeline._take_over_partitions(assigned)
 
 class KafkaMongoDataPipeline:
-    def __init__(self):
-        self.kafka_message_consumer = None
-        self.mongo_database_client = None
+    def __init__(self, kafka_message_consumer=None, mongo_database_client=None):
+        """
+        Connects to Kafka and MongoDB. Already-built clients (e.g. in-memory
+        stand-ins used by the benchmarks) can be passed in instead.
+        """
+        self.kafka_message_consumer = kafka_message_consumer
+        self.mongo_database_client = mongo_database_client
         self.target_collection = None
+        self.device_state = None
+        self.route_matrix = None
+        # Drops records redelivered by producer retries and replays (see dedup.py)
+        self.dedup = DedupIndex()
+        self.last_checkpoint_time = monotonic()
+        self.last_commit_time = monotonic()
+        self.last_lag_refresh_time = 0.0
         self.is_running = True
         
         # Setup signal handlers for graceful shutdown
         signal.signal(signal.SIGINT, self._handle_shutdown_signal)
         signal.signal(signal.SIGTERM, self._handle_shutdown_signal)
         
-        self._initialize_kafka_consumer()
-        self._initialize_mongodb_connection()
+        if self.kafka_message_consumer is None:
+            self._initialize_kafka_consumer()
+        else:
+            self._subscribe_to_input_topic()
+        if self.mongo_database_client is None:
+            self._initialize_mongodb_connection()
+        else:
+            self._bind_mongodb_collections()
 
     def _initialize_kafka_consumer(self, maximum_retries=5, retry_interval_seconds=5):
         """Initialize Kafka consumer with retry logic."""
@@ -53,13 +109,13 @@ class KafkaMongoDataPipeline:
         while attempt_count < maximum_retries:
             try:
                 self.kafka_message_consumer = KafkaConsumer(
-                    KAFKA_INPUT_TOPIC,
                     bootstrap_servers=KAFKA_SERVER_ADDRESSES,
-                    value_deserializer=lambda x: self._safely_parse_json(x),
                     auto_offset_reset='earliest',
-                    enable_auto_commit=True,
+                    # Committed by the pipeline after records are stored
+                    enable_auto_commit=False,
                     group_id='shipment_consumer_group'
                 )
+                self._subscribe_to_input_topic()
                 log_processor.info("Successfully connected to Kafka")
                 return
             except NoBrokersAvailable:
@@ -73,23 +129,24 @@ class KafkaMongoDataPipeline:
                 log_processor.error(f"Error setting up Kafka consumer: {initialization_error}")
                 raise
 
+    def _subscribe_to_input_topic(self):
+        # The listener moves per-device state along with its partitions
+        self.kafka_message_consumer.subscribe(
+            [KAFKA_INPUT_TOPIC],
+            listener=DeviceStateRebalanceListener(self)
+        )
+
     def _initialize_mongodb_connection(self, maximum_retries=5, retry_interval_seconds=5):
         """Initialize MongoDB connection with retry logic."""
         attempt_count = 0
         while attempt_count < maximum_retries:
             try:
-                self.mongo_database_client = MongoClient(
-                    MONGO_CONNECTION_URI,
-                    serverSelectionTimeoutMS=5000,
-                    connectTimeoutMS=30000,
-                    socketTimeoutMS=None,
-                    connect=False,
-                    maxPoolsize=1
+                self.mongo_database_client = mongo_clients.create_client(
+                    MONGO_CONNECTION_URI, "consumer", connect=False
                 )
                 # Force connection to verify it works
                 self.mongo_database_client.server_info()
-                database_instance = self.mongo_database_client[MONGODB_DATABASE_NAME]
-                self.target_collection = database_instance[MONGODB_COLLECTION_NAME]
+                self._bind_mongodb_collections()
                 log_processor.info(f"Successfully connected to MongoDB. Database: {MONGODB_DATABASE_NAME}, Collection: {MONGODB_COLLECTION_NAME}")
                 return
             except ConnectionFailure as connection_error:
@@ -103,36 +160,149 @@ class KafkaMongoDataPipeline:
                 log_processor.error(f"Error setting up MongoDB: {initialization_error}")
                 raise
 
+    def _bind_mongodb_collections(self):
+        database_instance = self.mongo_database_client[MONGODB_DATABASE_NAME]
+        self.target_collection = database_instance[MONGODB_COLLECTION_NAME]
+        self.device_state = PartitionedDeviceState(
+            KAFKA_INPUT_TOPIC,
+            MongoStateStore(database_instance[MONGODB_STATE_COLLECTION_NAME], item_field='devices')
+        )
+        self.route_matrix = PartitionedRouteMatrix(
+            KAFKA_INPUT_TOPIC,
+            MongoStateStore(database_instance[MONGODB_ROUTE_MATRIX_COLLECTION_NAME])
+        )
+
     @staticmethod
-    def _safely_parse_json(json_bytes_data):
-        """Safely deserialize JSON string."""
+    def _safely_decode_message(incoming_message):
+        """Safely decode a record; records without a schema header are parsed as JSON."""
         try:
-            return json.loads(json_bytes_data)
-        except json.JSONDecodeError as json_error:
-            log_processor.warning(f"Invalid JSON received: {json_bytes_data}. Error: {json_error}")
+            return wire_format.decode_kafka_value(incoming_message.value, incoming_message.headers)
+        except codec.JSONDecodeError as json_error:
+            log_processor.warning(f"Invalid JSON received: {incoming_message.value}. Error: {json_error}")
+            return None
+        except wire_format.WireFormatError as format_error:
+            log_processor.warning(f"Invalid binary record received: {format_error}")
             return None
 
+    def _hand_off_partitions(self, revoked_partitions):
+        """Commit offsets and snapshot device state before partitions move away."""
+        partitions = [tp.partition for tp in revoked_partitions if tp.topic == KAFKA_INPUT_TOPIC]
+        self._commit_offsets(force=True)
+        try:
+            self.device_state.revoke(partitions)
+            self.route_matrix.revoke(partitions)
+            log_processor.info(f"Handed off device state for partitions {partitions}")
+        except PyMongoError as mongo_operation_error:
+            log_processor.error(f"Failed to snapshot device state for partitions {partitions}: {mongo_operation_error}")
+
+    def _take_over_partitions(self, assigned_partitions):
+        """Restore the device state snapshots of newly assigned partitions."""
+        partitions = [tp.partition for tp in assigned_partitions if tp.topic == KAFKA_INPUT_TOPIC]
+        try:
+            self.device_state.assign(partitions)
+            self.route_matrix.assign(partitions)
+            log_processor.info(f"Restored device state for partitions {partitions}")
+        except PyMongoError as mongo_operation_error:
+            log_processor.error(f"Failed to restore device state for partitions {partitions}: {mongo_operation_error}")
+
+    def _commit_offsets(self, force=False):
+        """Commit the positions of everything processed so far."""
+        if not force and monotonic() - self.last_commit_time < COMMIT_INTERVAL_SECONDS:
+            return
+        commit_started = monotonic()
+        try:
+            self.kafka_message_consumer.commit()
+            KAFKA_COMMIT_SECONDS.observe(monotonic() - commit_started, outcome="ok")
+        except KafkaError as commit_error:
+            KAFKA_COMMIT_SECONDS.observe(monotonic() - commit_started, outcome="error")
+            log_processor.warning(f"Offset commit failed: {commit_error}")
+        self.last_commit_time = monotonic()
+
+    def _refresh_lag_metrics(self):
+        """Publish per-partition consumer lag every LAG_REFRESH_SECONDS."""
+        if monotonic() - self.last_lag_refresh_time < LAG_REFRESH_SECONDS:
+            return
+        self.last_lag_refresh_time = monotonic()
+        try:
+            assigned = list(self.kafka_message_consumer.assignment())
+            if not assigned:
+                return
+            end_offsets = self.kafka_message_consumer.end_offsets(assigned)
+            for tp in assigned:
+                lag = end_offsets[tp] - self.kafka_message_consumer.position(tp)
+                CONSUMER_LAG.set(max(lag, 0), partition=tp.partition)
+        except KafkaError as lag_error:
+            log_processor.debug(f"Could not refresh consumer lag: {lag_error}")
+
+    def _checkpoint_device_state(self, force=False):
+        """Periodically snapshot device state and route matrices so a crash loses at most one interval."""
+        if self.device_state is None:
+            return
+        if not force and monotonic() - self.last_checkpoint_time < STATE_CHECKPOINT_SECONDS:
+            return
+        try:
+            self.device_state.checkpoint()
+            self.route_matrix.checkpoint()
+        except PyMongoError as mongo_operation_error:
+            log_processor.error(f"Device state checkpoint failed: {mongo_operation_error}")
+        self.last_checkpoint_time = monotonic()
+
     def _process_message_and_store(self, incoming_message):
         """Process a single message and insert into MongoDB."""
         if not incoming_message.value:
             log_processor.warning("Received empty or invalid message")
             return
+        if self.dedup.seen(incoming_message.key, incoming_message.timestamp, incoming_message.value):
+            MESSAGES_TOTAL.inc(outcome="duplicate")
+            return
 
+        stored = False
         try:
-            # Data is the deserialized JSON dictionary
-            message_data = incoming_message.value
+            # Data is the decoded reading dictionary
+            message_data = self._safely_decode_message(incoming_message)
+            if message_data is None:
+                MESSAGES_TOTAL.inc(outcome="invalid")
+                return
             if not isinstance(message_data, dict):
+                MESSAGES_TOTAL.inc(outcome="invalid")
                 log_processor.warning(f"Unexpected message format: {message_data}")
                 return
                 
-            # Insert into MongoDB
-            insert_result = self.target_collection.insert_one(message_data)
-            log_processor.info(f"Inserted document with ID: {insert_result.inserted_id}")
+            # Insert into MongoDB, under short field names if configured
+            insert_result = self.target_collection.insert_one(telemetry_fields.to_stored(message_data))
+            stored = True
+            MESSAGES_TOTAL.inc(outcome="stored")
+            if log_processor.isEnabledFor(logging.DEBUG):
+                log_processor.debug(
+                    "Inserted document",
+                    extra={"sample": "insert", "document_id": str(insert_result.inserted_id), "partition": incoming_message.partition}
+                )
+
+            # Kafka timestamps are in milliseconds
+            event_time = incoming_message.timestamp / 1000.0
+            self.device_state.apply(
+                incoming_message.partition,
+                incoming_message.offset,
+                message_data,
+                event_time
+            )
+            self.route_matrix.apply(
+                incoming_message.partition,
+                incoming_message.offset,
+                message_data,
+                event_time
+            )
             
         except PyMongoError as mongo_operation_error:
+            MESSAGES_TOTAL.inc(outcome="failed")
             log_processor.error(f"MongoDB error during insertion: {mongo_operation_error}")
         except Exception as unexpected_error:
+            MESSAGES_TOTAL.inc(outcome="failed")
             log_processor.error(f"Error processing message: {unexpected_error}")
+        finally:
+            if not stored:
+                # Not written, so a redelivery must not be dropped as a duplicate
+                self.dedup.forget(incoming_message.key, incoming_message.timestamp, incoming_message.value)
 
     def _handle_shutdown_signal(self, signal_number, frame):
         """Handle shutdown signals."""
@@ -143,12 +313,20 @@ class KafkaMongoDataPipeline:
 
     def cleanup_connections(self):
         """Close all connections."""
+        if self.device_state is not None and self.mongo_database_client:
+            self._checkpoint_device_state(force=True)
+            self.device_state = None
+            self.route_matrix = None
+
         if self.kafka_message_consumer:
+            self._commit_offsets(force=True)
             try:
                 self.kafka_message_consumer.close()
                 log_processor.info("Kafka consumer closed")
             except Exception as kafka_close_error:
                 log_processor.error(f"Error closing Kafka consumer: {kafka_close_error}")
+            # Cleanup runs from both the signal handler and the pipeline loop
+            self.kafka_message_consumer = None
         
         if self.mongo_database_client:
             try:
@@ -162,12 +340,22 @@ class KafkaMongoDataPipeline:
         log_processor.info("Starting Kafka consumer...")
         
         try:
-            for message in self.kafka_message_consumer:
-                if not self.is_running:
-                    break
-                    
-                log_processor.debug(f"Received message: {message.value}")
-                self._process_message_and_store(message)
+            while self.is_running:
+                batches = self.kafka_message_consumer.poll(
+                    timeout_ms=POLL_TIMEOUT_MS,
+                    max_records=POLL_MAX_RECORDS
+                )
+                record_count = sum(len(records) for records in batches.values())
+                if record_count:
+                    BATCH_SIZE.observe(record_count)
+
+                for records in batches.values():
+                    for message in records:
+                        self._process_message_and_store(message)
+
+                self._commit_offsets()
+                self._checkpoint_device_state()
+                self._refresh_lag_metrics()
                 
         except KafkaError as kafka_runtime_error:
             log_processor.error(f"Kafka runtime error: {kafka_runtime_error}")
@@ -177,6 +365,12 @@ class KafkaMongoDataPipeline:
             self.cleanup_connections()
 
 def run_main_application():
+    configure_logging("consumer", log_file='consumer.log')
+    metrics.start_http_server(METRICS_PORT)
+    if CONSUMER_MODE == 'async':
+        import async_consumer
+        async_consumer.run()
+        return
     application_instance = None
     while True:
         try:
@@ -1,50 +1,108 @@
 """
 Database connection and collection management.
 """
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure
+import threading
+
+import pymongo
+import mongo_clients
 from config import settings
+from profiling import profiler, SlowQueryListener
 
 # Collections
 USERS_COLLECTION = "users"
 SHIPMENT_DATA_COLLECTION = "shipment_data"
 DEVICE_STREAM_DATA_COLLECTION = "device_stream_data"
+RATE_LIMITS_COLLECTION = "rate_limits"
+AUTH_SECRETS_COLLECTION = "auth_secrets"
+RESULT_CACHE_COLLECTION = "result_cache"
+# Which web worker reads the live feed (see live_feed.py)
+LIVE_FEED_LEASES_COLLECTION = "live_feed_leases"
+# Written by the consumer (see route_analytics.py)
+ROUTE_MATRIX_COLLECTION = "route_matrix"
 
 class Database:
+    """
+    Holds the process-wide MongoClient (the 'web' profile of
+    mongo_clients.py). Nothing connects at import: the client is created by
+    connect() (called from the web app's lifespan) or on first use. Creating
+    a MongoClient does not block; servers are discovered in the background
+    and ping() is left to the readiness check.
+    """
     _instance = None
     _client = None
     _db = None
+    _lock = threading.Lock()
     
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(Database, cls).__new__(cls)
-            cls._initialize()
         return cls._instance
     
     @classmethod
-    def _initialize(cls):
-        try:
-            cls._client = MongoClient(settings.MONGODB_URI)
+    def connect(cls):
+        with cls._lock:
+            if cls._client is not None:
+                return
+            if not settings.MONGODB_URI or not settings.DATABASE_NAME:
+                raise RuntimeError("MONGODB_URI and DATABASE_NAME must be set")
+            event_listeners = []
+            if settings.PROFILING_ENABLED:
+                event_listeners.append(SlowQueryListener(profiler))
+                profiler.explain = cls._explain
+            cls._client = mongo_clients.create_client(settings.MONGODB_URI, "web", event_listeners)
             cls._db = cls._client[settings.DATABASE_NAME]
-            # Test the connection
+
+    @classmethod
+    def ping(cls, timeout: float):
+        """Round trip to the server, bounded by `timeout` seconds; raises on failure."""
+        cls.connect()
+        with pymongo.timeout(timeout):
             cls._client.admin.command('ping')
-            print("Successfully connected to MongoDB.")
-        except ConnectionFailure as e:
-            print(f"Failed to connect to MongoDB: {e}")
-            raise
     
+    @classmethod
+    def _explain(cls, database_name: str, command: dict):
+        """Query plan for a captured command (used for slow-query reports)."""
+        return cls._client[database_name].command({"explain": command, "verbosity": "queryPlanner"})
+
     @classmethod
     def get_collection(cls, collection_name: str):
         if cls._db is None:
-            raise RuntimeError("Database not initialized. Call Database() first.")
+            cls.connect()
         return cls._db[collection_name]
+
+    @classmethod
+    def get_analytics_collection(cls, collection_name: str):
+        """The collection read with the analytics read preference (may lag the primary)."""
+        return mongo_clients.analytics(cls.get_collection(collection_name))
+
+    @classmethod
+    def collection(cls, collection_name: str, analytics: bool = False) -> "LazyCollection":
+        """A handle that is safe to create at import time; it connects on first use."""
+        return LazyCollection(collection_name, analytics)
     
     @classmethod
     def close_connection(cls):
-        if cls._client:
-            cls._client.close()
-            cls._client = None
-            cls._db = None
+        with cls._lock:
+            if cls._client:
+                cls._client.close()
+                cls._client = None
+                cls._db = None
+
+
+class LazyCollection:
+    """Stands in for a pymongo Collection until the first attribute access."""
+
+    def __init__(self, name: str, analytics: bool = False):
+        self.name = name
+        self.analytics = analytics
+
+    def __getattr__(self, attribute):
+        if self.analytics:
+            return getattr(Database.get_analytics_collection(self.name), attribute)
+        return getattr(Database.get_collection(self.name), attribute)
+
+    def __repr__(self):
+        return f"LazyCollection({self.name!r})"
+
 
-# Initialize the database connection when this module is imported
-db = Database()
\ No newline at end of file
+db = Database()
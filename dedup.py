@@ -0,0 +1,97 @@
+"""
+Consumer-side duplicate suppression.
+
+The producer delivers at least once: a batch that fails part-way is sent
+again as a whole, and a consumer restarted after a rebalance re-reads the
+records since the last commit. Either way the same record arrives more than
+once, with the same key (the Device_ID), value and timestamp: the producer
+stamps each record when it receives the reading and keeps that timestamp
+through retries and spool replays.
+
+DedupIndex remembers a 64-bit hash of (key, timestamp, value) for every
+record seen in the last `window_seconds`, up to `max_entries` hashes. A
+lookup is one dict probe and expiry pops from the front, so the cost per
+record is constant and memory is fixed. Two distinct readings only collide
+if one device sent byte-identical values in the same millisecond.
+
+A record only counts as seen once it is stored: callers forget() a record
+whose decode or insert failed, so a later delivery of it is accepted
+rather than dropped as a duplicate of a reading that was never written.
+
+The index is per process and in memory: duplicates that straddle a restart
+are not caught.
+"""
+import hashlib
+import os
+import struct
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import metrics
+
+# How long a record's hash is remembered, in seconds of consumer time
+DEDUP_WINDOW_SECONDS = float(os.environ.get('DEDUP_WINDOW_SECONDS', 600))
+# Upper bound on remembered hashes (about 100 bytes each)
+DEDUP_MAX_ENTRIES = int(os.environ.get('DEDUP_MAX_ENTRIES', 200000))
+
+_TIMESTAMP = struct.Struct("<q")
+
+DEDUP_ENTRIES = metrics.gauge("consumer_dedup_entries", "Record hashes held by the dedup index")
+DEDUP_EVICTIONS_TOTAL = metrics.counter(
+    "consumer_dedup_evictions_total", "Hashes dropped from the dedup index", ["reason"]
+)
+
+
+def record_hash(key: Optional[bytes], timestamp: int, value: bytes) -> int:
+    digest = hashlib.blake2b(key or b"", digest_size=8)
+    digest.update(b"\0")
+    digest.update(_TIMESTAMP.pack(timestamp))
+    digest.update(value)
+    return int.from_bytes(digest.digest(), "little")
+
+
+class DedupIndex:
+    """Hashes of recently seen records, oldest first."""
+
+    def __init__(self, window_seconds: float = DEDUP_WINDOW_SECONDS, max_entries: int = DEDUP_MAX_ENTRIES,
+                 clock=time.monotonic):
+        self.window_seconds = window_seconds
+        self.max_entries = max_entries
+        self.clock = clock
+        # hash -> time first seen; insertion order is time order
+        self._seen: "OrderedDict[int, float]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def seen(self, key: Optional[bytes], timestamp: int, value: bytes) -> bool:
+        """True if the record was already seen in the window; otherwise remember it."""
+        now = self.clock()
+        self._expire(now)
+        digest = record_hash(key, timestamp, value)
+        if digest in self._seen:
+            return True
+        self._seen[digest] = now
+        if len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+            DEDUP_EVICTIONS_TOTAL.inc(reason="capacity")
+        DEDUP_ENTRIES.set(len(self._seen))
+        return False
+
+    def forget(self, key: Optional[bytes], timestamp: int, value: bytes):
+        """Undo seen() for a record that was not stored."""
+        if self._seen.pop(record_hash(key, timestamp, value), None) is not None:
+            DEDUP_ENTRIES.set(len(self._seen))
+
+    def _expire(self, now: float):
+        cutoff = now - self.window_seconds
+        expired = 0
+        while self._seen:
+            oldest = next(iter(self._seen.values()))
+            if oldest >= cutoff:
+                break
+            self._seen.popitem(last=False)
+            expired += 1
+        if expired:
+            DEDUP_EVICTIONS_TOTAL.inc(expired, reason="expired")
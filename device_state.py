@@ -0,0 +1,285 @@
+"""
+Per-device state kept by the consumer, partitioned the same way as Kafka.
+
+The producer keys every record by Device_ID, so all readings of one device
+land on one partition and arrive in order. The consumer keeps the state of
+each device (latest reading, rollups, alert window) under the partition it
+came from. When a partition is revoked its state is snapshotted and handed
+off; the consumer that is assigned the partition next restores the snapshot
+and skips records it already covers.
+
+Readings can arrive late, e.g. replayed from a producer's spool after an
+outage while other producers kept sending to the partition. Each partition
+keeps a watermark: its newest event time minus ALLOWED_LATENESS_SECONDS.
+Counts, sums, minima and the latest reading do not depend on arrival order,
+so every reading is merged into them. The alert window does: readings at or
+after the watermark are inserted at their place in time, readings behind it
+are left out of the window and counted as late.
+"""
+import bisect
+import os
+import time
+import uuid
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional
+
+import metrics
+
+# Readings hotter than this count towards the alert window
+TEMPERATURE_ALERT_THRESHOLD = float(os.environ.get('TEMPERATURE_ALERT_THRESHOLD', 35.0))
+# Length of the sliding alert window in seconds
+ALERT_WINDOW_SECONDS = int(os.environ.get('ALERT_WINDOW_SECONDS', 300))
+# A device is alerting once this many hot readings fall inside the window
+ALERT_MIN_READINGS = int(os.environ.get('ALERT_MIN_READINGS', 3))
+# How far behind the newest reading of its partition a reading may be and
+# still be merged into the alert window
+ALLOWED_LATENESS_SECONDS = float(os.environ.get('ALLOWED_LATENESS_SECONDS', 60))
+# Device documents written per insert_many when saving a snapshot
+SNAPSHOT_BATCH_SIZE = int(os.environ.get('SNAPSHOT_BATCH_SIZE', 1000))
+
+LATE_READINGS_TOTAL = metrics.counter(
+    "consumer_late_readings_total", "Readings behind their partition's watermark, left out of alert windows"
+)
+READING_LATENESS_SECONDS = metrics.histogram(
+    "consumer_reading_lateness_seconds", "How far out-of-order readings trail the newest reading of their partition",
+    buckets=(0.1, 1, 5, 15, 60, 300, 900, 3600, 21600)
+)
+
+
+class DeviceState:
+    """Latest value, running rollups and alert window for one device."""
+
+    def __init__(self):
+        self.latest: Optional[Dict[str, Any]] = None
+        self.latest_event_time = 0.0
+        self.count = 0
+        self.temperature_sum = 0.0
+        self.temperature_min: Optional[float] = None
+        self.temperature_max: Optional[float] = None
+        self.battery_sum = 0.0
+        self.battery_min: Optional[float] = None
+        self.hot_readings = deque()
+
+    def apply(self, reading: Dict[str, Any], event_time: float, windowed: bool = True):
+        """Fold one reading into the state; `windowed` False keeps it out of the alert window."""
+        if event_time >= self.latest_event_time:
+            self.latest = reading
+            self.latest_event_time = event_time
+        self.count += 1
+
+        temperature = reading.get("First_Sensor_temperature")
+        if isinstance(temperature, (int, float)):
+            self.temperature_sum += temperature
+            self.temperature_min = temperature if self.temperature_min is None else min(self.temperature_min, temperature)
+            self.temperature_max = temperature if self.temperature_max is None else max(self.temperature_max, temperature)
+            if windowed and temperature > TEMPERATURE_ALERT_THRESHOLD:
+                if self.hot_readings and event_time < self.hot_readings[-1]:
+                    # Late but within the allowed lateness: keep the window sorted
+                    bisect.insort(self.hot_readings, event_time)
+                else:
+                    self.hot_readings.append(event_time)
+
+        battery = reading.get("Battery_Level")
+        if isinstance(battery, (int, float)):
+            self.battery_sum += battery
+            self.battery_min = battery if self.battery_min is None else min(self.battery_min, battery)
+
+        self._expire_alert_window(self.latest_event_time)
+
+    def _expire_alert_window(self, now: float):
+        cutoff = now - ALERT_WINDOW_SECONDS
+        while self.hot_readings and self.hot_readings[0] < cutoff:
+            self.hot_readings.popleft()
+
+    @property
+    def alerting(self) -> bool:
+        return len(self.hot_readings) >= ALERT_MIN_READINGS
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "latest": self.latest,
+            "latest_event_time": self.latest_event_time,
+            "count": self.count,
+            "temperature_sum": self.temperature_sum,
+            "temperature_min": self.temperature_min,
+            "temperature_max": self.temperature_max,
+            "battery_sum": self.battery_sum,
+            "battery_min": self.battery_min,
+            "hot_readings": list(self.hot_readings),
+            "alerting": self.alerting,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "DeviceState":
+        state = cls()
+        state.latest = data.get("latest")
+        state.latest_event_time = data.get("latest_event_time", 0.0)
+        state.count = data.get("count", 0)
+        state.temperature_sum = data.get("temperature_sum", 0.0)
+        state.temperature_min = data.get("temperature_min")
+        state.temperature_max = data.get("temperature_max")
+        state.battery_sum = data.get("battery_sum", 0.0)
+        state.battery_min = data.get("battery_min")
+        state.hot_readings = deque(data.get("hot_readings", []))
+        return state
+
+
+class PartitionState:
+    """Device states for one assigned partition plus the last applied offset."""
+
+    def __init__(self, partition: int):
+        self.partition = partition
+        self.offset = -1
+        # Newest event time seen on the partition; the watermark trails it
+        self.max_event_time = 0.0
+        self.devices: Dict[str, DeviceState] = {}
+
+    @property
+    def watermark(self) -> float:
+        return self.max_event_time - ALLOWED_LATENESS_SECONDS
+
+    def apply(self, offset: int, reading: Dict[str, Any], event_time: float) -> bool:
+        """Apply a record unless an earlier owner already did. Returns True if applied."""
+        if offset <= self.offset:
+            return False
+        windowed = event_time >= self.watermark
+        if event_time < self.max_event_time:
+            READING_LATENESS_SECONDS.observe(self.max_event_time - event_time)
+            if not windowed:
+                LATE_READINGS_TOTAL.inc()
+        else:
+            self.max_event_time = event_time
+        device_id = reading.get("Device_ID")
+        if device_id is not None:
+            key = str(device_id)
+            device = self.devices.get(key)
+            if device is None:
+                device = self.devices[key] = DeviceState()
+            device.apply(reading, event_time, windowed)
+        self.offset = offset
+        return True
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "partition": self.partition,
+            "offset": self.offset,
+            "max_event_time": self.max_event_time,
+            "devices": {key: device.to_dict() for key, device in self.devices.items()},
+            "updated_at": time.time(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "PartitionState":
+        state = cls(data["partition"])
+        state.offset = data.get("offset", -1)
+        state.max_event_time = data.get("max_event_time", 0.0)
+        state.devices = {key: DeviceState.from_dict(value) for key, value in data.get("devices", {}).items()}
+        return state
+
+
+class PartitionedDeviceState:
+    """
+    All per-device state owned by this consumer, keyed by partition.
+
+    Snapshots are stored through `store`, any object with
+    `load(topic, partition)` and `save(topic, snapshot)` methods.
+    """
+
+    def __init__(self, topic: str, store):
+        self.topic = topic
+        self.store = store
+        self.partitions: Dict[int, PartitionState] = {}
+
+    def apply(self, partition: int, offset: int, reading: Dict[str, Any], event_time: float) -> bool:
+        state = self.partitions.get(partition)
+        if state is None:
+            # Records can only arrive for assigned partitions; be lenient anyway
+            state = self.partitions[partition] = PartitionState(partition)
+        return state.apply(offset, reading, event_time)
+
+    def device(self, device_id) -> Optional[DeviceState]:
+        key = str(device_id)
+        for state in self.partitions.values():
+            if key in state.devices:
+                return state.devices[key]
+        return None
+
+    def assign(self, partitions: Iterable[int]):
+        """Restore the hand-off snapshot of each newly assigned partition."""
+        for partition in partitions:
+            snapshot = self.store.load(self.topic, partition)
+            self.partitions[partition] = (
+                PartitionState.from_dict(snapshot) if snapshot else PartitionState(partition)
+            )
+
+    def revoke(self, partitions: Iterable[int]):
+        """Snapshot and drop the state of revoked partitions."""
+        for partition in partitions:
+            state = self.partitions.pop(partition, None)
+            if state is not None:
+                self.store.save(self.topic, state.to_dict())
+
+    def snapshots(self) -> List[Dict[str, Any]]:
+        """Snapshots of every owned partition, e.g. to save them from another thread."""
+        return [state.to_dict() for state in self.partitions.values()]
+
+    def checkpoint(self):
+        """Snapshot every owned partition without dropping it."""
+        for snapshot in self.snapshots():
+            self.store.save(self.topic, snapshot)
+
+
+class MongoStateStore:
+    """
+    Keeps one snapshot document per topic partition in a Mongo collection.
+
+    With `item_field` ("devices" for device state) that mapping is stored as
+    one document per entry instead, so a snapshot is not bound by the 16 MB
+    document limit. Entry documents carry the generation of their snapshot
+    and the partition document, written last, names the current one: a save
+    interrupted half-way leaves the previous snapshot readable.
+    """
+
+    def __init__(self, collection, item_field: Optional[str] = None):
+        self.collection = collection
+        self.item_field = item_field
+        self._indexed = False
+
+    @staticmethod
+    def _key(topic: str, partition: int) -> str:
+        return f"{topic}:{partition}"
+
+    def _ensure_index(self):
+        if not self._indexed:
+            self.collection.create_index([("snapshot", 1), ("generation", 1)])
+            self._indexed = True
+
+    def load(self, topic: str, partition: int) -> Optional[Dict[str, Any]]:
+        key = self._key(topic, partition)
+        snapshot = self.collection.find_one({"_id": key}, {"_id": 0})
+        if snapshot is None or not self.item_field:
+            return snapshot
+        # Snapshots saved before entry documents keep the mapping inline
+        generation = snapshot.pop("generation", None)
+        if generation is not None:
+            entries = self.collection.find({"snapshot": key, "generation": generation}, {"item": 1, "value": 1})
+            snapshot[self.item_field] = {entry["item"]: entry["value"] for entry in entries}
+        return snapshot
+
+    def save(self, topic: str, snapshot: Dict[str, Any]):
+        key = self._key(topic, snapshot["partition"])
+        if self.item_field:
+            self._ensure_index()
+            snapshot = dict(snapshot)
+            items = list(snapshot.pop(self.item_field, {}).items())
+            generation = uuid.uuid4().hex
+            for start in range(0, len(items), SNAPSHOT_BATCH_SIZE):
+                self.collection.insert_many([
+                    {"_id": f"{key}:{generation}:{item}", "snapshot": key,
+                     "generation": generation, "item": item, "value": value}
+                    for item, value in items[start:start + SNAPSHOT_BATCH_SIZE]
+                ], ordered=False)
+            snapshot["generation"] = generation
+        self.collection.replace_one({"_id": key}, snapshot, upsert=True)
+        if self.item_field:
+            self.collection.delete_many({"snapshot": key, "generation": {"$ne": generation}})
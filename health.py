@@ -0,0 +1,140 @@
+"""
+Liveness and readiness for the web app.
+
+/healthz answers from memory: if the event loop can run the handler, the
+process is alive. /readyz reports the result of dependency checks (Mongo,
+Kafka, SMTP) that ReadinessMonitor runs in the background every few seconds,
+so a probe never waits on a slow or unreachable dependency and a burst of
+probes never multiplies the load on one.
+
+Only required checks decide readiness. The web app serves nothing without
+Mongo, but it keeps working when Kafka or SMTP are down (data stops updating,
+emails fail), so those are reported without taking the instance out of the
+load balancer.
+"""
+import asyncio
+import logging
+import socket
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEPENDENCY_UP = metrics.gauge(
+    "dependency_up", "1 if the last readiness check of the dependency passed", ["dependency"]
+)
+STARTUP_SECONDS = metrics.gauge(
+    "app_startup_seconds", "Time spent starting the web app, by phase", ["phase"]
+)
+
+
+class Check:
+    def __init__(self, name: str, probe: Callable[[float], None], required: bool = True):
+        # probe(timeout) raises on failure; it runs in a worker thread
+        self.name = name
+        self.probe = probe
+        self.required = required
+        self.ok: Optional[bool] = None
+        self.error: Optional[str] = None
+        self.latency_ms: Optional[float] = None
+        self.checked_at: Optional[float] = None
+
+    def status(self, now: float) -> dict:
+        return {
+            "status": "pending" if self.ok is None else ("ok" if self.ok else "failing"),
+            "required": self.required,
+            "latency_ms": self.latency_ms,
+            "age_seconds": None if self.checked_at is None else round(now - self.checked_at, 3),
+            "error": self.error,
+        }
+
+
+class ReadinessMonitor:
+    def __init__(self, interval: float, timeout: float):
+        self.interval = interval
+        self.timeout = timeout
+        self.checks: List[Check] = []
+        self.started_at = time.time()
+        self.startup: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, name: str, probe: Callable[[float], None], required: bool = True):
+        self.checks.append(Check(name, probe, required))
+
+    def record_startup(self, phase: str, seconds: float):
+        self.startup[phase] = round(seconds, 4)
+        STARTUP_SECONDS.set(seconds, phase=phase)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.gather(*(self._check(check) for check in self.checks))
+            await asyncio.sleep(self.interval)
+
+    async def _check(self, check: Check):
+        started = time.perf_counter()
+        try:
+            # The probe bounds itself by `timeout`; wait_for is the backstop
+            await asyncio.wait_for(asyncio.to_thread(check.probe, self.timeout), self.timeout + 1)
+            ok, error = True, None
+        except asyncio.TimeoutError:
+            ok, error = False, f"timed out after {self.timeout}s"
+        except Exception as e:
+            ok, error = False, f"{type(e).__name__}: {e}"
+        if ok != check.ok:
+            log = logger.info if ok else logger.warning
+            log(f"Dependency {check.name} is {'up' if ok else 'down'}" + (f": {error}" if error else ""))
+        check.ok, check.error = ok, error
+        check.latency_ms = round((time.perf_counter() - started) * 1000, 2)
+        check.checked_at = time.time()
+        DEPENDENCY_UP.set(1 if ok else 0, dependency=check.name)
+
+    def ready(self) -> bool:
+        return all(check.ok for check in self.checks if check.required)
+
+    def report(self) -> dict:
+        now = time.time()
+        return {
+            "ready": self.ready(),
+            "uptime_seconds": round(now - self.started_at, 3),
+            "startup_seconds": self.startup,
+            "checks": {check.name: check.status(now) for check in self.checks},
+        }
+
+
+def tcp_probe(addresses: Callable[[], List[Tuple[str, int]]]) -> Callable[[float], None]:
+    """A probe that passes if any of the addresses accepts a TCP connection."""
+    def probe(timeout: float):
+        targets = addresses()
+        if not targets:
+            raise RuntimeError("not configured")
+        errors = []
+        for host, port in targets:
+            try:
+                socket.create_connection((host, port), timeout=timeout).close()
+                return
+            except OSError as e:
+                errors.append(f"{host}:{port} {e}")
+        raise ConnectionError("; ".join(errors))
+    return probe
+
+
+def parse_host_port(address: str, default_port: int) -> Tuple[str, int]:
+    host, _, port = address.strip().rpartition(":")
+    if not host:
+        return port, default_port
+    return host, int(port)
@@ -0,0 +1,361 @@
+"""
+Live device readings for /ws/device-data.
+
+While any web worker holds a subscribed WebSocket, new readings are read
+from the device stream collection once per batch interval
+(WS_BATCH_INTERVAL_MS, 250 ms by default). Each interval produces at most
+one frame per client for every FEED_PUBLISH_DEVICES changed devices.
+Frames carry per-device state, not readings: a device that sent twenty
+readings in an interval appears once, with only the fields that changed
+since the previous frame. Frame size therefore follows the number of
+devices, not the event rate. A frame is encoded once for every client
+with the same device filter.
+
+A tick reads every reading after its cursor, oldest first, in pages of
+FEED_MAX_READINGS. ObjectIds come from the writers, so a smaller _id can be
+committed after a larger one was read: each tick also lists the _ids of
+the lookback window before the cursor (SYNC_LOOKBACK_SECONDS) and reads the
+ones it has not seen. A late reading older than a device's state is not
+applied.
+
+Server -> client (JSON text frames):
+
+    {"type": "snapshot", "devices": {"1150": {"Device_ID": 1150, "Battery_Level": 3.7, ..., "timestamp": 1792431081}}}
+    {"type": "delta", "devices": {"1150": {"Battery_Level": 3.6, "timestamp": 1792431082}}}
+
+Client -> server (the first snapshot follows the ?devices=1150,1152 query
+parameter, all devices without it):
+
+    {"devices": [1150, 1152]}   follow only these devices (null or [] for all);
+                                answered with a snapshot
+
+A client keeps the snapshot's devices and merges each delta's fields into
+them. Delta fields are absolute values, so applying one twice is harmless.
+Readings from the load generator (server.py --mode load) also carry Seq and
+Sent_At; these are passed through, so a benchmark can tell which reading a
+frame carried (see benchmarks/pipeline_bench.py).
+
+With several workers or replicas (WS_BACKPLANE=broker) only one worker
+reads the collection: the holder of the feed lease, a Mongo document it
+renews every FEED_LEASE_SECONDS / 2. It publishes each tick's changes on
+FEED_CHANNEL of the backplane (see backplane.py), and every worker with
+clients, the reader included, merges them into its device table and sends
+the frames to its own clients. The reader releases the lease when its last
+client leaves and the lease expires when the reader dies; either way
+another worker with clients takes over from the cursor carried in the last
+publication. A single worker uses the in-process backplane and always holds
+the lease.
+
+Compression is negotiated by the server (uvicorn --ws-per-message-deflate,
+on by default). Repeated field names and device ids across frames compress
+well under the shared deflate context.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, FrozenSet, Iterable, List, Optional
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+import codec
+import metrics
+import telemetry_fields
+from backplane import Backplane, InProcessBackplane
+
+logger = logging.getLogger(__name__)
+
+FEED_FIELDS = ("Device_ID", "Battery_Level", "First_Sensor_temperature", "Route_From", "Route_To")
+# Only in frames when the reading has them
+TRACE_FIELDS = ("Seq", "Sent_At")
+# Readings per query when paging through a tick's readings
+FEED_MAX_READINGS = 5000
+# How far before the cursor a tick looks for readings committed late
+FEED_LOOKBACK_SECONDS = 2.0
+# Backplane channel carrying every tick's changes to the workers
+FEED_CHANNEL = "ws:feed"
+# Devices per backplane message; larger ticks go out as several messages
+# (and frames)
+FEED_PUBLISH_DEVICES = 2000
+FEED_LEASE_NAME = "live_feed"
+FEED_LEASE_SECONDS = 5.0
+
+WEBSOCKET_FRAMES_TOTAL = metrics.counter(
+    "websocket_frames_total", "Live feed frames sent to WebSocket clients", ["type"]
+)
+WEBSOCKET_FRAME_BYTES = metrics.histogram(
+    "websocket_frame_bytes", "Size of live feed frames before compression", ["type"],
+    buckets=(64, 256, 1024, 4096, 16384, 65536, 262144),
+)
+LIVE_FEED_READINGS_TOTAL = metrics.counter(
+    "live_feed_readings_total", "Readings read by the live feed, by what became of them", ["outcome"]
+)
+
+# Called with (client_ids, text frame, time the tick started)
+Sender = Callable[[Iterable[str], str, float], Awaitable[None]]
+
+
+# ------------------ READER LEASE ------------------
+
+class LocalLease:
+    """Single worker: it always reads the feed."""
+
+    def acquire(self) -> bool:
+        return True
+
+    def release(self):
+        pass
+
+
+class MongoLease:
+    """
+    One reader of the feed across workers. The holder renews the lease
+    document; another worker can only take it once released or expired.
+    """
+
+    def __init__(self, collection, name: str = FEED_LEASE_NAME, seconds: float = FEED_LEASE_SECONDS):
+        self.collection = collection
+        self.name = name
+        self.seconds = seconds
+        self.owner = uuid.uuid4().hex
+
+    def acquire(self) -> bool:
+        """Take or renew the lease; False while another worker holds it."""
+        now = datetime.now(timezone.utc)
+        try:
+            self.collection.update_one(
+                {"_id": self.name, "$or": [{"owner": self.owner}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": self.owner, "expires_at": now + timedelta(seconds=self.seconds)}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # The upsert found a lease held by someone else
+            return False
+        return True
+
+    def release(self):
+        self.collection.delete_one({"_id": self.name, "owner": self.owner})
+
+
+def create_feed_lease(kind: str, collection=None):
+    """'local' when one worker serves the feed, 'mongo' to elect one reader among several."""
+    if kind == "local":
+        return LocalLease()
+    if kind == "mongo":
+        return MongoLease(collection)
+    raise ValueError(f"Unknown feed lease '{kind}' (expected 'local' or 'mongo')")
+
+
+class LiveFeed:
+    """Per-device state of this worker's live feed, and the clients following it."""
+
+    def __init__(self, collection, send: Sender, interval_seconds: float,
+                 backplane: Optional[Backplane] = None, lease=None,
+                 lookback_seconds: float = FEED_LOOKBACK_SECONDS, max_readings: int = FEED_MAX_READINGS):
+        self.collection = collection
+        self.send = send
+        self.interval_seconds = interval_seconds
+        self.backplane = backplane or InProcessBackplane()
+        self.lease = lease or LocalLease()
+        self.lookback_seconds = lookback_seconds
+        self.max_readings = max_readings
+        # client_id -> followed devices (None: all)
+        self.subscriptions: Dict[str, Optional[FrozenSet[str]]] = {}
+        # str(Device_ID) -> latest state sent to clients
+        self.devices: Dict[str, dict] = {}
+        # Newest _id read, the _ids read in the lookback window before it,
+        # and the _id of the reading behind each device's state
+        self._cursor = None
+        self._recent = set()
+        self._applied: Dict[str, ObjectId] = {}
+        self._seeded = False
+        self._seed_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._relaying = False
+        self._leader = False
+        self._lease_checked_at: Optional[float] = None
+
+    # ------------------ SUBSCRIPTIONS ------------------
+
+    async def subscribe(self, client_id: str, devices: Optional[Iterable] = None):
+        """Follow `devices` (all when empty) and send the client a snapshot."""
+        followed = frozenset(str(device) for device in devices) if devices else None
+        self.subscriptions[client_id] = followed
+        async with self._seed_lock:
+            if not self._seeded:
+                await asyncio.to_thread(self._seed)
+            if not self._relaying:
+                await self.backplane.subscribe(FEED_CHANNEL, self._relay)
+                self._relaying = True
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        snapshot = {key: state for key, state in self.devices.items() if followed is None or key in followed}
+        await self._send_frame([client_id], "snapshot", snapshot, time.perf_counter())
+
+    async def unsubscribe(self, client_id: str):
+        self.subscriptions.pop(client_id, None)
+        if not self.subscriptions:
+            await self.stop()
+
+    async def stop(self):
+        """Stop reading; the next subscriber starts from a fresh snapshot."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._relaying:
+            await self.backplane.unsubscribe(FEED_CHANNEL, self._relay)
+            self._relaying = False
+        if self._leader:
+            await asyncio.to_thread(self.lease.release)
+            self._leader = False
+        self._lease_checked_at = None
+        self.devices = {}
+        self._cursor = None
+        self._recent = set()
+        self._applied = {}
+        self._seeded = False
+
+    # ------------------ READING ------------------
+
+    def _read(self, match: dict, newest_first: bool = False, limit: Optional[int] = None) -> List[dict]:
+        pipeline = [{"$match": match}, {"$sort": {"_id": -1 if newest_first else 1}}]
+        if limit:
+            pipeline.append({"$limit": limit})
+        pipeline.append({"$project": telemetry_fields.read_projection(FEED_FIELDS + TRACE_FIELDS)})
+        return list(self.collection.aggregate(pipeline))
+
+    def _fetch(self) -> List[dict]:
+        """
+        Readings not read yet, oldest first: those committed late inside the
+        lookback window before the cursor, then every page after it.
+        """
+        readings = []
+        if self._cursor is not None:
+            floor = ObjectId.from_datetime(
+                self._cursor.generation_time - timedelta(seconds=self.lookback_seconds)
+            )
+            self._recent = {reading_id for reading_id in self._recent if reading_id >= floor}
+            window = self.collection.find({"_id": {"$gte": floor, "$lte": self._cursor}}, {"_id": 1})
+            late = [document["_id"] for document in window if document["_id"] not in self._recent]
+            if late:
+                readings.extend(self._read({"_id": {"$in": late}}))
+        while True:
+            page = self._read({"_id": {"$gt": self._cursor}} if self._cursor is not None else {},
+                              limit=self.max_readings)
+            readings.extend(page)
+            if page:
+                self._cursor = page[-1]["_id"]
+            if len(page) < self.max_readings:
+                break
+        self._recent.update(reading["_id"] for reading in readings)
+        return readings
+
+    def _seed(self):
+        readings = self._read({}, newest_first=True, limit=self.max_readings)
+        readings.reverse()
+        if readings:
+            self._cursor = readings[-1]["_id"]
+            self._recent = {reading["_id"] for reading in readings}
+        self._apply(readings)
+        self._seeded = True
+
+    def _apply(self, readings: List[dict]) -> Dict[str, dict]:
+        """Fold readings into the device table; returns the changed fields per device."""
+        if not readings:
+            return {}
+        newest: Dict[str, dict] = {}
+        for reading in readings:
+            device_id = reading.get("Device_ID")
+            if device_id is None:
+                continue
+            key = str(device_id)
+            if key not in newest or reading["_id"] > newest[key]["_id"]:
+                newest[key] = reading
+        changes: Dict[str, dict] = {}
+        for key, reading in newest.items():
+            previous = self.devices.get(key)
+            applied = self._applied.get(key)
+            timestamp = int(reading["_id"].generation_time.timestamp())
+            # A late reading older than the state already sent; without the
+            # _id (state relayed from another reader) compare the timestamp
+            if applied is not None and reading["_id"] <= applied:
+                continue
+            if applied is None and previous is not None and timestamp < previous.get("timestamp", 0):
+                continue
+            state = {field: reading.get(field) for field in FEED_FIELDS}
+            state.update({field: reading[field] for field in TRACE_FIELDS if reading.get(field) is not None})
+            state["timestamp"] = timestamp
+            if previous is None:
+                changes[key] = state
+            else:
+                changes[key] = {field: value for field, value in state.items() if previous.get(field) != value}
+            self.devices[key] = state
+            self._applied[key] = reading["_id"]
+        changes = {key: delta for key, delta in changes.items() if delta}
+        LIVE_FEED_READINGS_TOTAL.inc(len(changes), outcome="sent")
+        LIVE_FEED_READINGS_TOTAL.inc(len(readings) - len(changes), outcome="coalesced")
+        return changes
+
+    # ------------------ PUBLISHING ------------------
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                if await self._lead():
+                    await self.tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Live feed tick failed: {e}")
+
+    async def _lead(self) -> bool:
+        """Whether this worker reads the feed; takes or renews the lease every FEED_LEASE_SECONDS / 2."""
+        now = time.monotonic()
+        if self._lease_checked_at is None or now - self._lease_checked_at >= FEED_LEASE_SECONDS / 2:
+            self._leader = await asyncio.to_thread(self.lease.acquire)
+            self._lease_checked_at = now
+        return self._leader
+
+    async def tick(self):
+        """Read new readings and publish the changes to every worker."""
+        changes = self._apply(await asyncio.to_thread(self._fetch))
+        items = list(changes.items())
+        for start in range(0, len(items), FEED_PUBLISH_DEVICES):
+            await self.backplane.publish(FEED_CHANNEL, codec.dumps_str({
+                "cursor": str(self._cursor),
+                "devices": dict(items[start:start + FEED_PUBLISH_DEVICES]),
+            }))
+
+    # ------------------ SENDING ------------------
+
+    async def _relay(self, channel: str, data: str):
+        """Merge published changes into this worker's table and send them to its clients."""
+        started = time.perf_counter()
+        message = codec.loads(data)
+        cursor = ObjectId(message["cursor"])
+        if self._cursor is None or cursor > self._cursor:
+            # Where this worker continues if it takes the lease over
+            self._cursor = cursor
+        changes = message["devices"]
+        for key, fields in changes.items():
+            self.devices.setdefault(key, {}).update(fields)
+        groups: Dict[Optional[FrozenSet[str]], List[str]] = {}
+        for client_id, followed in list(self.subscriptions.items()):
+            groups.setdefault(followed, []).append(client_id)
+        for followed, client_ids in groups.items():
+            selected = changes if followed is None else {key: delta for key, delta in changes.items() if key in followed}
+            if selected:
+                await self._send_frame(client_ids, "delta", selected, started)
+
+    async def _send_frame(self, client_ids: List[str], kind: str, devices: Dict[str, dict], started: float):
+        frame = codec.dumps_str({"type": kind, "devices": devices})
+        WEBSOCKET_FRAMES_TOTAL.inc(len(client_ids), type=kind)
+        WEBSOCKET_FRAME_BYTES.observe(len(frame), type=kind)
+        await self.send(client_ids, frame, started)
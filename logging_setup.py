@@ -0,0 +1,154 @@
+"""
+Asynchronous, structured logging for the ingest services.
+
+configure_logging() routes every record through a bounded queue: the calling
+thread only does a level check, an optional rate-limit check and a
+put_nowait(). A QueueListener thread formats records as JSON lines and writes
+them to stderr and, optionally, a size-rotated log file.
+
+Per-message events should be logged with a sample key, e.g.
+
+    logger.debug("Inserted document", extra={"sample": "insert", "document_id": ...})
+
+Records with the same sample key are let through at most LOG_SAMPLE_RATE
+times per second; the next record that passes carries the number of records
+suppressed in between.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+import metrics
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# 'json' (default) or 'text'
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+LOG_FILE_MAX_BYTES = int(os.environ.get('LOG_FILE_MAX_BYTES', 10 * 1024 * 1024))
+LOG_FILE_BACKUPS = int(os.environ.get('LOG_FILE_BACKUPS', 5))
+# Records per second allowed through for each sample key
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 1))
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+RECORDS_DROPPED = metrics.counter(
+    "log_records_dropped_total", "Log records dropped because the log queue was full"
+)
+
+# Attributes every LogRecord has; anything else came from `extra`
+_STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: timestamp, level, logger, service, message and any extras."""
+
+    def __init__(self, service: str):
+        super().__init__()
+        self.service = service
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "service": self.service,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        elif record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Passes at most `rate` records per second per `sample` key; unkeyed records always pass."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_allowed = {}
+        self._suppressed = {}
+
+    def filter(self, record):
+        key = getattr(record, "sample", None)
+        if key is None:
+            return True
+        now = time.monotonic()
+        if now < self._next_allowed.get(key, 0.0):
+            self._suppressed[key] = self._suppressed.get(key, 0) + 1
+            return False
+        self._next_allowed[key] = now + self.interval
+        record.suppressed = self._suppressed.pop(key, 0)
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Leaves formatting to the listener thread and never blocks the caller:
+    when the queue is full the record is dropped and counted.
+    """
+
+    def prepare(self, record):
+        # Merge args now because they may be mutated after the call returns
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            RECORDS_DROPPED.inc()
+
+
+def configure_logging(service: str, log_file: Optional[str] = None, level: str = LOG_LEVEL):
+    """
+    Install the queue-based pipeline on the root logger. Safe to call once per
+    process; later calls are ignored. The listener is flushed at exit.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    if LOG_FORMAT == 'text':
+        formatter = logging.Formatter(TEXT_FORMAT)
+    else:
+        formatter = JsonFormatter(service)
+
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(LOG_SAMPLE_RATE))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
@@ -1,17 +1,41 @@
-from fastapi import FastAPI, HTTPException, Request, Depends, status, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse, JSONResponse
+import time
+# Startup timing starts before the heavy imports below
+IMPORT_STARTED = time.perf_counter()
+
+from fastapi import FastAPI, HTTPException, Request, Depends, Query, status, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
 from fastapi.middleware.gzip import GZipMiddleware
 from models import SignupModel, LoginModel, ShipmentModel, DeviceListModel, TwoFactorVerifyModel
+from models import UserDetailsModel, ShipmentSummaryModel, DeviceReadingModel, projection, response_fields
 from fastapi.middleware.cors import CORSMiddleware
 from auth import create_password_reset_token
 from email_service import send_password_reset_email, send_2fa_code_email # The file we just created
 from models import  ForgotPasswordRequest, PasswordResetRequest
 from jose import JWTError, jwt
 import secrets
-
-from database import db, USERS_COLLECTION, DEVICE_STREAM_DATA_COLLECTION
+import hashlib
+import metrics
+import profiling
+from profiling import ProfiledJSONResponse, ProfiledTemplates
+from assets import AssetPipeline, AssetFiles, PageCache, etag_matches
+from bson import ObjectId
+from backplane import Backplane, create_backplane
+from live_feed import LiveFeed, create_feed_lease
+import archive
+import route_analytics
+import telemetry_fields
+import codec
+import math
+import zlib
+
+from database import db, USERS_COLLECTION, DEVICE_STREAM_DATA_COLLECTION, RATE_LIMITS_COLLECTION, AUTH_SECRETS_COLLECTION, ROUTE_MATRIX_COLLECTION, RESULT_CACHE_COLLECTION, LIVE_FEED_LEASES_COLLECTION
+from rate_limit import AuthRateLimits, ConcurrencyLimiter, create_bucket_store
+import secret_store
+import result_cache
+from starlette.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
+from health import ReadinessMonitor, tcp_probe, parse_host_port
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -22,16 +46,120 @@ from auth import (
     verify_password, 
     create_access_token, 
     get_current_user,
+    get_admin_user,
     get_websocket_user,
     pwd_context
 )
 from config import settings
-import time
 from typing import List, Dict, Any, Optional
 import json
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+
+# ------------------ STARTUP / HEALTH (see health.py) ------------------
+# Dependency checks run in the background; /readyz only reads their results
+readiness = ReadinessMonitor(settings.HEALTH_CHECK_INTERVAL_SECONDS, settings.HEALTH_CHECK_TIMEOUT_SECONDS)
+readiness.add("mongo", db.ping)
+readiness.add(
+    "kafka",
+    tcp_probe(lambda: [parse_host_port(server, 9092) for server in settings.kafka_bootstrap_servers]),
+    required=False,
+)
+readiness.add(
+    "smtp",
+    tcp_probe(lambda: [(settings.EMAIL_HOST, settings.EMAIL_PORT)] if settings.EMAIL_HOST else []),
+    required=False,
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    readiness.record_startup("import", started - IMPORT_STARTED)
+    try:
+        # Does not wait for the server; readiness reports when it is reachable
+        db.connect()
+    except RuntimeError as e:
+        logger.error(f"MongoDB not configured: {e}")
+    await manager._ensure_started()
+    await readiness.start()
+    readiness.record_startup("lifespan", time.perf_counter() - started)
+    logger.info(f"Web app started in {time.perf_counter() - IMPORT_STARTED:.3f}s")
+    yield
+    await readiness.stop()
+    await live_feed.stop()
+    await manager.backplane.stop()
+    db.close_connection()
+
+app = FastAPI(default_response_class=ProfiledJSONResponse, lifespan=lifespan)
+if settings.PROFILING_ENABLED:
+    # Must be set before any route is declared
+    app.router.route_class = profiling.profiler.route_class()
+
+# ------------------ METRICS ------------------
+REQUEST_SECONDS = metrics.histogram(
+    "http_request_duration_seconds", "HTTP request latency", ["method", "route", "status"]
+)
+WEBSOCKET_CONNECTIONS = metrics.gauge(
+    "websocket_connections", "Open WebSocket connections in this worker"
+)
+WEBSOCKET_FANOUT_LAG_SECONDS = metrics.histogram(
+    "websocket_fanout_lag_seconds", "Delay between the receipt of a broadcast or live feed tick and the send to each client"
+)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Time every request, labelled by route template rather than raw path."""
+    started = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            route=getattr(route, "path", "unmatched"),
+            status=status_code
+        )
+
+# Async so they answer even when the threadpool is saturated
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    """Liveness: the process is up and its event loop is responsive."""
+    return {"status": "ok", "uptime_seconds": round(time.time() - readiness.started_at, 3)}
+
+@app.get("/readyz", include_in_schema=False)
+async def readyz():
+    """Readiness: 503 until the required dependencies' last checks passed."""
+    report = readiness.report()
+    return ProfiledJSONResponse(
+        report, status_code=200 if report["ready"] else 503, headers={"Cache-Control": "no-store"}
+    )
 
-app = FastAPI()
+@app.get("/metrics", include_in_schema=False)
+def metrics_endpoint():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+# ------------------ PROFILING (opt-in, see profiling.py) ------------------
+if settings.PROFILING_ENABLED:
+    app.middleware("http")(profiling.profiler.profile_requests)
+
+@app.get("/admin/profiling", include_in_schema=False)
+def profiling_report(admin: dict = Depends(get_admin_user)):
+    """Recent request timings, slow Mongo commands and captured profiles."""
+    report = profiling.profiler.store.snapshot()
+    report["enabled"] = settings.PROFILING_ENABLED
+    report["slow_query_ms"] = settings.SLOW_QUERY_MS
+    return ProfiledJSONResponse(report)
+
+@app.get("/admin/profiling/profiles/{profile_id}", include_in_schema=False)
+def profiling_profile(profile_id: int, admin: dict = Depends(get_admin_user)):
+    """The cProfile/pyinstrument report of one profiled request."""
+    entry = profiling.profiler.store.get_profile(profile_id)
+    if entry is None:
+        raise HTTPException(404, "Profile not found")
+    return PlainTextResponse(entry["output"])
 
 # Add GZip compression
 app.add_middleware(GZipMiddleware, minimum_size=1000)
@@ -52,85 +180,313 @@ app.add_middleware(
 )
 
 # Initialize Jinja2Templates
-templates = Jinja2Templates(directory="templates") 
+templates = ProfiledTemplates(directory="templates") 
+
+# Fingerprinted, pre-compressed static files (see assets.py); templates link
+# to them with {{ asset_url('dashboard.css') }}
+asset_pipeline = AssetPipeline("static")
+templates.env.globals["asset_url"] = asset_pipeline.url
+app.mount(asset_pipeline.url_prefix, AssetFiles(asset_pipeline), name="assets")
+# Pages are the same for every user: rendered once, then served with ETag/304
+pages = PageCache(templates)
 
-# Configure Static Files
+# Configure Static Files (unfingerprinted URLs, kept for old links)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # ------------------ HELPER FOR SCM DATABASE ACCESS ------------------
 def get_scm_data_collection(collection_name: str):
-    """Connects to the SCM database and returns a specific collection."""
-    return db.get_collection(collection_name)
+    """A collection of the SCM database; connects on first use, not here."""
+    return db.collection(collection_name)
 
 users_collection = get_scm_data_collection(USERS_COLLECTION)
 
+# ------------------ RATE LIMITING / ADMISSION CONTROL (see rate_limit.py) ------------------
+# Token buckets per IP and per email on /login, /verify-2fa, /signup and
+# /reset-password-request; 'mongo' shares them across workers
+auth_limits = AuthRateLimits(
+    create_bucket_store(settings.RATE_LIMIT_BACKEND, get_scm_data_collection(RATE_LIMITS_COLLECTION)),
+    per_ip=settings.AUTH_RATE_LIMIT_PER_IP,
+    per_email=settings.AUTH_RATE_LIMIT_PER_EMAIL,
+)
+# Per-worker caps on the costly sections; over the cap requests fail fast with 503
+password_hashing = ConcurrencyLimiter("password_hashing", settings.AUTH_MAX_CONCURRENT_HASHES)
+email_sending = ConcurrencyLimiter("email_sending", settings.AUTH_MAX_CONCURRENT_EMAILS)
+
+def client_ip(request: Request) -> Optional[str]:
+    return request.client.host if request.client else None
+
+# ------------------ SHORT-LIVED SECRETS (see secret_store.py) ------------------
+# 2FA codes and reset tokens live outside the user document and expire on
+# their own; consuming one is a single atomic check-and-delete
+secrets_store = secret_store.create_secret_store(
+    settings.SECRET_STORE_BACKEND, get_scm_data_collection(AUTH_SECRETS_COLLECTION)
+)
+TWO_FACTOR_SECRET = "2fa"
+RESET_SECRET = "reset"
+TWO_FACTOR_CODE_TTL = timedelta(minutes=5)
+RESET_TOKEN_TTL = timedelta(minutes=15)
+
+# ------------------ PER-USER RESULT CACHE (see result_cache.py) ------------------
+# /shipment/my and /account/me are read far more often than they change;
+# every route that writes shipments or accounts invalidates the user's entries
+user_results = result_cache.create_result_cache(
+    settings.RESULT_CACHE_BACKEND, get_scm_data_collection(RESULT_CACHE_COLLECTION),
+    max_entries=settings.RESULT_CACHE_MAX_ENTRIES, ttl_seconds=settings.RESULT_CACHE_TTL_SECONDS,
+    min_ttl_seconds=settings.RESULT_CACHE_MIN_TTL_SECONDS, max_ttl_seconds=settings.RESULT_CACHE_MAX_TTL_SECONDS,
+)
+SHIPMENTS_RESULT = "shipments"
+ACCOUNT_RESULT = "account"
+
+def invalidate_user_results(email: str, *namespaces: str):
+    """Drop the user's cached results (all of them without `namespaces`)."""
+    for namespace in namespaces or (SHIPMENTS_RESULT, ACCOUNT_RESULT):
+        user_results.invalidate(namespace, email)
+
+# ------------------ CONDITIONAL GET / DELTA SYNC HELPERS ------------------
+# Polling clients send If-None-Match with the last ETag and `since` with the
+# newest `_id` they hold. An unchanged collection costs two indexed _id
+# lookups and a 304; otherwise only the documents around and after the cursor
+# are returned.
+#
+# Documents do not become visible in `_id` order: ObjectIds are made by the
+# writer, and consumers on several partitions, or several unordered bulk
+# inserts in flight, can commit a smaller `_id` after a larger one was
+# served. So `since` also returns the SYNC_LOOKBACK_SECONDS before the cursor
+# and clients drop the `_id`s they already hold, and the ETag counts the
+# documents in that window, so a late insert below the newest `_id` changes it.
+POLLING_CACHE_CONTROL = "private, no-cache"
+
+# An ObjectId holds its creation time as unsigned 32-bit seconds
+MAX_SINCE_TIMESTAMP = 2 ** 32 - 1
+
+def parse_since(since: Optional[str]):
+    """`since` cursor: the last `_id` seen (ObjectId hex) or a Unix timestamp."""
+    if since is None or since == "":
+        return None
+    if ObjectId.is_valid(since):
+        return ObjectId(since)
+    try:
+        timestamp = float(since)
+    except ValueError:
+        timestamp = None
+    # float() also takes 'inf', 'nan' and 1e300, which no cursor can hold
+    if timestamp is None or not math.isfinite(timestamp) or not 0 <= timestamp <= MAX_SINCE_TIMESTAMP:
+        raise HTTPException(status_code=400, detail="since must be a document _id or a Unix timestamp")
+    return timestamp
+
+def lookback_start(timestamp: float) -> ObjectId:
+    """Smallest `_id` created SYNC_LOOKBACK_SECONDS before `timestamp`."""
+    start = max(timestamp - settings.SYNC_LOOKBACK_SECONDS, 0)
+    return ObjectId.from_datetime(datetime.fromtimestamp(start, tz=timezone.utc))
+
+def since_filter(since, timestamp_field: Optional[str] = None) -> dict:
+    """Query fragment selecting documents newer than the cursor, plus the lookback window before it."""
+    if since is None:
+        return {}
+    if isinstance(since, ObjectId):
+        return {"_id": {"$gte": lookback_start(since.generation_time.timestamp())}}
+    if timestamp_field:
+        return {timestamp_field: {"$gt": since - settings.SYNC_LOOKBACK_SECONDS}}
+    # No timestamp field: use the creation time embedded in the ObjectId
+    return {"_id": {"$gte": lookback_start(since)}}
+
+def newest_id_etag(collection, query: dict, variant: str = "") -> str:
+    """
+    Weak ETag that changes whenever a document matching `query` is inserted:
+    the newest `_id`, and how many documents the lookback window before it holds.
+    """
+    newest = collection.find_one(query, {"_id": 1}, sort=[("_id", -1)])
+    if newest is None:
+        return f'W/"empty{variant}"'
+    window = {**query, "_id": {"$gte": lookback_start(newest["_id"].generation_time.timestamp())}}
+    return f'W/"{newest["_id"]}.{collection.count_documents(window)}{variant}"'
+
+def not_modified_response(request: Request, etag: str) -> Optional[Response]:
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": POLLING_CACHE_CONTROL})
+    return None
+
+def polling_response(docs, etag: str):
+    return ProfiledJSONResponse(docs, headers={"ETag": etag, "Cache-Control": POLLING_CACHE_CONTROL})
+
+# ------------------ RESPONSE PROJECTIONS (see models.py) ------------------
+# Read routes fetch only the fields of their response model
+USER_DETAILS_PROJECTION = projection(UserDetailsModel)
+SHIPMENT_SUMMARY_PROJECTION = projection(ShipmentSummaryModel)
+# Readings may be stored under short names (see telemetry_fields.py); the
+# $project stage maps them back inside Mongo, not per document in Python
+DEVICE_READING_STAGE = {"$project": telemetry_fields.read_projection(
+    name for name in response_fields(DeviceReadingModel) if name != "_id"
+)}
+LATEST_READINGS_LIMIT = 15
+
+def latest_readings(collection, query: dict) -> list:
+    """The newest readings matching `query`, newest first, as DeviceReadingModel documents."""
+    return list(collection.aggregate([
+        {"$match": query},
+        {"$sort": {"_id": -1}},
+        {"$limit": LATEST_READINGS_LIMIT},
+        DEVICE_READING_STAGE,
+    ]))
+
 # Add WebSocket manager class
 class ConnectionManager:
-    def __init__(self):
+    """
+    WebSocket connections held by this worker.
+
+    Broadcasts and per-user messages go through the backplane (see
+    backplane.py), so they reach clients connected to any worker. Users are
+    hashed onto WS_SHARDS shard channels; a worker subscribes to a shard's
+    channel only while it holds a connection in that shard, so per-user
+    messages only wake the workers that can deliver them. The live feed
+    publishes on the same backplane (see live_feed.py).
+    """
+    BROADCAST_CHANNEL = "ws:broadcast"
+
+    def __init__(self, backplane: Backplane, shards: int):
+        self.backplane = backplane
+        self.shards = shards
         self.active_connections: Dict[str, WebSocket] = {}
+        # client_id -> user, user -> client_ids, shard -> users held here
+        self.connection_users: Dict[str, str] = {}
+        self.user_connections: Dict[str, set] = {}
+        self.shard_users: Dict[int, set] = {}
+        self._started = False
 
-    async def connect(self, websocket: WebSocket, client_id: str):
-        await websocket.accept()
-        self.active_connections[client_id] = websocket
+    def shard_for(self, user_key: str) -> int:
+        return zlib.crc32(user_key.encode("utf-8")) % self.shards
 
-    def disconnect(self, client_id: str):
-        if client_id in self.active_connections:
-            del self.active_connections[client_id]
+    def shard_channel(self, shard: int) -> str:
+        return f"ws:shard:{shard}"
 
-    async def send_personal_message(self, message: str, client_id: str):
-        if client_id in self.active_connections:
-            await self.active_connections[client_id].send_text(message)
+    async def _ensure_started(self):
+        if not self._started:
+            self._started = True
+            await self.backplane.start()
+            await self.backplane.subscribe(self.BROADCAST_CHANNEL, self._deliver_broadcast)
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections.values():
-            await connection.send_text(message)
+    async def connect(self, websocket: WebSocket, client_id: str, user_key: str):
+        await websocket.accept()
+        await self._ensure_started()
+        self.active_connections[client_id] = websocket
+        self.connection_users[client_id] = user_key
+        if user_key not in self.user_connections:
+            self.user_connections[user_key] = set()
+            shard = self.shard_for(user_key)
+            users = self.shard_users.setdefault(shard, set())
+            if not users:
+                await self.backplane.subscribe(self.shard_channel(shard), self._deliver_personal)
+            users.add(user_key)
+        self.user_connections[user_key].add(client_id)
+        WEBSOCKET_CONNECTIONS.set(len(self.active_connections))
+
+    async def disconnect(self, client_id: str):
+        self.active_connections.pop(client_id, None)
+        user_key = self.connection_users.pop(client_id, None)
+        clients = self.user_connections.get(user_key)
+        if clients is not None:
+            clients.discard(client_id)
+            if not clients:
+                del self.user_connections[user_key]
+                shard = self.shard_for(user_key)
+                users = self.shard_users.get(shard, set())
+                users.discard(user_key)
+                if not users:
+                    self.shard_users.pop(shard, None)
+                    await self.backplane.unsubscribe(self.shard_channel(shard), self._deliver_personal)
+        WEBSOCKET_CONNECTIONS.set(len(self.active_connections))
+
+    async def send_personal_message(self, message: str, user_key: str):
+        """Send to every connection of `user_key`, on whichever workers hold them."""
+        await self._ensure_started()
+        payload = codec.dumps_str({"user": user_key, "message": message})
+        await self.backplane.publish(self.shard_channel(self.shard_for(user_key)), payload)
 
-manager = ConnectionManager()
+    async def broadcast(self, message: str):
+        await self._ensure_started()
+        await self.backplane.publish(self.BROADCAST_CHANNEL, message)
+
+    async def send(self, client_ids, message: str, started: float):
+        """Send one text frame to each of `client_ids` held by this worker; dead connections are dropped."""
+        for client_id in client_ids:
+            connection = self.active_connections.get(client_id)
+            if connection is None:
+                continue
+            try:
+                await connection.send_text(message)
+            except Exception as e:
+                logger.warning(f"Dropping WebSocket client {client_id}: {e}")
+                await self.disconnect(client_id)
+                continue
+            WEBSOCKET_FANOUT_LAG_SECONDS.observe(time.perf_counter() - started)
+
+    async def _deliver_broadcast(self, channel: str, message: str):
+        await self.send(list(self.active_connections), message, time.perf_counter())
+
+    async def _deliver_personal(self, channel: str, payload: str):
+        started = time.perf_counter()
+        data = codec.loads(payload)
+        await self.send(list(self.user_connections.get(data["user"], ())), data["message"], started)
+
+manager = ConnectionManager(
+    create_backplane(settings.WS_BACKPLANE, settings.BACKPLANE_ADDRESS), settings.WS_SHARDS
+)
+# Readings reach /ws/device-data clients in batched, delta-encoded frames
+# (see live_feed.py). With the broker backplane one worker, the lease
+# holder, reads the collection and publishes to the others
+live_feed = LiveFeed(
+    get_scm_data_collection(DEVICE_STREAM_DATA_COLLECTION), manager.send, settings.WS_BATCH_INTERVAL_MS / 1000,
+    backplane=manager.backplane,
+    lookback_seconds=settings.SYNC_LOOKBACK_SECONDS,
+    lease=create_feed_lease(
+        "local" if settings.WS_BACKPLANE == "memory" else "mongo", get_scm_data_collection(LIVE_FEED_LEASES_COLLECTION)
+    ),
+)
 
 # ------------------ FRONTEND ROUTES (Template Serving) ------------------
 
 @app.get("/", response_class=HTMLResponse)
 def index(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+    return pages.response(request, "index.html")
 
 @app.get("/device-data-stream", response_class=HTMLResponse)
 def device_data_stream(request: Request):
-    return templates.TemplateResponse("device-data-stream.html", {"request": request})
+    return pages.response(request, "device-data-stream.html")
 
 @app.get("/dashboard", response_class=HTMLResponse)
 def dashboard(request: Request):
-    return templates.TemplateResponse("dashboard.html", {"request": request})
+    return pages.response(request, "dashboard.html")
 
 @app.get("/create-shipment", response_class=HTMLResponse)
 def create_shipment(request: Request):
-    return templates.TemplateResponse("create-shipment.html", {"request": request})
+    return pages.response(request, "create-shipment.html")
 
 @app.get("/myaccount", response_class=HTMLResponse)
 def my_account(request: Request):
-    return templates.TemplateResponse("myaccount.html", {"request": request})
+    return pages.response(request, "myaccount.html")
 
 @app.get("/myshipment", response_class=HTMLResponse)
 def my_shipments(request: Request):
-    return templates.TemplateResponse("myshipment.html", {"request": request})
+    return pages.response(request, "myshipment.html")
 
 @app.get("/login", response_class=HTMLResponse)
 def login(request: Request):
-    return templates.TemplateResponse("login.html", {"request": request})
+    return pages.response(request, "login.html")
 
 @app.get("/signup", response_class=HTMLResponse)
 def signup(request: Request):
-    return templates.TemplateResponse("signup.html", {"request": request})
+    return pages.response(request, "signup.html")
 
 @app.get("/forgot-password", response_class=HTMLResponse)
 def forgot_password(request: Request):
-    return templates.TemplateResponse("forgot-password.html", {"request": request})
+    return pages.response(request, "forgot-password.html")
 
 # --- In main.py, near your other template routes ---
 
 @app.get("/reset-password", response_class=HTMLResponse)
 def reset_password(request: Request):
     """Serves the password reset form page."""
-    return templates.TemplateResponse("reset-password.html", {"request": request})
+    return pages.response(request, "reset-password.html")
 
 # Note: No changes needed to the app.include_router(reset_router) line
 
@@ -163,68 +519,44 @@ async def handle_reset_confirm(request: PasswordResetRequest):
     except JWTError:
         raise credentials_exception
 
-    # 2. Find the user and validate the token status in the database
-    db_user = users_collection.find_one({"email": email})
-
-    if not db_user or db_user.get("reset_token") != request.token:
-        # Token doesn't match the one stored (or user not found)
-        raise credentials_exception
-    
-    if db_user.get("reset_token_expires") < datetime.utcnow():
-        # Token has expired
+    # 2. Consume the stored token: it must be the latest one issued, unexpired and unused
+    outcome, _ = secrets_store.consume(RESET_SECRET, email, request.token)
+    if outcome != secret_store.ACCEPTED:
         raise credentials_exception
 
     # 3. Hash the new password
-    hashed_password = hash_password(request.new_password)
-
-    # 4. Update the password and clear the reset token fields
-    users_collection.update_one(
-        {"_id": db_user["_id"]},
-        {
-            "$set": {
-                "password": hashed_password
-            },
-            "$unset": {
-                "reset_token": "",
-                "reset_token_expires": ""
-            }
-        }
-    )
+    with password_hashing.slot():
+        hashed_password = await run_in_threadpool(hash_password, request.new_password)
+
+    # 4. Update the password
+    users_collection.update_one({"email": email}, {"$set": {"password": hashed_password}})
+    invalidate_user_results(email)
 
     return {"message": "Password updated successfully."}
 
 @app.post("/reset-password-request")
-async def handle_reset_request(request: ForgotPasswordRequest):
+async def handle_reset_request(request: ForgotPasswordRequest, http_request: Request):
     """
     Receives email, generates reset token, updates DB, and sends email.
     Uses generic success message for security.
     """
+    # Outside the try: a 429 must not turn into the generic success message
+    auth_limits.check("reset_password", client_ip(http_request), request.email)
     try:
         # 1. Find the user in the database
-        db_user = users_collection.find_one({"email": request.email})
+        db_user = users_collection.find_one({"email": request.email}, {"_id": 1})
         
         # 2. Security Check: Always return generic success regardless of user existence.
         if not db_user:
             return {"message": "If an account is associated with this email, a reset link has been sent."}
 
         # 3. Generate a Password Reset Token (e.g., expires in 15 minutes)
-        reset_token_expires = timedelta(minutes=15)
         reset_token = create_password_reset_token(
-            data={"sub": request.email}, expires_delta=reset_token_expires
+            data={"sub": request.email}, expires_delta=RESET_TOKEN_TTL
         )
         
-        # 4. Save the Token and Expiration to the User's Database Document
-        expiry_timestamp = datetime.utcnow() + reset_token_expires
-        
-        users_collection.update_one(
-            {"_id": db_user["_id"]},
-            {
-                "$set": {
-                    "reset_token": reset_token,
-                    "reset_token_expires": expiry_timestamp
-                }
-            }
-        )
+        # 4. Save the token in the secret store; it replaces any earlier one
+        secrets_store.put(RESET_SECRET, request.email, reset_token, RESET_TOKEN_TTL.total_seconds())
         
         # 5. Construct the full reset URL
         # NOTE: You MUST replace this with your EC2 Public IP or actual domain name!
@@ -232,7 +564,8 @@ async def handle_reset_request(request: ForgotPasswordRequest):
         reset_url = f"{RESET_DOMAIN}/reset-password?token={reset_token}"
         
         # 6. Send the Email
-        email_sent = await send_password_reset_email(request.email, reset_url)
+        with email_sending.slot():
+            email_sent = await send_password_reset_email(request.email, reset_url)
         
         if not email_sent and settings.EMAIL_HOST != "smtp.example.com":
              # Log a failure, but still return a generic success to the user (security)
@@ -261,6 +594,7 @@ def create_new_shipment(shipment: ShipmentModel, user_payload: dict = Depends(ge
         shipment_data['creator_email'] = user_payload['email']
         
         insert_result = collection.insert_one(shipment_data)
+        invalidate_user_results(user_payload['email'], SHIPMENTS_RESULT)
         
         return {
             "message": "Shipment created successfully",
@@ -270,29 +604,47 @@ def create_new_shipment(shipment: ShipmentModel, user_payload: dict = Depends(ge
         raise HTTPException(status_code=500, detail=f"Database error during shipment creation: {e}")
 # -----------------------------------------------------------
 
-@app.get("/shipment/my")
-def get_my_shipments(user_payload: dict = Depends(get_current_user)):
+def find_user_shipments(collection, user_query: dict, cursor=None) -> list:
+    # MongoDB query to filter by the current user's email
+    return list(collection.find(
+        {**user_query, **since_filter(cursor, timestamp_field='timestamp')},
+        SHIPMENT_SUMMARY_PROJECTION
+    ).sort('timestamp', -1)) # Sort by most recent first
+
+def load_user_shipments(collection, user_query: dict) -> dict:
+    # ETag first: a shipment inserted in between shows up in the list, not the tag
+    etag = newest_id_etag(collection, user_query)
+    return {"etag": etag, "shipments": find_user_shipments(collection, user_query)}
+
+@app.get("/shipment/my", response_model=List[ShipmentSummaryModel])
+def get_my_shipments(request: Request, since: Optional[str] = None, user_payload: dict = Depends(get_current_user)):
     """
     Fetch shipments created by the logged-in user.
     This route filters shipments based on the 'creator_email' matching
     the authenticated user's email from the JWT payload.
+
+    Supports If-None-Match (304 when nothing new) and `since` (last `_id`
+    or Unix timestamp) to return only shipments created after it, plus
+    those of the SYNC_LOOKBACK_SECONDS before it (drop the ones already held).
     """
+    cursor = parse_since(since)
     try:
         collection = get_scm_data_collection("shipment_data")
+        user_query = {"creator_email": user_payload["email"]}
 
-        # MongoDB query to filter by the current user's email
-        shipments = list(collection.find(
-            {"creator_email": user_payload["email"]}
-        ).sort('timestamp', -1)) # Sort by most recent first
+        if cursor is None:
+            # The full list and its ETag are cached together until the user creates a shipment
+            result = user_results.get_or_load(
+                SHIPMENTS_RESULT, user_payload["email"], lambda: load_user_shipments(collection, user_query)
+            )
+            return not_modified_response(request, result["etag"]) or polling_response(result["shipments"], result["etag"])
 
-        # Convert ObjectId to string for JSON serialization
-        for s in shipments:
-            s["_id"] = str(s["_id"])
-            # Format the timestamp for display
-            if 'timestamp' in s and isinstance(s['timestamp'], int):
-                 s['createdOnDisplay'] = datetime.fromtimestamp(s['timestamp']).strftime('%Y-%m-%d %H:%M')
+        etag = newest_id_etag(collection, user_query)
+        not_modified = not_modified_response(request, etag)
+        if not_modified is not None:
+            return not_modified
 
-        return shipments
+        return polling_response(find_user_shipments(collection, user_query, cursor), etag)
     except Exception as e:
         # Log the error for debugging
         print(f"Error fetching user shipments: {e}")
@@ -300,73 +652,90 @@ def get_my_shipments(user_payload: dict = Depends(get_current_user)):
 
 
 # ------------------ 3. GET ACCOUNT DETAILS ------------------
-@app.get("/account/me/{email}")
+@app.get("/account/me/{email}", response_model=UserDetailsModel)
 def get_user_details(email: str, user_payload: dict = Depends(get_current_user)):
     
     if email != user_payload["email"]:
         raise HTTPException(403, "Not authorized")
 
-    db_user = users_collection.find_one({"email": email}, {"password": 0})
+    # Only the public fields; hashes and legacy secrets never leave the database
+    db_user = user_results.get_or_load(
+        ACCOUNT_RESULT, email, lambda: users_collection.find_one({"email": email}, USER_DETAILS_PROJECTION)
+    )
 
     if not db_user:
         raise HTTPException(404, "User not found")
 
-    db_user["_id"] = str(db_user["_id"])
-    return db_user
+    return ProfiledJSONResponse(db_user)
 
 # ------------------------------------------------------------
 
 
 # ------------------ GET LATEST SCM DATA (POLLING) ------------------
-@app.get("/device-data")
-def get_latest_device_data():
-    """Fetches the latest 15 documents from the live device data collection."""
+@app.get("/device-data", response_model=List[DeviceReadingModel])
+def get_latest_device_data(request: Request, since: Optional[str] = None):
+    """
+    Fetches the latest 15 documents from the live device data collection.
+    With `since` (last `_id` seen) only documents from SYNC_LOOKBACK_SECONDS
+    before it onwards are returned, so readings committed out of `_id` order
+    are not missed; clients drop the `_id`s they already hold. With
+    If-None-Match a 304 is returned when nothing was inserted.
+    """
+    cursor = parse_since(since)
     try:
         collection = get_scm_data_collection(DEVICE_STREAM_DATA_COLLECTION)
+
+        etag = newest_id_etag(collection, {})
+        not_modified = not_modified_response(request, etag)
+        if not_modified is not None:
+            return not_modified
         
-        latest_data = list(
-            collection.find()
-            .sort('_id', -1)
-            .limit(15)
-        )
+        latest_data = latest_readings(collection, since_filter(cursor))
         
-        for doc in latest_data:
-            doc['_id'] = str(doc['_id'])
-            
-        return latest_data
+        # Returned directly so the codec encodes ObjectId without a jsonable_encoder pass
+        return polling_response(latest_data, etag)
         
     except Exception as e:
         print(f"Database error: {e}")
         raise HTTPException(status_code=500, detail="Could not retrieve device data from database")
     
 
-@app.post("/device-data/filter")
+def device_id_values(devices: List[str]) -> list:
+    """Device IDs as sent, plus the integer form of numeric ones: readings store Device_ID as a number."""
+    values = list(devices)
+    values += [int(device) for device in devices if device.strip().lstrip("-").isdigit()]
+    return values
+
+@app.post("/device-data/filter", response_model=List[DeviceReadingModel])
 def get_filtered_device_data(
+    request: Request,
     device_list: DeviceListModel, 
     user_payload: dict = Depends(get_current_user) # Secure the route
 ):
     """
     Fetches the latest 15 documents from the live device data collection, 
     filtered by the Device_ID list provided in the request body.
+    `since` in the body and If-None-Match work as on GET /device-data.
     """
+    cursor = parse_since(device_list.since)
     try:
         collection = get_scm_data_collection(DEVICE_STREAM_DATA_COLLECTION)
         
         # 1. Create a query filter using the list of device IDs
-        filter_query = {"Device_ID": {"$in": device_list.devices}}
+        filter_query = {telemetry_fields.stored_name("Device_ID"): {"$in": device_id_values(device_list.devices)}}
+
+        # The ETag is per device list, so it carries a digest of the list
+        variant = "-" + hashlib.sha1(",".join(sorted(device_list.devices)).encode()).hexdigest()[:8]
+        etag = newest_id_etag(collection, filter_query, variant)
+        not_modified = not_modified_response(request, etag)
+        if not_modified is not None:
+            return not_modified
         
         # 2. Query the database
-        latest_data = list(
-            collection.find(filter_query)
-            .sort('_id', -1)
-            .limit(15)
-        )
+        latest_data = latest_readings(collection, {**filter_query, **since_filter(cursor)})
         
         # 3. Serialize and return
-        for doc in latest_data:
-            doc['_id'] = str(doc['_id'])
-            
-        return latest_data
+        return polling_response(latest_data, etag)
         
     except Exception as e:
         print(f"Database error: {e}")
@@ -374,6 +743,95 @@ def get_filtered_device_data(
 # --------------------------------------------------------------------
 
 
+# ------------------ HISTORICAL TELEMETRY (Parquet archive, see archive.py) ------------------
+# Aged readings leave Mongo for the archive; these scans never touch the
+# operational database
+ARCHIVE_MAX_DAYS = 366
+
+def get_archive_reader() -> archive.ArchiveReader:
+    try:
+        return archive.ArchiveReader(settings.ARCHIVE_DIR)
+    except RuntimeError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+
+def archive_window(start: datetime, end: Optional[datetime]):
+    """Aware UTC bounds of [start, end); naive inputs are taken as UTC."""
+    end = end or datetime.now(timezone.utc)
+    start, end = (value if value.tzinfo else value.replace(tzinfo=timezone.utc) for value in (start, end))
+    if end <= start:
+        raise HTTPException(status_code=400, detail="'end' must be after 'start'")
+    if end - start > timedelta(days=ARCHIVE_MAX_DAYS):
+        raise HTTPException(status_code=400, detail=f"Range is limited to {ARCHIVE_MAX_DAYS} days")
+    return start, end
+
+@app.get("/archive/device-data")
+def get_archived_device_data(
+    start: datetime,
+    end: Optional[datetime] = None,
+    device_id: Optional[List[int]] = Query(None),
+    limit: int = Query(1000, ge=1, le=archive.MAX_RANGE_ROWS),
+    user_payload: dict = Depends(get_current_user)
+):
+    """Archived readings in [start, end), oldest first, optionally for some devices."""
+    start, end = archive_window(start, end)
+    return ProfiledJSONResponse(get_archive_reader().range(start, end, device_id, limit))
+
+@app.get("/archive/device-data/stats")
+def get_archived_device_stats(
+    start: datetime,
+    end: Optional[datetime] = None,
+    device_id: Optional[List[int]] = Query(None),
+    group_by: str = Query("device", pattern="^(device|date|route)$"),
+    user_payload: dict = Depends(get_current_user)
+):
+    """Reading count and battery/temperature statistics per device, day or route."""
+    start, end = archive_window(start, end)
+    return ProfiledJSONResponse(get_archive_reader().aggregate(start, end, device_id, group_by))
+# --------------------------------------------------------------------
+
+
+# ------------------ ROUTE ANALYTICS (see route_analytics.py) ------------------
+# The consumer keeps origin-destination matrices per time bucket; these
+# endpoints read the merged snapshot, never the raw readings, and read it
+# from a secondary when there is one (see mongo_clients.analytics)
+lane_summaries = route_analytics.LaneSummaryCache(
+    db.collection(ROUTE_MATRIX_COLLECTION, analytics=True), settings.ROUTE_ANALYTICS_REFRESH_SECONDS
+)
+
+# Windows are capped to what the consumer's bucket rings hold
+LANE_DEFAULT_HOURS = min(24, route_analytics.MAX_WINDOW_HOURS)
+
+def lane_window(hours: float):
+    end = time.time()
+    return end - hours * 3600, end
+
+@app.get("/analytics/lanes")
+def get_top_lanes(
+    hours: float = Query(LANE_DEFAULT_HOURS, gt=0, le=route_analytics.MAX_WINDOW_HOURS),
+    limit: int = Query(20, ge=1, le=500),
+    order_by: str = Query("count", pattern="^(count|temperature|battery)$"),
+    user_payload: dict = Depends(get_current_user)
+):
+    """Busiest, hottest or lowest-battery lanes over the last `hours`."""
+    start, end = lane_window(hours)
+    return lane_summaries.get().top_lanes(start, end, limit, order_by)
+
+@app.get("/analytics/lanes/{route_from}/{route_to}")
+def get_lane_summary(
+    route_from: str,
+    route_to: str,
+    hours: float = Query(LANE_DEFAULT_HOURS, gt=0, le=route_analytics.MAX_WINDOW_HOURS),
+    user_payload: dict = Depends(get_current_user)
+):
+    """Reading count, mean temperature and mean battery of one lane over the last `hours`."""
+    start, end = lane_window(hours)
+    summary = lane_summaries.get().lane(route_from, route_to, start, end)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="No readings for this lane")
+    return summary
+# --------------------------------------------------------------------
+
+
 # ------------------ AUTH ROUTES ------------------
 
 @app.get("/api/v1/verify-token")
@@ -382,49 +840,52 @@ def verify_token(current_user: dict = Depends(get_current_user)):
 
 
 @app.post("/signup")
-def signup_user(user: SignupModel):
-    existing_user = users_collection.find_one({"email": user.email})
+def signup_user(user: SignupModel, http_request: Request):
+    auth_limits.check("signup", client_ip(http_request), user.email)
+    existing_user = users_collection.find_one({"email": user.email}, {"_id": 1})
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    print(user.password)
+    with password_hashing.slot():
+        hashed_password = hash_password(user.password)
     users_collection.insert_one({
         "name": user.name,
         "email": user.email,
-        "password": hash_password(user.password)
+        "password": hashed_password
         
     })
+    # A lookup of this email before signup may have cached "no such user"
+    invalidate_user_results(user.email)
     
     return {"message": "Signup successful!"}
 
 # Updated Login to return JWT
 # Updated Login to implement 2FA
 @app.post("/login", status_code=status.HTTP_202_ACCEPTED) # Set default status to 202
-async def login_user(user: LoginModel):
-    db_user = users_collection.find_one({"email": user.email})
+async def login_user(user: LoginModel, http_request: Request):
+    auth_limits.check("login", client_ip(http_request), user.email)
+    db_user = users_collection.find_one({"email": user.email}, {"name": 1, "email": 1, "password": 1})
     if not db_user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    if not verify_password(user.password, db_user["password"]):
+    # bcrypt takes tens of milliseconds; keep it off the event loop
+    with password_hashing.slot():
+        password_ok = await run_in_threadpool(verify_password, user.password, db_user["password"])
+    if not password_ok:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect password")
     
     # 1. Generate 6-digit code
     # NOTE: secrets.randbelow(1000000) generates a number from 0 to 999999
     code = str(secrets.randbelow(1000000)).zfill(6) 
-    code_expiry = datetime.utcnow() + timedelta(minutes=5)
-
-    # 2. Save code and expiry to the database
-    users_collection.update_one(
-        {"_id": db_user["_id"]},
-        {
-            "$set": {
-                "two_factor_code": code,
-                "code_expires_at": code_expiry
-            }
-        }
+
+    # 2. Save the code with what /verify-2fa needs, so it doesn't read the user again
+    secrets_store.put(
+        TWO_FACTOR_SECRET, user.email, code, TWO_FACTOR_CODE_TTL.total_seconds(),
+        payload={"name": db_user["name"], "email": db_user["email"]},
     )
 
     # 3. Send the code via email
-    await send_2fa_code_email(user.email, code)
+    with email_sending.slot():
+        await send_2fa_code_email(user.email, code)
 
     # 4. Return 202 status to client, prompting for the 2FA code
     # The client-side logic (login.js) expects this 202 status.
@@ -436,40 +897,26 @@ async def login_user(user: LoginModel):
 
 # NEW ROUTE: Verify 2FA Code
 @app.post("/verify-2fa")
-def verify_two_factor_code(request: TwoFactorVerifyModel):
-    db_user = users_collection.find_one({"email": request.email})
-
-    # Basic user/code existence check
-    if not db_user or db_user.get("two_factor_code") is None:
+def verify_two_factor_code(request: TwoFactorVerifyModel, http_request: Request):
+    # Per-email limit: a 6-digit code must not be brute-forceable
+    auth_limits.check("verify_2fa", client_ip(http_request), request.email)
+    # 1. Check and consume the code in one step; a code can only be used once
+    outcome, db_user = secrets_store.consume(TWO_FACTOR_SECRET, request.email, request.code)
+
+    # 2. Missing or expired: the user has to log in again for a new code
+    if outcome == secret_store.MISSING:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, 
-            detail="Verification process timed out or is invalid."
+            detail="Verification code expired or invalid. Please log in again."
         )
 
-    # 1. Check if the code has expired
-    if db_user.get("code_expires_at") < datetime.utcnow():
-        # Clear the expired code
-        users_collection.update_one(
-            {"_id": db_user["_id"]},
-            {"$unset": {"two_factor_code": "", "code_expires_at": ""}}
-        )
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED, 
-            detail="Verification code expired. Please log in again."
-        )
-
-    # 2. Check if the code matches
-    if request.code != db_user["two_factor_code"]:
+    if outcome == secret_store.MISMATCH:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, 
             detail="Incorrect verification code."
         )
     
-    # 3. SUCCESS: Clear the code and generate the final JWT
-    users_collection.update_one(
-        {"_id": db_user["_id"]},
-        {"$unset": {"two_factor_code": "", "code_expires_at": ""}}
-    )
+    # 3. SUCCESS: generate the final JWT
 
     access_token_expires = timedelta(minutes=30)
     access_token = create_access_token(
@@ -500,6 +947,7 @@ def create_new_shipment(shipment: ShipmentModel, user_payload: dict = Depends(ge
         shipment_data['creator_email'] = user_payload['email']
         
         insert_result = shipments_collection.insert_one(shipment_data)
+        invalidate_user_results(user_payload['email'], SHIPMENTS_RESULT)
         
         return {
             "message": "Shipment created successfully",
@@ -512,21 +960,41 @@ def create_new_shipment(shipment: ShipmentModel, user_payload: dict = Depends(ge
 # -----------------------------------------------------------
 
 @app.websocket("/ws/device-data")
-async def websocket_endpoint(websocket: WebSocket, token: str):
+async def websocket_endpoint(websocket: WebSocket, token: str, devices: Optional[str] = None):
+    """Live feed (see live_feed.py); `devices` is a comma-separated list to follow, all by default."""
     user = await get_websocket_user(websocket, token)
     if not user:
         return
 
-    client_id = f"{user['email']}_{int(time.time())}"
-    await manager.connect(websocket, client_id)
+    # The random suffix keeps two tabs opened in the same second apart
+    client_id = f"{user['email']}_{int(time.time())}_{secrets.token_hex(4)}"
+    await manager.connect(websocket, client_id, user['email'])
     
     try:
+        await live_feed.subscribe(client_id, [device for device in (devices or "").split(",") if device])
         while True:
-            # Keep connection alive
-            await websocket.receive_text()
+            # {"devices": [...]} changes the followed devices; anything else keeps the connection alive
+            try:
+                message = codec.loads(await websocket.receive_text())
+            except codec.JSONDecodeError:
+                continue
+            if not isinstance(message, dict) or "devices" not in message:
+                continue
+            followed = message["devices"]
+            if followed is not None and not (
+                isinstance(followed, list) and all(isinstance(device, (str, int)) for device in followed)
+            ):
+                await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA, reason="devices must be a list of device IDs or null")
+                break
+            await live_feed.subscribe(client_id, followed)
     except WebSocketDisconnect:
-        manager.disconnect(client_id)
         logger.info(f"Client {client_id} disconnected")
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
-        manager.disconnect(client_id)
\ No newline at end of file
+        try:
+            await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+        except Exception:
+            pass
+    finally:
+        await live_feed.unsubscribe(client_id)
+        await manager.disconnect(client_id)
\ No newline at end of file
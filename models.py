@@ -1,5 +1,5 @@
-from pydantic import BaseModel, EmailStr
-from typing import List, Optional
+from pydantic import BaseModel, EmailStr, Field
+from typing import Dict, List, Optional, Type, Union
 
 class SignupModel(BaseModel):
     name: str
@@ -30,6 +30,8 @@ class ShipmentModel(BaseModel):
 # --- New Model for Device List ---
 class DeviceListModel(BaseModel):
     devices: List[str]
+    # Delta sync cursor: last `_id` the client has (or a Unix timestamp)
+    since: Optional[str] = None
 
 class ForgotPasswordRequest(BaseModel):
     email: EmailStr
@@ -40,4 +42,40 @@ class PasswordResetRequest(BaseModel):
 
 class TwoFactorVerifyModel(BaseModel):
     email: str
-    code: str
\ No newline at end of file
+    code: str
+
+# --- Response Models ---
+# Read routes fetch exactly these fields from Mongo (see projection()) and
+# return the documents as they come back; the codec encodes ObjectId.
+class UserDetailsModel(BaseModel):
+    id: str = Field(alias="_id")
+    name: str
+    email: EmailStr
+
+class ShipmentSummaryModel(BaseModel):
+    id: str = Field(alias="_id")
+    shipmentNumber: str
+    containerNumber: str
+    goodsType: str
+    route: str
+    deliveryDate: str
+    status: str
+    description: str
+    # Unix time of creation; the page formats it
+    timestamp: int
+
+class DeviceReadingModel(BaseModel):
+    id: str = Field(alias="_id")
+    Device_ID: Union[int, str]
+    Battery_Level: Optional[float] = None
+    First_Sensor_temperature: Optional[float] = None
+    Route_From: Optional[str] = None
+    Route_To: Optional[str] = None
+
+def response_fields(model: Type[BaseModel]) -> List[str]:
+    """Document field names of a response model (aliases, i.e. `_id`)."""
+    return [field.alias or name for name, field in model.model_fields.items()]
+
+def projection(model: Type[BaseModel]) -> Dict[str, int]:
+    """Mongo projection returning only the fields of `model`."""
+    return {name: 1 for name in response_fields(model)}
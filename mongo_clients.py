@@ -0,0 +1,129 @@
+"""
+One place to build MongoClients, shared by every service.
+
+Each service gets a pool profile sized for how it uses Mongo:
+
+    web             sync routes run on the threadpool (40 threads), one
+                    connection each at most; waits for a connection are
+                    capped so a saturated pool fails a request instead of
+                    stalling it
+    consumer        one pipeline thread plus checkpoints and the lag probe
+    async_consumer  one connection per writer task plus headroom (the
+                    caller passes max_pool_size=writers + 2)
+    backfill        one connection per replay thread plus headroom
+    archiver        one export cursor and its deletes
+
+Writes always go to the primary. Analytics reads (lane summaries, archive
+exports) tolerate a little staleness and go through analytics(), which
+prefers a secondary so they stay off the primary that ingest depends on.
+On a standalone server or without secondaries this is the primary again.
+
+MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_MAX_IDLE_TIME_MS and
+MONGO_WAIT_QUEUE_TIMEOUT_MS override the profile of the process they are
+set for. Every client reports command latency and pool checkout waits
+(see metrics.py), labelled with its profile name.
+"""
+import os
+from typing import Any, Dict, NamedTuple, Optional
+
+from pymongo import MongoClient
+from pymongo.read_preferences import Primary, SecondaryPreferred
+
+from metrics import MongoCommandMetrics, MongoPoolMetrics
+
+# Read preference for analytics(): 'secondaryPreferred' or 'primary'
+MONGO_ANALYTICS_READ_PREFERENCE = os.environ.get('MONGO_ANALYTICS_READ_PREFERENCE', 'secondaryPreferred')
+# Skip secondaries lagging more than this (0: no limit; otherwise at least 90)
+MONGO_ANALYTICS_MAX_STALENESS_SECONDS = int(os.environ.get('MONGO_ANALYTICS_MAX_STALENESS_SECONDS', 0))
+
+
+class PoolProfile(NamedTuple):
+    max_pool_size: int
+    min_pool_size: int = 0
+    # Idle connections above min_pool_size are closed after this long
+    max_idle_time_ms: Optional[int] = 60000
+    # None: wait for a connection as long as the operation allows
+    wait_queue_timeout_ms: Optional[int] = None
+    # None: no socket timeout (long bulk writes and checkpoints)
+    socket_timeout_ms: Optional[int] = None
+
+
+PROFILES: Dict[str, PoolProfile] = {
+    "web": PoolProfile(max_pool_size=40, min_pool_size=4, wait_queue_timeout_ms=2000, socket_timeout_ms=30000),
+    "consumer": PoolProfile(max_pool_size=4, min_pool_size=1),
+    "async_consumer": PoolProfile(max_pool_size=10, min_pool_size=1),
+    "backfill": PoolProfile(max_pool_size=10, max_idle_time_ms=None),
+    "archiver": PoolProfile(max_pool_size=2),
+}
+
+SERVER_SELECTION_TIMEOUT_MS = 5000
+CONNECT_TIMEOUT_MS = 10000
+
+_ENV_OVERRIDES = {
+    "max_pool_size": "MONGO_MAX_POOL_SIZE",
+    "min_pool_size": "MONGO_MIN_POOL_SIZE",
+    "max_idle_time_ms": "MONGO_MAX_IDLE_TIME_MS",
+    "wait_queue_timeout_ms": "MONGO_WAIT_QUEUE_TIMEOUT_MS",
+}
+
+
+def resolve_profile(name: str, **overrides) -> PoolProfile:
+    """The named profile with call-site overrides, then environment overrides, applied."""
+    if name not in PROFILES:
+        raise ValueError(f"Unknown Mongo pool profile '{name}'; expected one of {sorted(PROFILES)}")
+    profile = PROFILES[name]._replace(**overrides)
+    from_env = {field: int(os.environ[env]) for field, env in _ENV_OVERRIDES.items() if os.environ.get(env)}
+    return profile._replace(**from_env)
+
+
+def client_options(name: str, event_listeners=(), **overrides) -> Dict[str, Any]:
+    """Keyword arguments for MongoClient (or Motor) under the named profile."""
+    profile = resolve_profile(name, **overrides)
+    options = {
+        "appname": f"scm-{name}",
+        "maxPoolSize": profile.max_pool_size,
+        "minPoolSize": min(profile.min_pool_size, profile.max_pool_size),
+        "maxIdleTimeMS": profile.max_idle_time_ms,
+        "socketTimeoutMS": profile.socket_timeout_ms,
+        "serverSelectionTimeoutMS": SERVER_SELECTION_TIMEOUT_MS,
+        "connectTimeoutMS": CONNECT_TIMEOUT_MS,
+        "retryWrites": True,
+        "retryReads": True,
+        "read_preference": Primary(),
+        "event_listeners": [MongoCommandMetrics(), MongoPoolMetrics(name), *event_listeners],
+    }
+    if profile.wait_queue_timeout_ms is not None:
+        options["waitQueueTimeoutMS"] = profile.wait_queue_timeout_ms
+    return options
+
+
+def create_client(uri: str, name: str, event_listeners=(), connect: bool = True, **overrides) -> MongoClient:
+    """
+    A MongoClient for the named profile. Creating it does not block: servers
+    are discovered in the background and the first operation waits for them
+    up to SERVER_SELECTION_TIMEOUT_MS.
+    """
+    return MongoClient(uri, connect=connect, **client_options(name, event_listeners, **overrides))
+
+
+def create_motor_client(uri: str, name: str, event_listeners=(), **overrides):
+    """The asyncio (Motor) counterpart of create_client(); needs the motor package."""
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    return AsyncIOMotorClient(uri, **client_options(name, event_listeners, **overrides))
+
+
+def analytics_read_preference():
+    if MONGO_ANALYTICS_READ_PREFERENCE == "primary":
+        return Primary()
+    if MONGO_ANALYTICS_READ_PREFERENCE != "secondaryPreferred":
+        raise ValueError(
+            f"MONGO_ANALYTICS_READ_PREFERENCE must be 'secondaryPreferred' or 'primary', "
+            f"not '{MONGO_ANALYTICS_READ_PREFERENCE}'"
+        )
+    return SecondaryPreferred(max_staleness=MONGO_ANALYTICS_MAX_STALENESS_SECONDS or -1)
+
+
+def analytics(database_or_collection):
+    """The same database or collection, reading with the analytics read preference."""
+    return database_or_collection.with_options(read_preference=analytics_read_preference())
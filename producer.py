@@ -1,15 +1,18 @@
+import signal
 import socket
-import json
+import threading
 from kafka import KafkaProducer
 import logging
 import time
 import os
 from kafka.errors import NoBrokersAvailable
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+from kafka.partitioner import DefaultPartitioner
+import codec
+import wire_format
+import metrics
+from logging_setup import configure_logging
+from spool import DiskSpool, Outbox, Record
+# Logging is configured in the entry point (see logging_setup.py)
 logger = logging.getLogger(__name__)
 
 # Configuration
@@ -22,17 +25,86 @@ KAFKA_BOOTSTRAP_SERVERS = os.environ.get('KAFKA_BOOTSTRAP_SERVERS', 'localhost:9
 
 KAFKA_TOPIC = os.environ.get('KAFKA_TOPIC', 'device_stream_data')
 BUFFER_SIZE = int(os.environ.get('BUFFER_SIZE', 4096))
+# Set to 'bin1' to publish schema v1 binary records and offer it to the socket server
+WIRE_FORMAT = os.environ.get('WIRE_FORMAT', wire_format.FORMAT_JSON)
+HANDSHAKE_TIMEOUT = 2.0
+
+# Port of the /metrics listener (0 disables it)
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9101))
+
+# Outbox (see spool.py): records wait in memory, then in the disk spool,
+# while Kafka is slow or down; socket reads pause when both are full
+SPOOL_PATH = os.environ.get('SPOOL_PATH', 'spool/producer.spool')
+SPOOL_MAX_BYTES = int(os.environ.get('SPOOL_MAX_BYTES', 256 * 1024 * 1024))
+MEMORY_QUEUE_RECORDS = int(os.environ.get('MEMORY_QUEUE_RECORDS', 10000))
+SEND_BATCH_RECORDS = int(os.environ.get('SEND_BATCH_RECORDS', 500))
+# How long a send may wait for metadata or buffer space before counting as failed
+KAFKA_MAX_BLOCK_MS = int(os.environ.get('KAFKA_MAX_BLOCK_MS', 10000))
+KAFKA_RETRY_MAX_SECONDS = 30
+
+MESSAGES_TOTAL = metrics.counter(
+    "producer_messages_total", "Readings handled by the producer", ["outcome"]
+)
+KAFKA_SEND_SECONDS = metrics.histogram(
+    "producer_kafka_send_duration_seconds", "Time to send and flush one batch to Kafka"
+)
+KAFKA_UP = metrics.gauge(
+    "producer_kafka_up", "1 while the last send to Kafka succeeded"
+)
+SOCKET_BATCH_SIZE = metrics.histogram(
+    "producer_socket_batch_size", "Readings decoded per socket read", buckets=metrics.SIZE_BUCKETS
+)
+SOCKET_BYTES_TOTAL = metrics.counter(
+    "producer_socket_bytes_total", "Bytes read from the socket server"
+)
+
+# 'murmur2' (Kafka's default, Java-client compatible) or 'modulo' (Device_ID % partitions)
+PARTITIONER = os.environ.get('PARTITIONER', 'murmur2')
+
+def modulo_partitioner(key, all_partitions, available):
+    """Map numeric Device_ID keys straight onto partitions; hash anything else."""
+    try:
+        return all_partitions[int(key) % len(all_partitions)]
+    except (TypeError, ValueError):
+        return DefaultPartitioner()(key, all_partitions, available)
+
+PARTITIONERS = {
+    'murmur2': DefaultPartitioner(),
+    'modulo': modulo_partitioner,
+}
+
+def _serialize_value(value):
+    """Binary payloads are already encoded; everything else goes out as JSON."""
+    if isinstance(value, bytes):
+        return value
+    return codec.dumps(value)
+
+def _serialize_key(key):
+    if key is None or isinstance(key, bytes):
+        return key
+    return str(key).encode('utf-8')
+
+def message_key(message):
+    """Device_ID of a reading (dict or schema v1 payload), used as the Kafka key."""
+    if isinstance(message, bytes):
+        return wire_format.peek_device_id(message)
+    return message.get('Device_ID')
 
 def create_kafka_producer(max_retries=10, retry_interval_seconds=5):
     """Create and return a Kafka producer instance with retry logic."""
+    if PARTITIONER not in PARTITIONERS:
+        raise ValueError(f"Unknown PARTITIONER '{PARTITIONER}', expected one of {sorted(PARTITIONERS)}")
     attempt = 0
     while attempt < max_retries:
         try:
             producer = KafkaProducer(
                 bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
-                value_serializer=lambda v: json.dumps(v).encode('utf-8'),
+                key_serializer=_serialize_key,
+                value_serializer=_serialize_value,
+                partitioner=PARTITIONERS[PARTITIONER],
                 acks='all',
-                retries=3
+                retries=3,
+                max_block_ms=KAFKA_MAX_BLOCK_MS
             )
             logger.info("Successfully connected to Kafka")
             return producer
@@ -65,49 +137,188 @@ def connect_to_socket_server(host, port):
             logger.error(f"Error connecting to socket server: {e}")
             raise
 
-def process_messages(sock, producer):
-    """Continuously receive and process messages from the socket server."""
-    buffer = ""
+def negotiate_format(sock):
+    """
+    Offer the binary format to the socket server when it is enabled.
+    Returns the selected format and any bytes already read past the handshake.
+    """
+    if WIRE_FORMAT != wire_format.FORMAT_BINARY:
+        return wire_format.FORMAT_JSON, b""
+
+    sock.sendall(wire_format.hello_line())
+    sock.settimeout(HANDSHAKE_TIMEOUT)
+    data = b""
+    try:
+        while b"\n" not in data:
+            chunk = sock.recv(BUFFER_SIZE)
+            if not chunk:
+                break
+            data += chunk
+    except socket.timeout:
+        pass
+    finally:
+        sock.settimeout(None)
+
+    line, separator, remainder = data.partition(b"\n")
+    selected = wire_format.parse_format(line)
+    if selected is None:
+        # Older server: it ignored the HELLO and is already streaming JSON
+        return wire_format.FORMAT_JSON, data
+    return selected, remainder
+
+def encode_record(message):
+    """
+    Encode one reading in the configured wire format, ready for the outbox.
+    Records are keyed by Device_ID so each device keeps its order on one partition.
+    """
+    key = _serialize_key(message_key(message))
+    # Receive time is the event time downstream, however late the record is sent
+    received_ms = int(time.time() * 1000)
+    if isinstance(message, bytes):
+        # Already a schema v1 payload from the socket, forward it untouched
+        return Record(key, message, binary=True, timestamp_ms=received_ms)
+    if WIRE_FORMAT == wire_format.FORMAT_BINARY:
+        return Record(key, wire_format.encode_reading(message), binary=True, timestamp_ms=received_ms)
+    return Record(key, codec.dumps(message), timestamp_ms=received_ms)
+
+def send_batch(producer, records):
+    """Send records to Kafka and wait until all are acknowledged; raises on any failure."""
+    futures = [
+        producer.send(
+            KAFKA_TOPIC,
+            key=record.key,
+            value=record.value,
+            headers=wire_format.kafka_headers(wire_format.FORMAT_BINARY if record.binary else wire_format.FORMAT_JSON),
+            timestamp_ms=record.timestamp_ms
+        )
+        for record in records
+    ]
+    producer.flush(timeout=KAFKA_MAX_BLOCK_MS / 1000)
+    for future in futures:
+        future.get(timeout=0)
+
+class KafkaSender(threading.Thread):
+    """
+    Drains the outbox into Kafka in batches. A batch is committed only once
+    Kafka acknowledged every record in it; on failure it is retried with
+    backoff, so records are delivered at least once and in order.
+    """
+
+    def __init__(self, outbox):
+        super().__init__(name="kafka-sender", daemon=True)
+        self.outbox = outbox
+        self.producer = None
+        self.stopping = threading.Event()
+
+    def run(self):
+        delay = 1
+        while not self.stopping.is_set():
+            if self.producer is None:
+                try:
+                    self.producer = create_kafka_producer(max_retries=1)
+                except Exception:
+                    # Keep reading the socket meanwhile; records go to the outbox
+                    self.stopping.wait(delay)
+                    delay = min(delay * 2, KAFKA_RETRY_MAX_SECONDS)
+                    continue
+
+            records, source, nbytes = self.outbox.take(SEND_BATCH_RECORDS, timeout=1.0)
+            if not records:
+                continue
+            try:
+                with KAFKA_SEND_SECONDS.time():
+                    send_batch(self.producer, records)
+            except Exception as e:
+                KAFKA_UP.set(0)
+                MESSAGES_TOTAL.inc(len(records), outcome="retried")
+                logger.warning(
+                    f"Kafka send failed ({e}); {self.outbox.pending()} records waiting, retrying in {delay}s",
+                    extra={"sample": "send_failed"}
+                )
+                self.stopping.wait(delay)
+                delay = min(delay * 2, KAFKA_RETRY_MAX_SECONDS)
+                continue
+
+            delay = 1
+            KAFKA_UP.set(1)
+            self.outbox.commit(len(records), source, nbytes)
+            MESSAGES_TOTAL.inc(len(records), outcome="sent")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "Sent to Kafka",
+                    extra={"sample": "sent", "topic": KAFKA_TOPIC, "records": len(records), "source": source}
+                )
+
+    def stop(self, timeout: float):
+        """
+        Let the batch in flight finish, then close the producer within `timeout`.
+        The join has no timeout of its own: the thread exits once its current
+        send returns, which KAFKA_MAX_BLOCK_MS bounds. Returning earlier would
+        leave it using the outbox while the caller closes it.
+        """
+        self.stopping.set()
+        self.join()
+        if self.producer is not None:
+            self.producer.close(timeout=timeout)
+            logger.info("Kafka producer closed")
+
+def _extract_messages(buffer, selected_format):
+    """Pop complete messages off the buffer: payload bytes for binary, dicts for JSON."""
+    if selected_format == wire_format.FORMAT_BINARY:
+        return wire_format.split_frames(buffer)
+
+    messages = []
+    # **FIXED**: Using the robust '\n' delimiter for message separation
+    while b'\n' in buffer:
+        # Find the first '\n' to delimit one JSON object
+        index = buffer.index(b'\n')
+        json_str = bytes(buffer[:index]).strip()
+        del buffer[:index + 1] # The rest is the new buffer
+
+        # Skip empty strings that might result from double-newlines
+        if not json_str:
+            continue
+
+        try:
+            messages.append(codec.loads(json_str))
+        except codec.JSONDecodeError:
+            MESSAGES_TOTAL.inc(outcome="invalid")
+            logger.warning(f"Invalid JSON: {json_str}")
+    return messages
+
+def process_messages(sock, outbox):
+    """
+    Continuously receive messages from the socket server and queue them for
+    Kafka. outbox.put() blocks while the spool is full, which stops the
+    reads and lets TCP flow control slow the server down.
+    """
+    selected_format, pending = negotiate_format(sock)
+    logger.info(f"Using wire format '{selected_format}' with the socket server")
+    buffer = bytearray(pending)
     while True:
         try:
+            messages = _extract_messages(buffer, selected_format)
+            if messages:
+                SOCKET_BATCH_SIZE.observe(len(messages))
+            for message in messages:
+                try:
+                    outbox.put(encode_record(message))
+                except Exception as e:
+                    MESSAGES_TOTAL.inc(outcome="failed")
+                    logger.error(f"Error processing message: {e}")
+
             # Receive data
             data = sock.recv(BUFFER_SIZE)
             if not data:
                 logger.warning("Connection closed by server")
                 return False
 
-            # Decode and process the data
-            buffer += data.decode('utf-8')
-            
-            # Process complete JSON objects (this handles chunked data)
-            # **FIXED**: Using the robust '\n' delimiter for message separation
-            while '\n' in buffer:
-                # Find the first '\n' to delimit one JSON object
-                json_str, _, remainder = buffer.partition('\n')
-                buffer = remainder # The rest is the new buffer
-                
-                # Strip whitespace (important if server sends extra spaces/newlines)
-                json_str = json_str.strip()
-                
-                # Skip empty strings that might result from double-newlines
-                if not json_str:
-                    continue
-                
-                try:
-                    # Parse the JSON data
-                    message = json.loads(json_str)
-                    logger.info(f"Received message: {message}")
-                    
-                    # Send to Kafka
-                    producer.send(KAFKA_TOPIC, value=message)
-                    producer.flush()
-                    logger.info(f"Sent to Kafka topic '{KAFKA_TOPIC}': {message}")
-                    
-                except json.JSONDecodeError:
-                    logger.warning(f"Invalid JSON: {json_str}")
-                except Exception as e:
-                    logger.error(f"Error processing message: {e}")
+            SOCKET_BYTES_TOTAL.inc(len(data))
+            buffer += data
         
+        except wire_format.WireFormatError as e:
+            logger.error(f"Malformed frame from socket server: {e}")
+            return True  # Reconnect to resynchronise the stream
         except socket.error as e:
             logger.error(f"Socket error: {e}")
             return False
@@ -115,30 +326,51 @@ def process_messages(sock, producer):
             logger.error(f"Unexpected error: {e}")
             return True  # Return True to attempt reconnection
 
+def _handle_shutdown_signal(signal_number, frame):
+    raise KeyboardInterrupt
+
 def main():
-    producer = create_kafka_producer()
-    
-    while True:
-        sock = connect_to_socket_server(SOCKET_SERVER, SOCKET_PORT)
-        try:
-            should_reconnect = process_messages(sock, producer)
-            if not should_reconnect:
-                break
-        except KeyboardInterrupt:
-            logger.info("Shutting down...")
-            break
-        except Exception as e:
-            logger.error(f"Unexpected error in main loop: {e}")
-        finally:
-            if sock:
-                sock.close()
-                logger.info("Socket connection closed")
-            
-        # Wait before reconnecting
-        time.sleep(5)
-    
-    producer.close()
-    logger.info("Kafka producer closed")
+    configure_logging("producer")
+    metrics.start_http_server(METRICS_PORT)
+    if PARTITIONER not in PARTITIONERS:
+        raise ValueError(f"Unknown PARTITIONER '{PARTITIONER}', expected one of {sorted(PARTITIONERS)}")
+    # Kafka may be down at startup: the sender connects in the background
+    # while readings are already being spooled
+    outbox = Outbox(DiskSpool(SPOOL_PATH, SPOOL_MAX_BYTES), MEMORY_QUEUE_RECORDS)
+    sender = KafkaSender(outbox)
+    sender.start()
+
+    # docker stop sends SIGTERM: leave the loop as on Ctrl-C, so the records
+    # still in memory reach Kafka or the spool below
+    signal.signal(signal.SIGTERM, _handle_shutdown_signal)
+    try:
+        while True:
+            sock = None
+            try:
+                sock = connect_to_socket_server(SOCKET_SERVER, SOCKET_PORT)
+                should_reconnect = process_messages(sock, outbox)
+                if not should_reconnect:
+                    break
+            except Exception as e:
+                logger.error(f"Unexpected error in main loop: {e}")
+            finally:
+                if sock:
+                    sock.close()
+                    logger.info("Socket connection closed")
+
+            # Wait before reconnecting
+            time.sleep(5)
+    except KeyboardInterrupt:
+        logger.info("Shutting down...")
+    # A second signal must not cut the shutdown short
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    sender.stop(timeout=10)
+    # Only once the sender thread has exited: whatever is still in memory
+    # goes to the spool for the next run
+    outbox.close()
+    logger.info(f"Outbox closed with {outbox.spool.records} records spooled")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
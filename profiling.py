@@ -0,0 +1,382 @@
+"""
+Opt-in request profiling for the web app (PROFILING_ENABLED=true).
+
+When enabled, main.py installs profile_requests() as HTTP middleware. Every
+request then gets a RequestProfile that collects time spent per phase:
+
+    auth           get_current_user (token check and user lookup)
+    mongo          every Mongo command issued while serving the request
+    serialization  rendering JSON responses (ProfiledJSONResponse)
+    templates      rendering Jinja2 pages (ProfiledTemplates)
+
+Phases can overlap (the auth lookup is also Mongo time). The breakdown is
+returned in a Server-Timing header, exported as a histogram and kept in a
+small ring buffer for /admin/profiling.
+
+Mongo commands slower than the slow-query threshold are recorded together
+with their explain plan; the explain runs on a background thread so the
+slow request is not made slower. A request can also be profiled with cProfile
+or pyinstrument, either by sending "X-Profile: cprofile|pyinstrument" or by
+sampling (PROFILE_SAMPLE_RATE). Only one request is profiled at a time.
+"""
+import asyncio
+import contextvars
+import cProfile
+import functools
+import io
+import itertools
+import logging
+import pstats
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+from fastapi.routing import APIRoute
+from fastapi.templating import Jinja2Templates
+from pymongo import monitoring
+
+import metrics
+from codec import FastJSONResponse
+from config import settings
+
+try:
+    from pyinstrument import Profiler as PyinstrumentProfiler
+except ImportError:
+    PyinstrumentProfiler = None
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "x-profile"
+PROFILER_CPROFILE = "cprofile"
+PROFILER_PYINSTRUMENT = "pyinstrument"
+PHASES = ("auth", "mongo", "serialization", "templates")
+# Commands the server can explain; anything else is recorded without a plan
+EXPLAINABLE_COMMANDS = {"find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"}
+# Command fields that are driver bookkeeping rather than part of the query
+_DRIVER_FIELDS = {"lsid", "txnNumber", "$clusterTime", "$db", "$readPreference", "signature"}
+# Lines of cProfile output kept per profile
+CPROFILE_LINES = 40
+
+PHASE_SECONDS = metrics.histogram(
+    "http_request_phase_seconds", "Time spent per request phase (profiling enabled only)", ["route", "phase"]
+)
+
+_current: contextvars.ContextVar[Optional["RequestProfile"]] = contextvars.ContextVar("request_profile", default=None)
+
+
+class RequestProfile:
+    """Timing collected for one request; shared by every thread serving it."""
+
+    def __init__(self, method: str, path: str, profiler: Optional[str] = None):
+        self.method = method
+        self.path = path
+        self.route = None
+        self.status = None
+        self.profiler = profiler
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.duration = None
+        self.phases: Dict[str, float] = {}
+        # cProfile/pyinstrument report, when the request was profiled
+        self.report: Optional[str] = None
+        self.pending_commands: Dict[int, dict] = {}
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def finish(self, route: Optional[str], status: int):
+        self.route = route
+        self.status = status
+        self.duration = time.perf_counter() - self._started
+
+    def server_timing(self) -> str:
+        entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.phases.items()]
+        entries.append(f"total;dur={self.duration * 1000:.2f}")
+        return ", ".join(entries)
+
+    def to_dict(self) -> dict:
+        return {
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "status": self.status,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 3),
+            "phases_ms": {name: round(seconds * 1000, 3) for name, seconds in self.phases.items()},
+            "profiler": self.profiler,
+        }
+
+
+def current_profile() -> Optional[RequestProfile]:
+    return _current.get()
+
+
+@contextmanager
+def phase(name: str):
+    """Add the duration of the with-block to the current request's `name` phase."""
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - started)
+
+
+# ------------------ RESULT STORE ------------------
+
+class ProfileStore:
+    """Bounded, in-memory history of requests, slow queries and profiles."""
+
+    def __init__(self, max_requests: int = 200, max_slow_queries: int = 100, max_profiles: int = 20):
+        self.lock = threading.Lock()
+        self.requests = deque(maxlen=max_requests)
+        self.slow_queries = deque(maxlen=max_slow_queries)
+        self.profiles = deque(maxlen=max_profiles)
+        self._ids = itertools.count(1)
+
+    def add_request(self, profile: RequestProfile):
+        with self.lock:
+            self.requests.append(profile.to_dict())
+
+    def add_slow_query(self, entry: dict) -> dict:
+        with self.lock:
+            entry["id"] = next(self._ids)
+            self.slow_queries.append(entry)
+        return entry
+
+    def add_profile(self, profile: RequestProfile):
+        with self.lock:
+            entry = dict(profile.to_dict(), id=next(self._ids), output=profile.report)
+            self.profiles.append(entry)
+
+    def get_profile(self, profile_id: int) -> Optional[dict]:
+        with self.lock:
+            for entry in self.profiles:
+                if entry["id"] == profile_id:
+                    return entry
+        return None
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "requests": list(self.requests),
+                "slow_queries": list(self.slow_queries),
+                # Profile bodies can be large; fetch them one at a time
+                "profiles": [{k: v for k, v in p.items() if k != "output"} for p in self.profiles],
+            }
+
+
+# ------------------ PROFILER ------------------
+
+class Profiler:
+    """
+    Profiling state shared by the middleware, the endpoint wrappers and the
+    Mongo listener. The module-level `profiler` is built from settings.
+    """
+
+    def __init__(self, slow_query_ms: float = 100, sample_rate: float = 0.0, store: Optional[ProfileStore] = None):
+        self.slow_query_seconds = slow_query_ms / 1000.0
+        self.sample_rate = sample_rate
+        self.store = store or ProfileStore()
+        self.explain: Optional[Callable[[str, dict], dict]] = None
+        self._explain_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="explain")
+        # cProfile and pyinstrument both hook the interpreter; run one at a time
+        self._profiler_lock = threading.Lock()
+
+    def choose_profiler(self, requested: Optional[str]) -> Optional[str]:
+        """Profiler for a request: the one named in the X-Profile header, else sampled."""
+        requested = (requested or "").strip().lower()
+        if requested not in (PROFILER_CPROFILE, PROFILER_PYINSTRUMENT):
+            if not requested and (not self.sample_rate or random.random() >= self.sample_rate):
+                return None
+            requested = PROFILER_PYINSTRUMENT
+        if requested == PROFILER_PYINSTRUMENT and PyinstrumentProfiler is None:
+            requested = PROFILER_CPROFILE
+        return requested
+
+    async def profile_requests(self, request, call_next):
+        """HTTP middleware: time the request, and run a profiler if asked to."""
+        profile = RequestProfile(
+            request.method, request.url.path, self.choose_profiler(request.headers.get(PROFILE_HEADER))
+        )
+        token = _current.set(profile)
+        status_code = 500
+        try:
+            response = await call_next(request)
+            status_code = response.status_code
+        finally:
+            _current.reset(token)
+            route = getattr(request.scope.get("route"), "path", None)
+            profile.finish(route, status_code)
+            self.store.add_request(profile)
+            if profile.report is not None:
+                self.store.add_profile(profile)
+            for name, seconds in profile.phases.items():
+                PHASE_SECONDS.observe(seconds, route=route or "unmatched", phase=name)
+        response.headers["Server-Timing"] = profile.server_timing()
+        return response
+
+    # ---- endpoint profiling ----
+
+    @contextmanager
+    def _profiling(self, profile: Optional[RequestProfile]):
+        """Run the with-block under the profiler the request asked for, if it is free."""
+        if profile is None or profile.profiler is None:
+            yield
+            return
+        if not self._profiler_lock.acquire(blocking=False):
+            profile.profiler = None
+            yield
+            return
+        stop = _start_profiler(profile.profiler)
+        try:
+            yield
+        finally:
+            try:
+                profile.report = stop()
+            finally:
+                self._profiler_lock.release()
+
+    def wrap_endpoint(self, endpoint):
+        """
+        Profile the endpoint where it actually runs: sync endpoints execute in
+        the threadpool, and both profilers only see the thread they start on.
+        For async endpoints the profile also includes whatever other requests
+        ran on the event loop while this one was awaiting.
+        """
+        if asyncio.iscoroutinefunction(endpoint):
+            @functools.wraps(endpoint)
+            async def profiled_async(*args, **kwargs):
+                with self._profiling(_current.get()):
+                    return await endpoint(*args, **kwargs)
+            return profiled_async
+
+        @functools.wraps(endpoint)
+        def profiled_sync(*args, **kwargs):
+            with self._profiling(_current.get()):
+                return endpoint(*args, **kwargs)
+        return profiled_sync
+
+    def route_class(self):
+        """APIRoute subclass that wraps every endpoint with wrap_endpoint()."""
+        profiler = self
+
+        class ProfiledRoute(APIRoute):
+            def __init__(self, path, endpoint, **kwargs):
+                super().__init__(path, profiler.wrap_endpoint(endpoint), **kwargs)
+
+        return ProfiledRoute
+
+    # ---- slow queries ----
+
+    def record_slow_query(self, database_name: str, command_name: str, command: dict, seconds: float, profile):
+        entry = self.store.add_slow_query({
+            "database": database_name,
+            "command_name": command_name,
+            "command": command,
+            "duration_ms": round(seconds * 1000, 3),
+            "path": profile.path if profile else None,
+            "recorded_at": time.time(),
+            "plan": None,
+        })
+        logger.warning(
+            "Slow Mongo command",
+            extra={"command_name": command_name, "duration_ms": entry["duration_ms"], "path": entry["path"]}
+        )
+        if self.explain is not None and command_name in EXPLAINABLE_COMMANDS:
+            self._explain_executor.submit(self._attach_plan, entry, database_name, command)
+
+    def _attach_plan(self, entry: dict, database_name: str, command: dict):
+        try:
+            result = self.explain(database_name, command)
+            entry["plan"] = result.get("queryPlanner", {}).get("winningPlan", result)
+        except Exception as e:
+            entry["plan"] = {"error": str(e)}
+
+
+class SlowQueryListener(monitoring.CommandListener):
+    """
+    Adds Mongo time to the current request's "mongo" phase and reports
+    commands slower than the profiler's threshold. Costs one context-var
+    lookup per command when no request is being profiled.
+    """
+
+    def __init__(self, profiler: Profiler):
+        self.profiler = profiler
+
+    def started(self, event):
+        profile = _current.get()
+        if profile is not None:
+            profile.pending_commands[event.request_id] = event.command
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event)
+
+    def _finish(self, event):
+        profile = _current.get()
+        if profile is None:
+            return
+        seconds = event.duration_micros / 1e6
+        profile.add("mongo", seconds)
+        command = profile.pending_commands.pop(event.request_id, None)
+        if seconds >= self.profiler.slow_query_seconds and command is not None:
+            self.profiler.record_slow_query(
+                event.database_name, event.command_name, _strip_driver_fields(command), seconds, profile
+            )
+
+
+# ------------------ PROFILED RESPONSE / TEMPLATE CLASSES ------------------
+
+class ProfiledJSONResponse(FastJSONResponse):
+    """FastJSONResponse that counts its render time as "serialization"."""
+
+    def render(self, content):
+        with phase("serialization"):
+            return super().render(content)
+
+
+class ProfiledTemplates(Jinja2Templates):
+    """Jinja2Templates that counts rendering as "templates"."""
+
+    def TemplateResponse(self, *args, **kwargs):
+        with phase("templates"):
+            return super().TemplateResponse(*args, **kwargs)
+
+
+def _strip_driver_fields(command) -> dict:
+    return {key: value for key, value in command.items() if key not in _DRIVER_FIELDS}
+
+
+def _start_profiler(kind: str) -> Callable[[], str]:
+    """Start a profiler of the given kind; the returned callable stops it and returns its report."""
+    if kind == PROFILER_PYINSTRUMENT:
+        profiler = PyinstrumentProfiler()
+        profiler.start()
+
+        def stop():
+            profiler.stop()
+            return profiler.output_text(unicode=True)
+        return stop
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    def stop():
+        profiler.disable()
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(CPROFILE_LINES)
+        return output.getvalue()
+    return stop
+
+
+profiler = Profiler(slow_query_ms=settings.SLOW_QUERY_MS, sample_rate=settings.PROFILE_SAMPLE_RATE)
@@ -0,0 +1,187 @@
+"""
+Rate limiting and admission control for the expensive auth endpoints.
+
+RateLimiter is a token bucket: each key (an IP or an email, per route) holds
+up to `burst` tokens and regains `rate` tokens per second; a request that
+finds no token is rejected straight away with 429 and a Retry-After header.
+Buckets live in a BucketStore:
+
+    MemoryBucketStore  per process; fine for a single worker.
+    MongoBucketStore   shared by every worker and replica; one atomic
+                       find_one_and_update per check, idle buckets expire
+                       through a TTL index.
+
+ConcurrencyLimiter caps how many requests may be inside a costly section
+(bcrypt, SMTP) at once in this worker. It never queues: when every slot is
+taken the request fails fast instead of adding to the latency of the ones
+already running.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+
+from fastapi import HTTPException, status
+from pymongo import ReturnDocument
+
+import metrics
+
+RATE_LIMITED_TOTAL = metrics.counter(
+    "rate_limited_requests_total", "Requests rejected by rate limiting or admission control", ["route", "scope"]
+)
+
+_UNITS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+def parse_rate(spec: str) -> Tuple[float, float]:
+    """'10/minute' -> (10 / 60 tokens per second, burst of 10)."""
+    count, _, unit = spec.partition("/")
+    unit = unit.strip().lower().rstrip("s")
+    if unit not in _UNITS:
+        raise ValueError(f"Invalid rate '{spec}': expected '<count>/<second|minute|hour|day>'")
+    try:
+        count = float(count)
+    except ValueError:
+        count = math.nan
+    # A count of zero would divide by zero when refilling the bucket
+    if not (math.isfinite(count) and count > 0):
+        raise ValueError(f"Invalid rate '{spec}': the count must be a positive number")
+    return count / _UNITS[unit], count
+
+
+class MemoryBucketStore:
+    """Token buckets in a dict, bounded by evicting the least recently used keys."""
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: float, cost: float = 1.0) -> float:
+        """Take `cost` tokens; returns 0 if allowed, otherwise seconds until it would be."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class MongoBucketStore:
+    """
+    Token buckets in a Mongo collection, shared across workers. The refill,
+    check and take happen in one pipeline update, so concurrent requests on
+    different workers cannot spend the same token.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self._indexed = False
+
+    def _ensure_index(self):
+        if not self._indexed:
+            self.collection.create_index("expires_at", expireAfterSeconds=0)
+            self._indexed = True
+
+    def take(self, key: str, rate: float, burst: float, cost: float = 1.0) -> float:
+        self._ensure_index()
+        now = time.time()
+        # An empty bucket is full again after burst / rate seconds
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=burst / rate)
+        refilled = {"$min": [burst, {"$add": [
+            {"$ifNull": ["$tokens", burst]},
+            {"$multiply": [{"$subtract": [now, {"$ifNull": ["$updated", now]}]}, rate]},
+        ]}]}
+        bucket = self.collection.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": refilled, "updated": now, "expires_at": expires_at}},
+                {"$set": {"allowed": {"$gte": ["$tokens", cost]}}},
+                {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", cost]}, "$tokens"]}}},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if bucket["allowed"]:
+            return 0.0
+        return (cost - bucket["tokens"]) / rate
+
+
+class RateLimiter:
+    """A token-bucket limit applied per key, e.g. 5/minute per email."""
+
+    def __init__(self, store, spec: str):
+        self.store = store
+        self.spec = spec
+        self.rate, self.burst = parse_rate(spec)
+
+    def hit(self, key: str, cost: float = 1.0) -> float:
+        """0 when allowed, otherwise the number of seconds to wait."""
+        return self.store.take(key, self.rate, self.burst, cost)
+
+
+class ConcurrencyLimiter:
+    """Caps concurrent entries into a section of code in this worker; never waits."""
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self._slots = threading.BoundedSemaphore(limit)
+
+    @contextmanager
+    def slot(self):
+        if not self._slots.acquire(blocking=False):
+            RATE_LIMITED_TOTAL.inc(route=self.name, scope="concurrency")
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server busy, please retry shortly.",
+                headers={"Retry-After": "1"},
+            )
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+
+class AuthRateLimits:
+    """The per-IP and per-email limits shared by the auth routes."""
+
+    def __init__(self, store, per_ip: str, per_email: str):
+        self.per_ip = RateLimiter(store, per_ip)
+        self.per_email = RateLimiter(store, per_email)
+
+    def check(self, route: str, client_ip: Optional[str], email: Optional[str] = None):
+        """Raise 429 when either bucket is empty. Buckets are separate per route."""
+        checks = [("ip", self.per_ip, client_ip)]
+        if email:
+            checks.append(("email", self.per_email, email.strip().lower()))
+        for scope, limiter, value in checks:
+            if not value:
+                continue
+            wait = limiter.hit(f"{route}:{scope}:{value}")
+            if wait > 0:
+                RATE_LIMITED_TOTAL.inc(route=route, scope=scope)
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail="Too many requests, please try again later.",
+                    headers={"Retry-After": str(max(1, math.ceil(wait)))},
+                )
+
+
+def create_bucket_store(kind: str, collection=None):
+    """'memory' for a single worker, 'mongo' to share buckets across workers."""
+    if kind == "memory":
+        return MemoryBucketStore()
+    if kind == "mongo":
+        return MongoBucketStore(collection)
+    raise ValueError(f"Unknown rate limit backend '{kind}' (expected 'memory' or 'mongo')")
@@ -0,0 +1,299 @@
+"""
+Per-user cache of read results: a user's shipment list, their account details.
+
+Entries are stored under (namespace, subject), e.g. ("shipments", "a@b.com").
+The routes that write the underlying documents invalidate them in the same
+request (write-through), so a read after a write never sees the old result.
+Entries also expire, for writes an invalidation does not reach (another
+worker's in-process cache). The TTL adapts per key (see AdaptiveTTL): a key
+that keeps being read and is never written is kept longer, up to
+max_ttl_seconds; each write halves it, down to min_ttl_seconds.
+
+Every key carries a version, bumped by invalidate(). A load that started before an invalidation cannot
+store its now-stale result, because put() only succeeds for the version
+that get() returned.
+
+    MemoryResultCache  per process, LRU-bounded to max_entries; fine for a
+                       single worker. With several workers, another worker's
+                       entry stays stale until it expires.
+    MongoResultCache   shared by every worker: one _id lookup instead of the
+                       query; a TTL index removes expired entries.
+    NullResultCache    caching off ('off'), e.g. to compare load-test runs.
+
+Lookups and stores are best effort: when Mongo fails they turn into
+misses. A failed invalidation is raised instead, because the entry would
+stay stale.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Tuple
+
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_REQUESTS_TOTAL = metrics.counter(
+    "result_cache_requests_total", "Result cache lookups by outcome", ["namespace", "outcome"]
+)
+RESULT_CACHE_INVALIDATIONS_TOTAL = metrics.counter(
+    "result_cache_invalidations_total", "Result cache entries invalidated by writes", ["namespace"]
+)
+RESULT_CACHE_EVICTIONS_TOTAL = metrics.counter(
+    "result_cache_evictions_total", "Entries dropped from the in-process result cache", ["reason"]
+)
+RESULT_CACHE_ENTRIES = metrics.gauge(
+    "result_cache_entries", "Entries held by the in-process result cache"
+)
+RESULT_CACHE_TTL_SECONDS = metrics.histogram(
+    "result_cache_ttl_seconds", "TTL given to stored result cache entries", ["namespace"],
+    buckets=(5, 15, 30, 60, 120, 300, 600, 1800, 3600),
+)
+
+
+class _Miss:
+    def __repr__(self):
+        return "MISS"
+
+
+# get() found nothing usable; distinct from a cached None
+MISS = _Miss()
+
+
+def _key(namespace: str, subject: str) -> str:
+    return f"{namespace}:{subject}"
+
+
+class AdaptiveTTL:
+    """
+    Per-key TTL between min_seconds and max_seconds, starting at
+    base_seconds. An entry that lived out its TTL without a write and is
+    then read again was dropped too early: its next TTL is twice as long.
+    A write halves it, so keys written often are cached briefly and keys
+    that are only read are cached long. Keeps at most max_keys keys, least
+    recently stored first out; a forgotten key starts again from the base.
+    """
+
+    def __init__(self, base_seconds: float, min_seconds: float, max_seconds: float,
+                 max_keys: int = 100000, clock=time.monotonic):
+        self.base_seconds = min(max(base_seconds, min_seconds), max_seconds)
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self.max_keys = max_keys
+        self.clock = clock
+        # key -> [ttl, time the entry was stored or None]; least recently stored first
+        self._keys: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def stored(self, key: str) -> float:
+        """TTL for an entry stored now."""
+        with self._lock:
+            state = self._keys.get(key)
+            if state is None:
+                state = self._keys[key] = [self.base_seconds, None]
+            state[1] = self.clock()
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+            return state[0]
+
+    def missed(self, key: str):
+        """A lookup found no entry."""
+        with self._lock:
+            state = self._keys.get(key)
+            if state is not None and state[1] is not None and self.clock() >= state[1] + state[0]:
+                state[0] = min(state[0] * 2, self.max_seconds)
+                state[1] = None
+
+    def written(self, key: str):
+        with self._lock:
+            state = self._keys.get(key)
+            if state is not None:
+                state[0] = max(state[0] / 2, self.min_seconds)
+                state[1] = None
+
+
+class ResultCache:
+    """Lookup-or-load shared by every backend."""
+
+    def get(self, namespace: str, subject: str) -> Tuple[Any, int]:
+        """(value or MISS, version to pass to put())."""
+        raise NotImplementedError
+
+    def put(self, namespace: str, subject: str, value: Any, version: int):
+        raise NotImplementedError
+
+    def invalidate(self, namespace: str, subject: str):
+        raise NotImplementedError
+
+    def get_or_load(self, namespace: str, subject: str, load: Callable[[], Any]) -> Any:
+        value, version = self.get(namespace, subject)
+        if value is not MISS:
+            RESULT_CACHE_REQUESTS_TOTAL.inc(namespace=namespace, outcome="hit")
+            return value
+        RESULT_CACHE_REQUESTS_TOTAL.inc(namespace=namespace, outcome="miss")
+        value = load()
+        self.put(namespace, subject, value, version)
+        return value
+
+
+class NullResultCache(ResultCache):
+    def get(self, namespace: str, subject: str) -> Tuple[Any, int]:
+        return MISS, 0
+
+    def put(self, namespace: str, subject: str, value: Any, version: int):
+        pass
+
+    def invalidate(self, namespace: str, subject: str):
+        RESULT_CACHE_INVALIDATIONS_TOTAL.inc(namespace=namespace)
+
+
+class MemoryResultCache(ResultCache):
+    """Least recently used entries go first once max_entries is reached."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float, min_ttl_seconds: float = 5,
+                 max_ttl_seconds: float = 600, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = AdaptiveTTL(ttl_seconds, min_ttl_seconds, max_ttl_seconds, max_entries, clock)
+        self.clock = clock
+        # key -> [version, value or MISS, expires at]; least recently used first
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, namespace: str, subject: str) -> Tuple[Any, int]:
+        key = _key(namespace, subject)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.ttl.missed(key)
+                return MISS, 0
+            if entry[1] is not MISS and entry[2] <= self.clock():
+                entry[1] = MISS
+                RESULT_CACHE_EVICTIONS_TOTAL.inc(reason="expired")
+            if entry[1] is not MISS:
+                self._entries.move_to_end(key)
+            else:
+                self.ttl.missed(key)
+            return entry[1], entry[0]
+
+    def put(self, namespace: str, subject: str, value: Any, version: int):
+        key = _key(namespace, subject)
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry[0] if entry is not None else 0) != version:
+                # Invalidated while the value was being loaded
+                return
+            ttl = self.ttl.stored(key)
+            self._entries[key] = [version, value, self.clock() + ttl]
+            self._entries.move_to_end(key)
+            self._evict()
+        RESULT_CACHE_TTL_SECONDS.observe(ttl, namespace=namespace)
+
+    def invalidate(self, namespace: str, subject: str):
+        key = _key(namespace, subject)
+        with self._lock:
+            entry = self._entries.get(key)
+            # The emptied entry keeps the new version for loads still in flight
+            self._entries[key] = [(entry[0] if entry is not None else 0) + 1, MISS, 0.0]
+            self._entries.move_to_end(key)
+            self._evict()
+            self.ttl.written(key)
+        RESULT_CACHE_INVALIDATIONS_TOTAL.inc(namespace=namespace)
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            RESULT_CACHE_EVICTIONS_TOTAL.inc(reason="capacity")
+        RESULT_CACHE_ENTRIES.set(len(self._entries))
+
+
+class MongoResultCache(ResultCache):
+    """
+    Entries in a Mongo collection, {_id: key, version, value, expires_at},
+    with a TTL index on expires_at. put() only updates the document whose
+    version it read. If the document moved on in the meantime, the upsert
+    collides on _id and the value is dropped. Each worker adapts the TTLs
+    from the lookups and writes it serves.
+    """
+
+    def __init__(self, collection, ttl_seconds: float, min_ttl_seconds: float = 5,
+                 max_ttl_seconds: float = 600):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self.ttl = AdaptiveTTL(ttl_seconds, min_ttl_seconds, max_ttl_seconds)
+        self._indexed = False
+
+    def _ensure_index(self):
+        if not self._indexed:
+            self.collection.create_index("expires_at", expireAfterSeconds=0)
+            self._indexed = True
+
+    @staticmethod
+    def _expires_at(ttl_seconds: float) -> datetime:
+        return datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds)
+
+    def get(self, namespace: str, subject: str) -> Tuple[Any, int]:
+        key = _key(namespace, subject)
+        try:
+            entry = self.collection.find_one({"_id": key})
+        except PyMongoError as e:
+            logger.warning(f"Result cache lookup failed: {e}")
+            return MISS, 0
+        if entry is None:
+            self.ttl.missed(key)
+            return MISS, 0
+        expires_at = entry.get("expires_at")
+        if expires_at is not None and expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        if "value" not in entry or expires_at is None or expires_at <= datetime.now(timezone.utc):
+            self.ttl.missed(key)
+            return MISS, entry.get("version", 0)
+        return entry["value"], entry.get("version", 0)
+
+    def put(self, namespace: str, subject: str, value: Any, version: int):
+        key = _key(namespace, subject)
+        try:
+            self._ensure_index()
+            ttl = self.ttl.stored(key)
+            self.collection.update_one(
+                {"_id": key, "version": version},
+                {"$set": {"value": value, "expires_at": self._expires_at(ttl)}},
+                upsert=True,
+            )
+            RESULT_CACHE_TTL_SECONDS.observe(ttl, namespace=namespace)
+        except DuplicateKeyError:
+            # Invalidated while the value was being loaded
+            pass
+        except PyMongoError as e:
+            logger.warning(f"Result cache store failed: {e}")
+
+    def invalidate(self, namespace: str, subject: str):
+        self._ensure_index()
+        # Keeps the bumped version around as long as a load could still be running
+        self.collection.update_one(
+            {"_id": _key(namespace, subject)},
+            {"$inc": {"version": 1}, "$unset": {"value": ""},
+             "$set": {"expires_at": self._expires_at(self.ttl.max_seconds)}},
+            upsert=True,
+        )
+        self.ttl.written(_key(namespace, subject))
+        RESULT_CACHE_INVALIDATIONS_TOTAL.inc(namespace=namespace)
+
+
+def create_result_cache(kind: str, collection=None, max_entries: int = 10000, ttl_seconds: float = 60,
+                        min_ttl_seconds: float = 5, max_ttl_seconds: float = 600) -> ResultCache:
+    """'memory' for a single worker, 'mongo' to share entries across workers, 'off' to disable."""
+    if kind == "memory":
+        return MemoryResultCache(max_entries, ttl_seconds, min_ttl_seconds, max_ttl_seconds)
+    if kind == "mongo":
+        return MongoResultCache(collection, ttl_seconds, min_ttl_seconds, max_ttl_seconds)
+    if kind == "off":
+        return NullResultCache()
+    raise ValueError(f"Unknown result cache backend '{kind}' (expected 'memory', 'mongo' or 'off')")
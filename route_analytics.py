@@ -0,0 +1,428 @@
+"""
+Origin-destination matrices of device readings, kept by the consumer.
+
+Route_From / Route_To strings ("Chennai, India") are interned to small
+integer location IDs. Each partition keeps a ring of time buckets; each
+bucket is a dense NumPy array indexed [origin, destination, field] holding
+the reading count and the temperature and battery sums (plus how many
+readings carried each value), so a mean is one division. Applying a
+reading is a handful of array increments, not a query.
+
+Like device_state.py, matrices are kept per Kafka partition, snapshotted to
+Mongo on checkpoints and handed off with the partition on rebalances; the
+partition offset makes replays after a hand-off idempotent. Snapshots are
+sparse: only lanes that saw readings are written.
+
+The web app merges the partition snapshots into one LaneSummaries view
+with running totals along the time axis, so a lane summary over any window
+is a couple of array lookups, independent of how many readings it covers.
+
+Memory per partition is ROUTE_BUCKETS x locations^2 x 5 float64 values;
+locations beyond ROUTE_MAX_LOCATIONS are not tracked (and counted in
+route_readings_total{outcome="overflow"}).
+"""
+import logging
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Width of one time bucket in seconds
+ROUTE_BUCKET_SECONDS = int(os.environ.get('ROUTE_BUCKET_SECONDS', 3600))
+# Buckets kept per partition; older readings fall out of the matrix
+ROUTE_BUCKETS = int(os.environ.get('ROUTE_BUCKETS', 24))
+# Longest window the rings cover, in hours (the web app caps requests to it)
+MAX_WINDOW_HOURS = ROUTE_BUCKETS * ROUTE_BUCKET_SECONDS / 3600
+# Distinct locations tracked per partition
+ROUTE_MAX_LOCATIONS = int(os.environ.get('ROUTE_MAX_LOCATIONS', 128))
+INITIAL_LOCATIONS = 16
+
+# Fields of the last matrix axis
+COUNT, TEMPERATURE_SUM, TEMPERATURE_COUNT, BATTERY_SUM, BATTERY_COUNT = range(5)
+FIELDS = 5
+
+ROUTE_READINGS_TOTAL = metrics.counter(
+    "route_readings_total", "Readings folded into the route matrix", ["outcome"]
+)
+ROUTE_LOCATIONS = metrics.gauge(
+    "route_locations", "Interned route locations", ["partition"]
+)
+
+
+def location_key(name: str) -> str:
+    """Lookup key of a location: case and whitespace insensitive."""
+    return " ".join(name.split()).casefold()
+
+
+def _number(value) -> Optional[float]:
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value):
+        return float(value)
+    return None
+
+
+class RouteInterner:
+    """Location name <-> dense integer ID, in first-seen order."""
+
+    def __init__(self, names: Iterable[str] = ()):
+        self.names: List[str] = []
+        self.ids: Dict[str, int] = {}
+        for name in names:
+            self.intern(name)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def get(self, name: str) -> Optional[int]:
+        return self.ids.get(location_key(name))
+
+    def intern(self, name: str) -> int:
+        key = location_key(name)
+        location_id = self.ids.get(key)
+        if location_id is None:
+            location_id = self.ids[key] = len(self.names)
+            self.names.append(" ".join(name.split()))
+        return location_id
+
+
+class RouteMatrix:
+    """Rolling origin-destination matrix for one assigned partition."""
+
+    def __init__(self, partition: int, bucket_seconds: int = ROUTE_BUCKET_SECONDS,
+                 buckets: int = ROUTE_BUCKETS, max_locations: int = ROUTE_MAX_LOCATIONS):
+        self.partition = partition
+        self.offset = -1
+        self.bucket_seconds = bucket_seconds
+        self.buckets = buckets
+        self.max_locations = max_locations
+        self.locations = RouteInterner()
+        # Absolute bucket number (event time // bucket_seconds) held by each slot
+        self.slot_bucket = np.full(buckets, -1, dtype=np.int64)
+        self.newest_bucket = -1
+        self.values = np.zeros((buckets, INITIAL_LOCATIONS, INITIAL_LOCATIONS, FIELDS))
+
+    def _slot(self, bucket: int) -> Optional[int]:
+        """Ring slot of `bucket`, recycling the slot if it holds an older bucket."""
+        if bucket <= self.newest_bucket - self.buckets:
+            return None
+        slot = bucket % self.buckets
+        held = self.slot_bucket[slot]
+        if held == bucket:
+            return slot
+        if held > bucket:
+            return None
+        self.values[slot] = 0
+        self.slot_bucket[slot] = bucket
+        self.newest_bucket = max(self.newest_bucket, bucket)
+        return slot
+
+    def _location(self, name: str) -> Optional[int]:
+        location_id = self.locations.get(name)
+        if location_id is not None:
+            return location_id
+        if len(self.locations) >= self.max_locations:
+            return None
+        location_id = self.locations.intern(name)
+        self._reserve(location_id + 1)
+        ROUTE_LOCATIONS.set(len(self.locations), partition=self.partition)
+        return location_id
+
+    def _reserve(self, locations: int):
+        capacity = self.values.shape[1]
+        if locations <= capacity:
+            return
+        while capacity < locations:
+            capacity *= 2
+        grown = np.zeros((self.buckets, capacity, capacity, FIELDS))
+        size = self.values.shape[1]
+        grown[:, :size, :size] = self.values
+        self.values = grown
+
+    def apply(self, offset: int, reading: Dict[str, Any], event_time: float) -> bool:
+        """Fold a reading in unless an earlier owner already did. Returns True if applied."""
+        if offset <= self.offset:
+            return False
+        self.offset = offset
+        origin, destination = reading.get("Route_From"), reading.get("Route_To")
+        if not isinstance(origin, str) or not isinstance(destination, str):
+            ROUTE_READINGS_TOTAL.inc(outcome="no_route")
+            return True
+        slot = self._slot(int(event_time // self.bucket_seconds))
+        if slot is None:
+            ROUTE_READINGS_TOTAL.inc(outcome="late")
+            return True
+        i, j = self._location(origin), self._location(destination)
+        if i is None or j is None:
+            ROUTE_READINGS_TOTAL.inc(outcome="overflow")
+            return True
+
+        cell = self.values[slot, i, j]
+        cell[COUNT] += 1
+        temperature = _number(reading.get("First_Sensor_temperature"))
+        if temperature is not None:
+            cell[TEMPERATURE_SUM] += temperature
+            cell[TEMPERATURE_COUNT] += 1
+        battery = _number(reading.get("Battery_Level"))
+        if battery is not None:
+            cell[BATTERY_SUM] += battery
+            cell[BATTERY_COUNT] += 1
+        ROUTE_READINGS_TOTAL.inc(outcome="applied")
+        return True
+
+    def to_dict(self) -> Dict[str, Any]:
+        # Slots not recycled since newest_bucket jumped ahead still hold stale buckets
+        live = self.slot_bucket > self.newest_bucket - self.buckets
+        slots, origins, destinations = np.nonzero(self.values[..., COUNT] * live[:, None, None])
+        return {
+            "partition": self.partition,
+            "offset": self.offset,
+            "bucket_seconds": self.bucket_seconds,
+            "locations": list(self.locations.names),
+            # One entry per non-empty (bucket, origin, destination) cell
+            "cells": {
+                "bucket": self.slot_bucket[slots].astype(np.int64).tobytes(),
+                "origin": origins.astype(np.int32).tobytes(),
+                "destination": destinations.astype(np.int32).tobytes(),
+                "values": self.values[slots, origins, destinations].tobytes(),
+            },
+            "updated_at": time.time(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "RouteMatrix":
+        matrix = cls(data["partition"])
+        matrix.offset = data.get("offset", -1)
+        if data.get("bucket_seconds") != matrix.bucket_seconds:
+            # Buckets of another width cannot be merged; count afresh from here
+            logger.warning(f"Route matrix of partition {matrix.partition} uses "
+                           f"{data.get('bucket_seconds')}s buckets; starting empty")
+            return matrix
+        # Restored locations keep their IDs even past the current limit
+        matrix.locations = RouteInterner(data.get("locations", []))
+        matrix._reserve(len(matrix.locations))
+        ROUTE_LOCATIONS.set(len(matrix.locations), partition=matrix.partition)
+        cells = decode_cells(data)
+        if cells is None:
+            return matrix
+        buckets, origins, destinations, values = cells
+        for bucket in np.unique(buckets):
+            slot = matrix._slot(int(bucket))
+            if slot is None:
+                continue
+            selected = buckets == bucket
+            matrix.values[slot, origins[selected], destinations[selected]] = values[selected]
+        return matrix
+
+
+def decode_cells(snapshot: Dict[str, Any]):
+    """(buckets, origins, destinations, values) arrays of a snapshot, or None if empty."""
+    cells = snapshot.get("cells") or {}
+    if not cells.get("bucket"):
+        return None
+    return (
+        np.frombuffer(cells["bucket"], dtype=np.int64),
+        np.frombuffer(cells["origin"], dtype=np.int32),
+        np.frombuffer(cells["destination"], dtype=np.int32),
+        np.frombuffer(cells["values"], dtype=np.float64).reshape(-1, FIELDS),
+    )
+
+
+class PartitionedRouteMatrix:
+    """
+    Route matrices owned by this consumer, keyed by partition; same hand-off
+    protocol and store interface as device_state.PartitionedDeviceState.
+    """
+
+    def __init__(self, topic: str, store):
+        self.topic = topic
+        self.store = store
+        self.partitions: Dict[int, RouteMatrix] = {}
+
+    def apply(self, partition: int, offset: int, reading: Dict[str, Any], event_time: float) -> bool:
+        matrix = self.partitions.get(partition)
+        if matrix is None:
+            matrix = self.partitions[partition] = RouteMatrix(partition)
+        return matrix.apply(offset, reading, event_time)
+
+    def assign(self, partitions: Iterable[int]):
+        for partition in partitions:
+            snapshot = self.store.load(self.topic, partition)
+            self.partitions[partition] = RouteMatrix.from_dict(snapshot) if snapshot else RouteMatrix(partition)
+
+    def revoke(self, partitions: Iterable[int]):
+        for partition in partitions:
+            matrix = self.partitions.pop(partition, None)
+            if matrix is not None:
+                self.store.save(self.topic, matrix.to_dict())
+
+    def snapshots(self) -> List[Dict[str, Any]]:
+        return [matrix.to_dict() for matrix in self.partitions.values()]
+
+    def checkpoint(self):
+        for snapshot in self.snapshots():
+            self.store.save(self.topic, snapshot)
+
+
+# ------------------ READ SIDE (web app) ------------------
+
+def _mean(total: float, count: float) -> Optional[float]:
+    return round(float(total / count), 3) if count else None
+
+
+class LaneSummaries:
+    """
+    Every partition's matrix merged over common location IDs, with running
+    totals along the bucket axis: totals[k] is the sum of buckets [0, k).
+    Only the last ROUTE_BUCKETS buckets are kept, as in each partition's
+    ring: cells of an idle partition's older snapshot are dropped rather
+    than stretching the arrays.
+
+    The merged arrays are indexed by lane, only over the (origin,
+    destination) pairs that saw readings: partitions each tracking up to
+    ROUTE_MAX_LOCATIONS different locations would make a dense
+    locations x locations matrix grow with the square of their number.
+    """
+
+    def __init__(self, snapshots: List[Dict[str, Any]]):
+        self.locations = RouteInterner()
+        self.bucket_seconds = ROUTE_BUCKET_SECONDS
+        self.updated_at = min((s.get("updated_at", 0.0) for s in snapshots), default=None)
+        self.first_bucket = 0
+        # Start of the oldest bucket kept; None without readings
+        self.covered_from: Optional[float] = None
+
+        parts = []
+        widths = [s.get("bucket_seconds") for s in snapshots if decode_cells(s) is not None]
+        if widths:
+            # Snapshots written with another bucket width are left out
+            self.bucket_seconds = max(set(widths), key=widths.count)
+        for snapshot in snapshots:
+            cells = decode_cells(snapshot)
+            if cells is None or snapshot.get("bucket_seconds") != self.bucket_seconds:
+                continue
+            buckets, origins, destinations, values = cells
+            # Partition-local IDs -> merged IDs
+            global_ids = np.array([self.locations.intern(name) for name in snapshot["locations"]], dtype=np.int64)
+            parts.append((buckets, global_ids[origins], global_ids[destinations], values))
+
+        size = self._size = len(self.locations)
+        if parts:
+            oldest = int(max(p[0].max() for p in parts)) - ROUTE_BUCKETS + 1
+            self.covered_from = float(oldest * self.bucket_seconds)
+            parts = [tuple(array[p[0] >= oldest] for array in p) for p in parts]
+            parts = [p for p in parts if len(p[0])]
+        if not parts:
+            # origin * size + destination of each lane, sorted
+            self.lane_keys = np.zeros(0, dtype=np.int64)
+            self.totals = np.zeros((1, 0, FIELDS))
+            return
+        self.first_bucket = int(min(p[0].min() for p in parts))
+        span = int(max(p[0].max() for p in parts)) - self.first_bucket + 1
+        buckets = np.concatenate([p[0] for p in parts])
+        self.lane_keys, lanes = np.unique(np.concatenate([p[1] * size + p[2] for p in parts]), return_inverse=True)
+        merged = np.zeros((span, len(self.lane_keys), FIELDS))
+        np.add.at(merged, (buckets - self.first_bucket, lanes), np.concatenate([p[3] for p in parts]))
+        self.totals = np.zeros((span + 1, len(self.lane_keys), FIELDS))
+        np.cumsum(merged, axis=0, out=self.totals[1:])
+
+    @property
+    def last_bucket(self) -> int:
+        return self.first_bucket + self.totals.shape[0] - 2
+
+    def _window(self, start: float, end: float):
+        """Indices into totals covering the buckets that overlap [start, end)."""
+        first = math.floor(start / self.bucket_seconds) - self.first_bucket
+        last = math.ceil(end / self.bucket_seconds) - self.first_bucket
+        limit = self.totals.shape[0] - 1
+        return min(max(first, 0), limit), min(max(last, 0), limit)
+
+    def _summary(self, cell: np.ndarray) -> Dict[str, Any]:
+        return {
+            "count": int(cell[COUNT]),
+            "avg_temperature": _mean(cell[TEMPERATURE_SUM], cell[TEMPERATURE_COUNT]),
+            "avg_battery": _mean(cell[BATTERY_SUM], cell[BATTERY_COUNT]),
+        }
+
+    def _window_info(self, start: float, end: float) -> Dict[str, Any]:
+        # Older buckets are no longer kept, so the window covered starts later
+        if self.covered_from is not None:
+            start = max(start, self.covered_from)
+        return {
+            "start": start,
+            "end": end,
+            "bucket_seconds": self.bucket_seconds,
+            "as_of": self.updated_at,
+        }
+
+    def lane(self, origin: str, destination: str, start: float, end: float) -> Optional[Dict[str, Any]]:
+        """Summary of one lane over the buckets overlapping [start, end); None if never seen."""
+        i, j = self.locations.get(origin), self.locations.get(destination)
+        if i is None or j is None:
+            return None
+        first, last = self._window(start, end)
+        key = i * self._size + j
+        lane = int(np.searchsorted(self.lane_keys, key))
+        if lane < len(self.lane_keys) and self.lane_keys[lane] == key:
+            cell = self.totals[last, lane] - self.totals[first, lane]
+        else:
+            cell = np.zeros(FIELDS)
+        return {
+            "route_from": self.locations.names[i],
+            "route_to": self.locations.names[j],
+            **self._summary(cell),
+            **self._window_info(start, end),
+        }
+
+    def top_lanes(self, start: float, end: float, limit: int, order_by: str = "count") -> Dict[str, Any]:
+        """The `limit` busiest (or hottest, or lowest-battery) lanes in the window."""
+        first, last = self._window(start, end)
+        window = self.totals[last] - self.totals[first]
+        counts = window[..., COUNT]
+        if order_by == "temperature":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                score = np.where(window[..., TEMPERATURE_COUNT] > 0,
+                                 window[..., TEMPERATURE_SUM] / window[..., TEMPERATURE_COUNT], -np.inf)
+        elif order_by == "battery":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                score = np.where(window[..., BATTERY_COUNT] > 0,
+                                 -window[..., BATTERY_SUM] / window[..., BATTERY_COUNT], -np.inf)
+        else:
+            score = np.where(counts > 0, counts, -np.inf)
+        flat = score.ravel()
+        candidates = np.flatnonzero(np.isfinite(flat))
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(-flat[candidates], limit - 1)[:limit]]
+        candidates = candidates[np.argsort(-flat[candidates], kind="stable")]
+        lanes = []
+        for index in candidates:
+            i, j = divmod(int(self.lane_keys[index]), self._size)
+            lanes.append({
+                "route_from": self.locations.names[i],
+                "route_to": self.locations.names[j],
+                **self._summary(window[index]),
+            })
+        return {"lanes": lanes, "locations": len(self.locations), **self._window_info(start, end)}
+
+
+class LaneSummaryCache:
+    """Rebuilds LaneSummaries from the snapshot collection at most every `refresh_seconds`."""
+
+    def __init__(self, collection, refresh_seconds: float):
+        self.collection = collection
+        self.refresh_seconds = refresh_seconds
+        self._summaries: Optional[LaneSummaries] = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> LaneSummaries:
+        with self._lock:
+            if self._summaries is None or time.monotonic() - self._loaded_at >= self.refresh_seconds:
+                self._summaries = LaneSummaries(list(self.collection.find({}, {"_id": 0})))
+                self._loaded_at = time.monotonic()
+            return self._summaries
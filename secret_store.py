@@ -0,0 +1,141 @@
+"""
+Short-lived secrets: 2FA codes and password reset tokens.
+
+Each secret is stored under (kind, subject), e.g. ("2fa", "a@b.com"), with an
+expiry and a small payload that the consumer needs afterwards (the user's
+name for the login response), so completing a flow does not have to read the
+user document again. Only a SHA-256 digest of the secret is kept.
+
+consume() is an atomic check-and-delete: a secret is accepted at most once,
+and only while it is unexpired and matches. Putting a new secret for the
+same subject replaces the previous one.
+
+    MemorySecretStore  per process; fine for a single worker.
+    MongoSecretStore   shared by every worker; a TTL index removes expired
+                       entries, so nothing needs cleaning up by hand.
+"""
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Tuple
+
+import metrics
+
+SECRET_OPERATIONS_TOTAL = metrics.counter(
+    "auth_secret_operations_total", "Short-lived secret store operations by outcome", ["kind", "outcome"]
+)
+
+# Outcomes of consume()
+ACCEPTED = "accepted"
+MISMATCH = "mismatch"
+MISSING = "missing"  # never issued, already used or expired
+
+
+def _digest(secret: str) -> str:
+    return hashlib.sha256(secret.encode("utf-8")).hexdigest()
+
+
+def _key(kind: str, subject: str) -> str:
+    return f"{kind}:{subject.strip().lower()}"
+
+
+class MemorySecretStore:
+    """Secrets in a dict; expired entries are dropped on access and on a periodic sweep."""
+
+    def __init__(self, sweep_every: int = 1000):
+        self.sweep_every = sweep_every
+        # key -> (digest, expires at (monotonic), payload)
+        self._secrets: Dict[str, Tuple[str, float, dict]] = {}
+        self._puts = 0
+        self._lock = threading.Lock()
+
+    def put(self, kind: str, subject: str, secret: str, ttl_seconds: float, payload: Optional[dict] = None):
+        with self._lock:
+            self._secrets[_key(kind, subject)] = (_digest(secret), time.monotonic() + ttl_seconds, payload or {})
+            self._puts += 1
+            if self._puts % self.sweep_every == 0:
+                now = time.monotonic()
+                for key in [k for k, (_, expires, _) in self._secrets.items() if expires <= now]:
+                    del self._secrets[key]
+        SECRET_OPERATIONS_TOTAL.inc(kind=kind, outcome="issued")
+
+    def consume(self, kind: str, subject: str, secret: str) -> Tuple[str, Optional[dict]]:
+        """(ACCEPTED, payload) and the secret is gone, or (MISMATCH | MISSING, None)."""
+        key = _key(kind, subject)
+        with self._lock:
+            entry = self._secrets.get(key)
+            if entry is not None and entry[1] <= time.monotonic():
+                del self._secrets[key]
+                entry = None
+            if entry is None:
+                outcome, payload = MISSING, None
+            elif entry[0] != _digest(secret):
+                outcome, payload = MISMATCH, None
+            else:
+                del self._secrets[key]
+                outcome, payload = ACCEPTED, entry[2]
+        SECRET_OPERATIONS_TOTAL.inc(kind=kind, outcome=outcome)
+        return outcome, payload
+
+    def discard(self, kind: str, subject: str):
+        with self._lock:
+            self._secrets.pop(_key(kind, subject), None)
+
+
+class MongoSecretStore:
+    """
+    Secrets in a Mongo collection with a TTL index on expires_at. The TTL
+    monitor only runs about once a minute, so expiry is also checked in
+    every query. A successful consume() is a single find_one_and_delete.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self._indexed = False
+
+    def _ensure_index(self):
+        if not self._indexed:
+            self.collection.create_index("expires_at", expireAfterSeconds=0)
+            self._indexed = True
+
+    def put(self, kind: str, subject: str, secret: str, ttl_seconds: float, payload: Optional[dict] = None):
+        self._ensure_index()
+        self.collection.replace_one(
+            {"_id": _key(kind, subject)},
+            {
+                "digest": _digest(secret),
+                "expires_at": datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds),
+                "payload": payload or {},
+            },
+            upsert=True,
+        )
+        SECRET_OPERATIONS_TOTAL.inc(kind=kind, outcome="issued")
+
+    def consume(self, kind: str, subject: str, secret: str) -> Tuple[str, Optional[dict]]:
+        key = _key(kind, subject)
+        now = datetime.now(timezone.utc)
+        entry = self.collection.find_one_and_delete(
+            {"_id": key, "digest": _digest(secret), "expires_at": {"$gt": now}},
+            projection={"payload": 1},
+        )
+        if entry is not None:
+            outcome, payload = ACCEPTED, entry.get("payload") or {}
+        else:
+            # Failure path only: tell a wrong secret from a missing or expired one
+            pending = self.collection.find_one({"_id": key, "expires_at": {"$gt": now}}, projection={"_id": 1})
+            outcome, payload = (MISMATCH if pending else MISSING), None
+        SECRET_OPERATIONS_TOTAL.inc(kind=kind, outcome=outcome)
+        return outcome, payload
+
+    def discard(self, kind: str, subject: str):
+        self.collection.delete_one({"_id": _key(kind, subject)})
+
+
+def create_secret_store(kind: str, collection=None):
+    """'memory' for a single worker, 'mongo' to share secrets across workers."""
+    if kind == "memory":
+        return MemorySecretStore()
+    if kind == "mongo":
+        return MongoSecretStore(collection)
+    raise ValueError(f"Unknown secret store backend '{kind}' (expected 'memory' or 'mongo')")
@@ -4,77 +4,263 @@ import errno
 import json
 import time
 import random
+import os
+import argparse
+import itertools
+import threading
+import wire_format
 
-PORT = 5050
+PORT = int(os.environ.get('SOCKET_PORT', 5050))
 # Uses the system's hostname, often resolves to 127.0.0.1 or the network IP
-SERVER = '0.0.0.0' 
-print(SERVER)
-ADDR = (SERVER, PORT)
+SERVER = '0.0.0.0'
 FORMAT = 'utf-8'
 DISCONNECT_MESSAGE = "!DISCONNECT"
+# Set to 'bin1' to allow the compact binary format for producers that offer it
+WIRE_FORMAT = os.environ.get('WIRE_FORMAT', wire_format.FORMAT_JSON)
+HANDSHAKE_TIMEOUT = 1.0
 
+ROUTES = ['Newyork,USA','Chennai, India','Bengaluru, India','London,UK']
+FIRST_DEVICE_ID = 1150
 
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-print("socket created")
+# Load generator: how often the steady profile wakes up to send what is due
+STEADY_TICK_SECONDS = 0.01
+# Cap on events written in one sendall, so a slow client cannot build a huge backlog
+MAX_EVENTS_PER_WRITE = 10000
+STATS_INTERVAL_SECONDS = 5
 
-server.bind(ADDR)    # bind this socket to the address we configured earlier
-server.listen(2)
-print(f"[LISTENING] Server is listening on {SERVER}")
 
-# Loop to continuously accept connections
-while True:
+def negotiate_format(conn):
+    """
+    Read an optional HELLO line from the client and answer with the format to use.
+    Clients that do not send HELLO (older producers) get newline-delimited JSON.
+    """
+    conn.settimeout(HANDSHAKE_TIMEOUT)
+    line = b""
     try:
-        conn, addr = server.accept() # Waits for the producer to connect
-        print(f'CONNECTION FROM {addr} HAS BEEN ESTABLISHED')
-        connected = True
-        
-        while connected:
-            try:
-                # Generates 5 data points
-                for i in range(0,5):
-                    route = ['Newyork,USA','Chennai, India','Bengaluru, India','London,UK']
-                    routefrom = random.choice(route)
-                    routeto = random.choice(route)
-                    
-                    if (routefrom != routeto):
-                        data = {
-                            "Battery_Level":round(random.uniform(2.00,5.00),2),
-                            "Device_ID": random.randint(1150,1158),
-                            "First_Sensor_temperature":round(random.uniform(10,40.0),1),
-                            "Route_From":routefrom,
-                            "Route_To":routeto
-                            }
-                        
-                        # Serialize to JSON, encode, and **append a newline delimiter**
-                        # Removed 'indent=1' to make the JSON compact and the delimiter reliable.
-                        userdata = (json.dumps(data).encode(FORMAT) + b'\n') 
-                        conn.sendall(userdata) # Use sendall for reliability
-                        print(userdata)
-                        time.sleep(10)
-                    else:
-                        continue
-
-            except IOError as e:
-                if e.errno == errno.EPIPE:
-                    # Handle broken pipe error gracefully (client disconnected)
-                    print("Client disconnected (Broken Pipe)")
-                    connected = False
-                else:
-                    print(f"Server error: {e}")
-                    raise
-            except Exception as e:
-                print(f"Unexpected error in data loop: {e}")
-                connected = False
-
-        if conn:
-            conn.close()    #close the connection
-            print(f"Connection with {addr} closed.")
-            
-    except KeyboardInterrupt:
-        print("\nServer shutting down...")
-        break
+        while not line.endswith(b"\n") and len(line) < 256:
+            chunk = conn.recv(1)
+            if not chunk:
+                break
+            line += chunk
+    except socket.timeout:
+        pass
+    finally:
+        conn.settimeout(None)
+
+    offered = wire_format.parse_hello(line)
+    if not offered:
+        return wire_format.FORMAT_JSON
+    selected = wire_format.choose_format(offered, WIRE_FORMAT)
+    conn.sendall(wire_format.format_line(selected))
+    return selected
+
+
+def encode_reading(data, selected_format):
+    if selected_format == wire_format.FORMAT_BINARY:
+        # Length-prefixed schema v1 frame, no field names on the wire
+        return wire_format.encode_frame(wire_format.encode_reading(data))
+    # Serialize to JSON, encode, and **append a newline delimiter**
+    # Removed 'indent=1' to make the JSON compact and the delimiter reliable.
+    return json.dumps(data).encode(FORMAT) + b'\n'
+
+
+# ------------------ DEMO MODE (one reading every 10 seconds) ------------------
+
+def serve_demo(conn, selected_format, options):
+    while True:
+        # Generates 5 data points
+        for i in range(0,5):
+            routefrom = random.choice(ROUTES)
+            routeto = random.choice(ROUTES)
+
+            if (routefrom != routeto):
+                data = {
+                    "Battery_Level":round(random.uniform(2.00,5.00),2),
+                    "Device_ID": random.randint(1150,1158),
+                    "First_Sensor_temperature":round(random.uniform(10,40.0),1),
+                    "Route_From":routefrom,
+                    "Route_To":routeto
+                    }
+
+                userdata = encode_reading(data, selected_format)
+                conn.sendall(userdata) # Use sendall for reliability
+                print(userdata)
+                time.sleep(10)
+            else:
+                continue
+
+
+# ------------------ LOAD GENERATOR MODE ------------------
+
+def build_routes(count):
+    """The real routes first, then synthetic ones up to the requested cardinality."""
+    routes = list(ROUTES[:count])
+    for i in range(len(routes), count):
+        routes.append(f"City-{i}, Country-{i % 50}")
+    return routes
+
+
+class LoadGenerator:
+    """
+    Deterministic reading generator for one connection.
+
+    With the same seed the sequence of readings is identical between runs;
+    only the embedded send timestamps differ.
+    """
+
+    def __init__(self, devices, routes, seed):
+        self.rng = random.Random(seed)
+        self.device_ids = list(range(FIRST_DEVICE_ID, FIRST_DEVICE_ID + devices))
+        self.routes = build_routes(routes)
+        self.sequence = 0
+
+    def next_reading(self, sent_at):
+        rng = self.rng
+        if len(self.routes) > 1:
+            routefrom, routeto = rng.sample(self.routes, 2)
+        else:
+            routefrom = routeto = self.routes[0]
+        self.sequence += 1
+        return {
+            "Battery_Level": round(rng.uniform(2.00, 5.00), 2),
+            "Device_ID": rng.choice(self.device_ids),
+            "First_Sensor_temperature": round(rng.uniform(10, 40.0), 1),
+            "Route_From": routefrom,
+            "Route_To": routeto,
+            # Used downstream to measure end-to-end latency and detect gaps
+            "Sent_At": sent_at,
+            "Seq": self.sequence,
+        }
+
+
+def serve_load(conn, selected_format, options, connection_index):
+    """
+    Send readings at options.rate events/sec until the client goes away
+    (or options.duration seconds pass).
+
+    steady: events are spread evenly, written every STEADY_TICK_SECONDS.
+    burst:  options.burst_size events are written back to back, then the
+            connection idles so the average rate still matches options.rate.
+    """
+    generator = LoadGenerator(options.devices, options.routes, options.seed + connection_index)
+    if options.profile == 'burst':
+        period = options.burst_size / options.rate
+    else:
+        period = STEADY_TICK_SECONDS
+
+    start = time.monotonic()
+    last_stats = start
+    last_stats_sent = 0
+    sent = 0
+    while True:
+        now = time.monotonic()
+        if options.duration and now - start >= options.duration:
+            print(f"Load run finished for connection {connection_index}: {sent} events")
+            return
+
+        if options.profile == 'burst':
+            due = options.burst_size
+        else:
+            due = int((now - start) * options.rate) - sent
+        due = min(due, MAX_EVENTS_PER_WRITE)
+
+        if due > 0:
+            sent_at = time.time()
+            payload = b"".join(
+                encode_reading(generator.next_reading(sent_at), selected_format) for _ in range(due)
+            )
+            conn.sendall(payload)
+            sent += due
+
+        if now - last_stats >= STATS_INTERVAL_SECONDS:
+            rate = (sent - last_stats_sent) / (now - last_stats)
+            print(f"[LOAD] connection {connection_index}: {sent} events sent, {rate:.0f} events/sec")
+            last_stats, last_stats_sent = now, sent
+
+        time.sleep(max(0.0, period - (time.monotonic() - now)))
+
+
+# ------------------ CONNECTION HANDLING ------------------
+
+def handle_client(conn, addr, options, connection_index):
+    """Serve one client connection; every client gets its own thread."""
+    try:
+        selected_format = negotiate_format(conn)
+        print(f"Using wire format '{selected_format}' for {addr}")
+        if options.mode == 'load':
+            serve_load(conn, selected_format, options, connection_index)
+        else:
+            serve_demo(conn, selected_format, options)
+    except IOError as e:
+        if e.errno in (errno.EPIPE, errno.ECONNRESET):
+            # Handle broken pipe error gracefully (client disconnected)
+            print("Client disconnected (Broken Pipe)")
+        else:
+            print(f"Server error: {e}")
     except Exception as e:
-        print(f"Error in server accept loop: {e}")
-        time.sleep(5)
+        print(f"Unexpected error in data loop: {e}")
+    finally:
+        conn.close()    #close the connection
+        print(f"Connection with {addr} closed.")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Device data socket server")
+    parser.add_argument('--mode', choices=['demo', 'load'], default=os.environ.get('SERVER_MODE', 'demo'),
+                        help="demo: one reading every 10s; load: configurable high-rate generator")
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--rate', type=float, default=float(os.environ.get('LOAD_RATE', 1000)),
+                        help="Target events/sec per connection (load mode)")
+    parser.add_argument('--devices', type=int, default=int(os.environ.get('LOAD_DEVICES', 9)),
+                        help="Number of distinct Device_IDs (load mode)")
+    parser.add_argument('--routes', type=int, default=int(os.environ.get('LOAD_ROUTES', len(ROUTES))),
+                        help="Number of distinct route names (load mode)")
+    parser.add_argument('--profile', choices=['steady', 'burst'], default=os.environ.get('LOAD_PROFILE', 'steady'))
+    parser.add_argument('--burst-size', type=int, default=int(os.environ.get('LOAD_BURST_SIZE', 500)),
+                        help="Events per burst (burst profile)")
+    parser.add_argument('--seed', type=int, default=int(os.environ.get('LOAD_SEED', 42)),
+                        help="Base seed; connection N uses seed + N")
+    parser.add_argument('--duration', type=float, default=float(os.environ.get('LOAD_DURATION', 0)),
+                        help="Seconds to generate per connection, 0 for no limit (load mode)")
+    parser.add_argument('--backlog', type=int, default=int(os.environ.get('SOCKET_BACKLOG', 64)),
+                        help="Pending connection queue size")
+    options = parser.parse_args(argv)
+    if options.rate <= 0 or options.devices < 1 or options.routes < 1 or options.burst_size < 1:
+        parser.error("--rate, --devices, --routes and --burst-size must be positive")
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    print(SERVER)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    print("socket created")
+
+    server.bind((SERVER, options.port))    # bind this socket to the address we configured earlier
+    server.listen(options.backlog)
+    print(f"[LISTENING] Server is listening on {SERVER}:{options.port} in {options.mode} mode")
+
+    connection_counter = itertools.count()
+    # Loop to continuously accept connections
+    while True:
+        try:
+            conn, addr = server.accept() # Waits for the producer to connect
+            print(f'CONNECTION FROM {addr} HAS BEEN ESTABLISHED')
+            threading.Thread(
+                target=handle_client,
+                args=(conn, addr, options, next(connection_counter)),
+                daemon=True
+            ).start()
+        except KeyboardInterrupt:
+            print("\nServer shutting down...")
+            break
+        except Exception as e:
+            print(f"Error in server accept loop: {e}")
+            time.sleep(5)
+
+    server.close()
+
 
-server.close()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
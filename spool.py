@@ -0,0 +1,286 @@
+"""
+Outbox for the producer: a bounded in-memory queue that overflows into an
+append-only, memory-mapped spool file on local disk.
+
+The socket reader put()s encoded records; the Kafka sender takes batches,
+and commits them only once Kafka has acknowledged them. While Kafka is down
+nothing is committed, so records pile up in memory, then in the spool, and
+are replayed in their original order on recovery. When the spool is full
+too, put() blocks: the producer stops reading its socket and TCP flow
+control pushes back on the data server instead of records being dropped.
+
+Ordering: new records go to memory only while the spool is empty, and the
+sender always drains memory before the spool, so records leave in the order
+they arrived.
+
+Spool layout:
+
+    header  <read offset u64><write offset u64>
+    frames  <length u32><flags u8><key length u16>[<timestamp u64>]<key><value>,
+            back to back; the timestamp is present when its flag is set
+
+Unread frames live between the two offsets. Offsets are stored in the file
+itself, so a restarted producer resumes replay where it stopped. When an
+append does not fit at the end, unread frames are moved to the front.
+Records still in memory are written to the spool on close(); after a crash
+only they are lost, not the spool.
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import deque
+from typing import List, NamedTuple, Optional, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct("<QQ")
+_FRAME = struct.Struct("<IBH")
+_TIMESTAMP = struct.Struct("<Q")
+_FLAG_KEY = 1
+_FLAG_BINARY = 2
+_FLAG_TIMESTAMP = 4
+
+SPOOL_BYTES = metrics.gauge("spool_bytes", "Unsent bytes held in the disk spool")
+SPOOL_RECORDS = metrics.gauge("spool_records", "Unsent records held in the disk spool")
+SPOOL_CAPACITY_BYTES = metrics.gauge("spool_capacity_bytes", "Size of the disk spool file")
+MEMORY_QUEUE_RECORDS = metrics.gauge("spool_memory_records", "Unsent records held in memory")
+SPOOLED_TOTAL = metrics.counter("spool_written_records_total", "Records written to the disk spool")
+REPLAYED_TOTAL = metrics.counter("spool_replayed_records_total", "Records replayed from the disk spool after being sent")
+DROPPED_TOTAL = metrics.counter("spool_dropped_records_total", "Records lost because the spool had no room at shutdown")
+PAUSED = metrics.gauge("spool_paused", "1 while the reader is blocked because the spool is full")
+PAUSED_SECONDS_TOTAL = metrics.counter("spool_paused_seconds_total", "Time the reader spent blocked on a full spool")
+
+
+class Record(NamedTuple):
+    key: Optional[bytes]
+    value: bytes
+    # Schema v1 binary payload rather than JSON (decides the Kafka headers)
+    binary: bool = False
+    # When the producer received the reading (ms); sent as the Kafka timestamp
+    # so retries and replays keep the original event time
+    timestamp_ms: Optional[int] = None
+
+
+def _encode(record: Record) -> bytes:
+    key = record.key or b""
+    flags = (_FLAG_KEY if record.key is not None else 0) | (_FLAG_BINARY if record.binary else 0)
+    timestamp = b""
+    if record.timestamp_ms is not None:
+        flags |= _FLAG_TIMESTAMP
+        timestamp = _TIMESTAMP.pack(record.timestamp_ms)
+    length = _FRAME.size - 4 + len(timestamp) + len(key) + len(record.value)
+    return _FRAME.pack(length, flags, len(key)) + timestamp + key + record.value
+
+
+class DiskSpool:
+    """Append-only spool of records in a fixed-size, memory-mapped file."""
+
+    def __init__(self, path: str, max_bytes: int):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        exists = os.path.exists(path) and os.path.getsize(path) >= _HEADER.size
+        self.path = path
+        self._file = open(path, "r+b" if exists else "w+b")
+        # An existing spool keeps its size so no unread frame is cut off
+        self.size = max(max_bytes, os.path.getsize(path) if exists else 0)
+        self._file.truncate(self.size)
+        self._mm = mmap.mmap(self._file.fileno(), self.size)
+        self.read_offset, self.write_offset = _HEADER.unpack_from(self._mm, 0) if exists else (0, 0)
+        if not (_HEADER.size <= self.read_offset <= self.write_offset <= self.size):
+            if exists:
+                logger.warning(f"Spool {path} has an invalid header; starting empty")
+            self._reset()
+        self.records = self._count()
+        if self.records:
+            logger.info(f"Spool {path} holds {self.records} unsent records from a previous run")
+        SPOOL_CAPACITY_BYTES.set(self.size)
+        self._update_gauges()
+
+    @property
+    def used_bytes(self) -> int:
+        return self.write_offset - self.read_offset
+
+    def _count(self) -> int:
+        count, offset = 0, self.read_offset
+        while offset < self.write_offset:
+            offset += 4 + _FRAME.unpack_from(self._mm, offset)[0]
+            count += 1
+        return count
+
+    def _reset(self):
+        self.read_offset = self.write_offset = _HEADER.size
+        self._write_header()
+
+    def _write_header(self):
+        _HEADER.pack_into(self._mm, 0, self.read_offset, self.write_offset)
+
+    def _update_gauges(self):
+        SPOOL_BYTES.set(self.used_bytes)
+        SPOOL_RECORDS.set(self.records)
+
+    def _compact(self):
+        """Move the unread frames to the front of the file."""
+        used = self.used_bytes
+        self._mm.move(_HEADER.size, self.read_offset, used)
+        self.read_offset, self.write_offset = _HEADER.size, _HEADER.size + used
+        self._write_header()
+
+    def append(self, record: Record) -> bool:
+        """False when the spool has no room for the record."""
+        return self.append_raw(_encode(record), 1)
+
+    def append_raw(self, frames: bytes, count: int) -> bool:
+        if self.write_offset + len(frames) > self.size:
+            if self.read_offset > _HEADER.size:
+                self._compact()
+            if self.write_offset + len(frames) > self.size:
+                return False
+        self._mm[self.write_offset:self.write_offset + len(frames)] = frames
+        self.write_offset += len(frames)
+        self.records += count
+        self._write_header()
+        self._update_gauges()
+        return True
+
+    def read_batch(self, max_records: int) -> Tuple[List[Record], int]:
+        """The oldest unread records and how many bytes they take; nothing is consumed."""
+        records, offset = [], self.read_offset
+        while offset < self.write_offset and len(records) < max_records:
+            length, flags, key_length = _FRAME.unpack_from(self._mm, offset)
+            start = offset + _FRAME.size
+            end = offset + 4 + length
+            timestamp_ms = None
+            if flags & _FLAG_TIMESTAMP:
+                timestamp_ms = _TIMESTAMP.unpack_from(self._mm, start)[0]
+                start += _TIMESTAMP.size
+            key = bytes(self._mm[start:start + key_length]) if flags & _FLAG_KEY else None
+            records.append(Record(
+                key, bytes(self._mm[start + key_length:end]), bool(flags & _FLAG_BINARY), timestamp_ms
+            ))
+            offset = end
+        return records, offset - self.read_offset
+
+    def commit(self, count: int, nbytes: int):
+        """Consume `count` records (`nbytes` bytes) returned by read_batch()."""
+        # Relative to read_offset, which stays valid if _compact() ran in between
+        self.read_offset += nbytes
+        self.records -= count
+        if self.read_offset == self.write_offset:
+            self._reset()
+        else:
+            self._write_header()
+        self._update_gauges()
+
+    def prepend(self, records: List[Record]) -> int:
+        """Put `records` in front of the unread frames; returns how many fit."""
+        frames = bytearray()
+        fitted = 0
+        for record in records:
+            frame = _encode(record)
+            if _HEADER.size + len(frames) + len(frame) + self.used_bytes > self.size:
+                break
+            frames += frame
+            fitted += 1
+        tail = bytes(self._mm[self.read_offset:self.write_offset])
+        tail_records = self.records
+        self._reset()
+        self.records = 0
+        self.append_raw(bytes(frames) + tail, fitted + tail_records)
+        return fitted
+
+    def close(self):
+        self._mm.flush()
+        self._mm.close()
+        self._file.close()
+
+
+class Outbox:
+    """
+    Memory queue in front of a DiskSpool. One reader thread put()s, one
+    sender thread take()s and commit()s.
+    """
+
+    def __init__(self, spool: DiskSpool, memory_records: int):
+        self.spool = spool
+        self.memory_records = memory_records
+        self._memory: deque = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def put(self, record: Record):
+        """Queue a record; blocks while both the memory queue and the spool are full."""
+        with self._cond:
+            paused_at = None
+            while True:
+                if self._closed:
+                    DROPPED_TOTAL.inc()
+                    break
+                if not self.spool.records and len(self._memory) < self.memory_records:
+                    self._memory.append(record)
+                    MEMORY_QUEUE_RECORDS.set(len(self._memory))
+                    break
+                if self.spool.append(record):
+                    SPOOLED_TOTAL.inc()
+                    break
+                if paused_at is None:
+                    paused_at = time.monotonic()
+                    PAUSED.set(1)
+                    logger.warning("Spool full; pausing socket reads until Kafka catches up", extra={"sample": "spool_full"})
+                self._cond.wait(1.0)
+            if paused_at is not None:
+                PAUSED.set(0)
+                PAUSED_SECONDS_TOTAL.inc(time.monotonic() - paused_at)
+                logger.info("Spool has room again; resuming socket reads", extra={"sample": "spool_resumed"})
+            self._cond.notify_all()
+
+    def take(self, max_records: int, timeout: float) -> Tuple[List[Record], str, int]:
+        """
+        The oldest queued records as (records, source, nbytes), without
+        removing them; pass the same values to commit() once they are sent.
+        """
+        with self._cond:
+            if not self._memory and not self.spool.records:
+                self._cond.wait(timeout)
+            if self._memory:
+                count = min(max_records, len(self._memory))
+                return [self._memory[i] for i in range(count)], "memory", 0
+            if self.spool.records:
+                records, nbytes = self.spool.read_batch(max_records)
+                return records, "spool", nbytes
+            return [], "memory", 0
+
+    def commit(self, count: int, source: str, nbytes: int):
+        with self._cond:
+            if source == "memory":
+                for _ in range(count):
+                    self._memory.popleft()
+                MEMORY_QUEUE_RECORDS.set(len(self._memory))
+            else:
+                self.spool.commit(count, nbytes)
+                REPLAYED_TOTAL.inc(count)
+            # Wake a reader blocked on a full spool
+            self._cond.notify_all()
+
+    def pending(self) -> int:
+        return len(self._memory) + self.spool.records
+
+    def close(self):
+        """Write records still in memory to the spool, ahead of what is already there."""
+        with self._cond:
+            self._closed = True
+            if self._memory:
+                records = list(self._memory)
+                fitted = self.spool.prepend(records)
+                if fitted < len(records):
+                    DROPPED_TOTAL.inc(len(records) - fitted)
+                    logger.error(f"Spool full at shutdown; dropped {len(records) - fitted} records")
+                self._memory.clear()
+                MEMORY_QUEUE_RECORDS.set(0)
+            self._cond.notify_all()
+            self.spool.close()
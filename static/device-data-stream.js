@@ -1,5 +1,15 @@
 let pollingTimer = null;
 let currentSelectedDeviceId = null; // Track the currently selected device ID for rendering
+// Delta sync state: the server answers 304 when nothing changed, otherwise
+// the records newer than lastSeenId plus a short window before it (records
+// can be committed out of _id order), so records already held are dropped
+let latestRecords = [];
+let lastEtag = null;
+let lastSeenId = null;
+// Live feed over /ws/device-data: batched frames of per-device deltas
+// (see live_feed.py); polling is the fallback when the socket fails
+let liveSocket = null;
+let deviceStates = {};
 
 // ==============================================
 // ELEMENT REFERENCES
@@ -10,6 +20,7 @@ const dataForm = document.getElementById("dataForm");
 const API_URL = "/device-data";
 // Reduced polling interval to 2 seconds for a more "stream-like" feel
 const POLLING_INTERVAL = 2000; 
+const MAX_RECORDS = 15;
 
 // ==============================================
 // HELPER: Populate device IDs
@@ -91,14 +102,24 @@ async function fetchAndRenderData() {
         return;
     }
 
+    const headers = { "Authorization": `Bearer ${token}` };
+    if (lastEtag) {
+        headers["If-None-Match"] = lastEtag;
+    }
+    const url = lastSeenId ? `${API_URL}?since=${encodeURIComponent(lastSeenId)}` : API_URL;
+
     try {
-        const response = await fetch(API_URL, {
+        const response = await fetch(url, {
             method: "GET",
-            headers: {
-                "Authorization": `Bearer ${token}`
-            }
+            headers: headers,
+            cache: "no-store"
         });
 
+        // Nothing new since the last poll
+        if (response.status === 304) {
+            return;
+        }
+
         // Handle token expiry / invalid token
         if (response.status === 401 || response.status === 403) {
             console.error("Session expired.");
@@ -114,15 +135,99 @@ async function fetchAndRenderData() {
             return;
         }
 
-        const latestData = await response.json();
+        const newRecords = await response.json();
+        lastEtag = response.headers.get("ETag");
+        if (newRecords.length > 0) {
+            const held = new Set(latestRecords.map(record => record._id));
+            const added = newRecords.filter(record => !held.has(record._id));
+            // Newest first; ObjectId hex strings sort in creation order
+            latestRecords = added.concat(latestRecords)
+                .sort((a, b) => (a._id < b._id ? 1 : a._id > b._id ? -1 : 0))
+                .slice(0, MAX_RECORDS);
+            if (!lastSeenId || newRecords[0]._id > lastSeenId) {
+                lastSeenId = newRecords[0]._id;
+            }
+        }
         // Use the globally tracked ID to maintain selection consistency
-        renderTable(latestData, currentSelectedDeviceId); 
+        renderTable(latestRecords, currentSelectedDeviceId); 
 
     } catch (error) {
         console.error("Error fetching device data:", error);
     }
 }
 
+function resetSyncState() {
+    latestRecords = [];
+    lastEtag = null;
+    lastSeenId = null;
+    deviceStates = {};
+}
+
+// ==============================================
+// LIVE FEED (WebSocket) WITH POLLING FALLBACK
+// ==============================================
+function startPolling() {
+    fetchAndRenderData();
+    pollingTimer = setInterval(fetchAndRenderData, POLLING_INTERVAL);
+}
+
+function stopStreaming() {
+    if (pollingTimer) {
+        clearInterval(pollingTimer);
+        pollingTimer = null;
+    }
+    if (liveSocket) {
+        liveSocket.onclose = null;
+        liveSocket.close();
+        liveSocket = null;
+    }
+}
+
+function applyLiveFrame(frame) {
+    if (frame.type === "snapshot") {
+        deviceStates = frame.devices;
+        latestRecords = Object.values(deviceStates)
+            .sort((a, b) => b.timestamp - a.timestamp)
+            .slice(0, MAX_RECORDS);
+    } else if (frame.type === "delta") {
+        const updated = [];
+        for (const [deviceId, fields] of Object.entries(frame.devices)) {
+            deviceStates[deviceId] = Object.assign(deviceStates[deviceId] || {}, fields);
+            updated.push(Object.assign({}, deviceStates[deviceId]));
+        }
+        latestRecords = updated.concat(latestRecords).slice(0, MAX_RECORDS);
+    }
+    renderTable(latestRecords, currentSelectedDeviceId);
+}
+
+function startLiveFeed(selectedId, token) {
+    if (!("WebSocket" in window)) {
+        startPolling();
+        return;
+    }
+    const scheme = window.location.protocol === "https:" ? "wss" : "ws";
+    let url = `${scheme}://${window.location.host}/ws/device-data?token=${encodeURIComponent(token)}`;
+    if (selectedId !== "all") {
+        url += `&devices=${encodeURIComponent(selectedId)}`;
+    }
+    const socket = new WebSocket(url);
+    let receivedFrame = false;
+    liveSocket = socket;
+
+    socket.onmessage = (event) => {
+        receivedFrame = true;
+        applyLiveFrame(JSON.parse(event.data));
+    };
+    socket.onclose = () => {
+        if (liveSocket !== socket) {
+            return;
+        }
+        liveSocket = null;
+        console.warn(receivedFrame ? "Live feed closed; polling instead." : "Live feed unavailable; polling instead.");
+        startPolling();
+    };
+}
+
 // ==============================================
 // FORM SUBMIT EVENT (Start polling)
 // ==============================================
@@ -138,19 +243,18 @@ dataForm.addEventListener('submit', function (event) {
         return;
     }
 
-    // Stop any existing polling timer before starting a new one
-    if (pollingTimer) {
-        clearInterval(pollingTimer);
-        pollingTimer = null;
-    }
-    
-    // Immediately fetch and render data
-    fetchAndRenderData(); 
+    // Stop any existing stream before starting a new one
+    stopStreaming();
+    resetSyncState();
 
-    // Start the recurring polling
-    pollingTimer = setInterval(fetchAndRenderData, POLLING_INTERVAL);
+    const token = localStorage.getItem("access_token");
+    if (!token) {
+        console.error("Authentication token is missing.");
+        return;
+    }
+    startLiveFeed(selectedId, token);
 
-    console.log(`Started polling for Device ID: ${selectedId === "all" ? "All Devices" : selectedId}`);
+    console.log(`Started live feed for Device ID: ${selectedId === "all" ? "All Devices" : selectedId}`);
 });
 
 // ==============================================
@@ -166,12 +270,9 @@ document.addEventListener("DOMContentLoaded", function () {
             allowClear: true
         });
 
-        // When selection changes: Clear the table and stop polling 
+        // When selection changes: Clear the table and stop the stream
         $('#deviceId').on('change', function () {
-            if (pollingTimer) {
-                clearInterval(pollingTimer);
-                pollingTimer = null;
-            }
+            stopStreaming();
             tbody.innerHTML = '<tr><td colspan="6" style="text-align: center;">Press "GET DEVICE DATA" to start the stream.</td></tr>';
             currentSelectedDeviceId = null;
         });
@@ -181,5 +282,5 @@ document.addEventListener("DOMContentLoaded", function () {
     });
 });
 
-// REMOVED the connectWebSocket logic as it was not being used correctly 
-// and conflicts with the polling implementation for this page's design
\ No newline at end of file
+// The live feed replaces polling while the WebSocket is open; polling only
+// runs after the socket closes or cannot be opened
\ No newline at end of file
@@ -7,6 +7,14 @@ const SHIPMENTS_API_URL = "/shipment/my";
 // ========================
 // RENDER SHIPMENTS
 // ========================
+// "YYYY-MM-DD HH:MM" in local time from the Unix `timestamp` of a shipment
+function formatCreatedOn(timestamp) {
+    if (typeof timestamp !== "number") return null;
+    const d = new Date(timestamp * 1000);
+    const pad = n => String(n).padStart(2, "0");
+    return `${d.getFullYear()}-${pad(d.getMonth() + 1)}-${pad(d.getDate())} ${pad(d.getHours())}:${pad(d.getMinutes())}`;
+}
+
 function renderShipments(shipments) {
     const tableBody = document.getElementById("shipmentsTableBody");
     const noDataMessage = document.getElementById("noDataMessage");
@@ -33,7 +41,7 @@ function renderShipments(shipments) {
             <td>${shipment.route || "N/A"}</td>
             <td>${shipment.deliveryDate || "N/A"}</td>
             <td class="${statusClass}">${shipment.status || "Created"}</td>
-            <td>${shipment.createdOnDisplay || "N/A"}</td> <!-- FIX: Use the formatted field from the backend -->
+            <td>${formatCreatedOn(shipment.timestamp) || "N/A"}</td>
             <td>${shipment.description || "N/A"}</td>
         `;
     });
@@ -0,0 +1,71 @@
+"""
+Names of telemetry fields as stored in Mongo.
+
+Every reading document repeats its field names, and on these small readings
+"First_Sensor_temperature" and friends are a large share of each document,
+of the working set and of every index key built on them. With
+STORED_FIELD_NAMES=compact the writers (consumer, backfill) store readings
+under short names instead:
+
+    Device_ID -> d   Battery_Level -> b   First_Sensor_temperature -> t
+    Route_From -> f  Route_To -> r        Sent_At -> s       Seq -> q
+
+Everything outside Mongo keeps the full names. Readers do not rename in
+Python: read_projection() is an aggregation $project that maps either layout
+back to the full names inside the server, so a collection holding both
+layouts (after switching to compact) reads the same. Filters go through
+stored_name() and therefore only match documents written in the current
+layout; archive or backfill older readings when switching.
+"""
+import os
+from typing import Any, Dict, Iterable
+
+# 'full' (the wire names) or 'compact' (short names, see above)
+STORED_FIELD_NAMES = os.environ.get('STORED_FIELD_NAMES', 'full')
+
+SHORT_NAMES = {
+    "Device_ID": "d",
+    "Battery_Level": "b",
+    "First_Sensor_temperature": "t",
+    "Route_From": "f",
+    "Route_To": "r",
+    "Sent_At": "s",
+    "Seq": "q",
+}
+FULL_NAMES = {short: full for full, short in SHORT_NAMES.items()}
+
+if STORED_FIELD_NAMES not in ("full", "compact"):
+    raise ValueError(f"STORED_FIELD_NAMES must be 'full' or 'compact', not '{STORED_FIELD_NAMES}'")
+COMPACT = STORED_FIELD_NAMES == "compact"
+
+
+def stored_name(field: str) -> str:
+    """Name of `field` in newly written documents, for filters and indexes."""
+    return SHORT_NAMES.get(field, field) if COMPACT else field
+
+
+def to_stored(reading: Dict[str, Any]) -> Dict[str, Any]:
+    """The document to insert for a reading; the reading itself is not modified."""
+    if not COMPACT:
+        return reading
+    return {SHORT_NAMES.get(key, key): value for key, value in reading.items()}
+
+
+def from_stored(document: Dict[str, Any]) -> Dict[str, Any]:
+    """A stored document (either layout) with the full field names."""
+    if not any(key in FULL_NAMES for key in document):
+        return document
+    return {FULL_NAMES.get(key, key): value for key, value in document.items()}
+
+
+def read_projection(fields: Iterable[str]) -> Dict[str, Any]:
+    """
+    $project stage body returning `fields` under their full names from
+    documents in either layout. Fields missing from a document come back
+    as null.
+    """
+    projection: Dict[str, Any] = {}
+    for field in fields:
+        short = SHORT_NAMES.get(field)
+        projection[field] = {"$ifNull": [f"${short}", f"${field}"]} if short else 1
+    return projection
@@ -0,0 +1,242 @@
+"""
+Compact binary encoding for device readings.
+
+The JSON readings repeat the same five field names in every message. Schema
+version 1 replaces them with a fixed struct layout:
+
+    B   presence mask (one bit per known field, plus EXTRAS_BIT)
+    I   Device_ID
+    d   Battery_Level
+    d   First_Sensor_temperature
+    B+s Route_From (length-prefixed UTF-8)
+    B+s Route_To   (length-prefixed UTF-8)
+    I+s extra fields as JSON (only when EXTRAS_BIT is set)
+
+Any field that does not fit the layout (wrong type, out of range) is carried
+in the JSON extras block instead, so encoding is lossless.
+
+The format is negotiated on the socket between server.py and producer.py
+(HELLO / FORMAT lines), and announced to consumers through Kafka headers.
+Kafka messages without a schema header are treated as plain JSON.
+"""
+import struct
+from typing import Any, Dict, List, Optional, Tuple
+
+import codec
+
+FORMAT_JSON = "json"
+FORMAT_BINARY = "bin1"
+SUPPORTED_FORMATS = (FORMAT_BINARY, FORMAT_JSON)
+
+SCHEMA_ID = 1
+SCHEMA_HEADER = "schema-id"
+CONTENT_TYPE_HEADER = "content-type"
+BINARY_CONTENT_TYPE = b"application/x-scm-device-v1"
+
+# Handshake lines exchanged on the socket before any data
+HELLO_PREFIX = b"HELLO "
+FORMAT_PREFIX = b"FORMAT "
+
+_FIXED = struct.Struct("<BIdd")
+_FRAME_LENGTH = struct.Struct("<I")
+_EXTRAS_LENGTH = struct.Struct("<I")
+
+DEVICE_ID_BIT = 1 << 0
+BATTERY_BIT = 1 << 1
+TEMPERATURE_BIT = 1 << 2
+ROUTE_FROM_BIT = 1 << 3
+ROUTE_TO_BIT = 1 << 4
+EXTRAS_BIT = 1 << 7
+
+_UINT32_MAX = 2 ** 32 - 1
+
+
+class WireFormatError(ValueError):
+    """Raised when a binary payload cannot be decoded."""
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _route_bytes(value: Any) -> Optional[bytes]:
+    if not isinstance(value, str):
+        return None
+    encoded = value.encode("utf-8")
+    return encoded if len(encoded) <= 255 else None
+
+
+def encode_reading(reading: Dict[str, Any]) -> bytes:
+    """Encode one reading dict with schema version 1."""
+    extras = dict(reading)
+    mask = 0
+
+    device_id = extras.pop("Device_ID", None)
+    if isinstance(device_id, int) and not isinstance(device_id, bool) and 0 <= device_id <= _UINT32_MAX:
+        mask |= DEVICE_ID_BIT
+    else:
+        if "Device_ID" in reading:
+            extras["Device_ID"] = device_id
+        device_id = 0
+
+    battery = extras.pop("Battery_Level", None)
+    if _is_number(battery):
+        mask |= BATTERY_BIT
+    else:
+        if "Battery_Level" in reading:
+            extras["Battery_Level"] = battery
+        battery = 0.0
+
+    temperature = extras.pop("First_Sensor_temperature", None)
+    if _is_number(temperature):
+        mask |= TEMPERATURE_BIT
+    else:
+        if "First_Sensor_temperature" in reading:
+            extras["First_Sensor_temperature"] = temperature
+        temperature = 0.0
+
+    route_from = _route_bytes(reading.get("Route_From"))
+    if route_from is not None:
+        mask |= ROUTE_FROM_BIT
+        extras.pop("Route_From")
+    route_to = _route_bytes(reading.get("Route_To"))
+    if route_to is not None:
+        mask |= ROUTE_TO_BIT
+        extras.pop("Route_To")
+
+    parts = [_FIXED.pack(mask | (EXTRAS_BIT if extras else 0), device_id, float(battery), float(temperature))]
+    for route in (route_from, route_to):
+        route = route or b""
+        parts.append(bytes((len(route),)))
+        parts.append(route)
+    if extras:
+        extras_bytes = codec.dumps(extras)
+        parts.append(_EXTRAS_LENGTH.pack(len(extras_bytes)))
+        parts.append(extras_bytes)
+    return b"".join(parts)
+
+
+def decode_reading(payload: bytes) -> Dict[str, Any]:
+    """Decode a schema version 1 payload back into a reading dict."""
+    try:
+        mask, device_id, battery, temperature = _FIXED.unpack_from(payload, 0)
+        offset = _FIXED.size
+        routes = []
+        for _ in range(2):
+            length = payload[offset]
+            offset += 1
+            routes.append(bytes(payload[offset:offset + length]).decode("utf-8"))
+            offset += length
+
+        reading: Dict[str, Any] = {}
+        if mask & BATTERY_BIT:
+            reading["Battery_Level"] = battery
+        if mask & DEVICE_ID_BIT:
+            reading["Device_ID"] = device_id
+        if mask & TEMPERATURE_BIT:
+            reading["First_Sensor_temperature"] = temperature
+        if mask & ROUTE_FROM_BIT:
+            reading["Route_From"] = routes[0]
+        if mask & ROUTE_TO_BIT:
+            reading["Route_To"] = routes[1]
+        if mask & EXTRAS_BIT:
+            (length,) = _EXTRAS_LENGTH.unpack_from(payload, offset)
+            offset += _EXTRAS_LENGTH.size
+            reading.update(codec.loads(bytes(payload[offset:offset + length])))
+        return reading
+    except (struct.error, IndexError, UnicodeDecodeError, codec.JSONDecodeError) as e:
+        raise WireFormatError(f"Malformed schema {SCHEMA_ID} payload: {e}") from e
+
+
+def peek_device_id(payload: bytes) -> Any:
+    """
+    Read Device_ID from a binary payload without decoding the rest, unless it
+    did not fit the layout and travelled in the extras block.
+    """
+    mask, device_id, _, _ = _FIXED.unpack_from(payload, 0)
+    if mask & DEVICE_ID_BIT:
+        return device_id
+    if mask & EXTRAS_BIT:
+        return decode_reading(payload).get("Device_ID")
+    return None
+
+
+# ------------------ SOCKET FRAMING ------------------
+
+def encode_frame(payload: bytes) -> bytes:
+    """Length-prefix one binary payload for the socket stream."""
+    return _FRAME_LENGTH.pack(len(payload)) + payload
+
+
+def split_frames(buffer: bytearray) -> List[bytes]:
+    """Pop every complete frame off the front of buffer."""
+    frames = []
+    offset = 0
+    while len(buffer) - offset >= _FRAME_LENGTH.size:
+        (length,) = _FRAME_LENGTH.unpack_from(buffer, offset)
+        end = offset + _FRAME_LENGTH.size + length
+        if end > len(buffer):
+            break
+        frames.append(bytes(buffer[offset + _FRAME_LENGTH.size:end]))
+        offset = end
+    del buffer[:offset]
+    return frames
+
+
+def hello_line(formats=SUPPORTED_FORMATS) -> bytes:
+    """Line the producer sends to offer formats, in order of preference."""
+    return HELLO_PREFIX + ",".join(formats).encode("ascii") + b"\n"
+
+
+def parse_hello(line: bytes) -> List[str]:
+    """Formats offered in a HELLO line, or [] if it is not one."""
+    if not line.startswith(HELLO_PREFIX):
+        return []
+    return [f.strip() for f in line[len(HELLO_PREFIX):].decode("ascii", "replace").split(",") if f.strip()]
+
+
+def choose_format(offered: List[str], enabled: str) -> str:
+    """Server side: pick the binary format only if both sides enable it."""
+    if enabled == FORMAT_BINARY and FORMAT_BINARY in offered:
+        return FORMAT_BINARY
+    return FORMAT_JSON
+
+
+def format_line(selected: str) -> bytes:
+    return FORMAT_PREFIX + selected.encode("ascii") + b"\n"
+
+
+def parse_format(line: bytes) -> Optional[str]:
+    """Format selected in a FORMAT line, or None if it is not one."""
+    if not line.startswith(FORMAT_PREFIX):
+        return None
+    selected = line[len(FORMAT_PREFIX):].decode("ascii", "replace").strip()
+    return selected if selected in SUPPORTED_FORMATS else FORMAT_JSON
+
+
+# ------------------ KAFKA HEADERS ------------------
+
+def kafka_headers(selected: str) -> List[Tuple[str, bytes]]:
+    """Headers to attach to a Kafka record encoded with `selected`."""
+    if selected == FORMAT_BINARY:
+        return [(SCHEMA_HEADER, str(SCHEMA_ID).encode("ascii")), (CONTENT_TYPE_HEADER, BINARY_CONTENT_TYPE)]
+    return []
+
+
+def decode_kafka_value(value: bytes, headers) -> Any:
+    """
+    Decode a Kafka record value using its headers.
+
+    Records without a schema header predate the binary format and are parsed
+    as JSON. Raises WireFormatError for unknown schema ids.
+    """
+    schema_id = None
+    for key, header_value in headers or ():
+        if key == SCHEMA_HEADER:
+            schema_id = header_value
+            break
+    if schema_id is None:
+        return codec.loads(value)
+    if schema_id == str(SCHEMA_ID).encode("ascii"):
+        return decode_reading(value)
+    raise WireFormatError(f"Unsupported schema id: {schema_id!r}")